@@ -3,12 +3,15 @@ from os.path import join, basename
 import os
 import sys
 import re
-import tarfile
+import json
+import hashlib
 import setuptools
 import logging
 import stat
 import imp
 import shutil
+from functools import partial
+from itertools import chain
 try:
     from ConfigParser import ConfigParser, RawConfigParser  # Python 2
 except ImportError:
@@ -27,44 +30,21 @@ from zc.buildout.easy_install import Installer
 from zc.buildout.easy_install import IncompatibleConstraintError
 
 import zc.recipe.egg
-try:
-    import httplib  # Python 2
-except ImportError:
-    from http import client as httplib  # Python 3
-from email import utils as email_utils
-try:
-    from urllib import urlretrieve  # Python 2
-except ImportError:
-    from urllib.request import urlretrieve  # Python 3
 try:
     from urlparse import urlparse  # Python 2
 except ImportError:
     from urllib.parse import urlparse  # Python 3
 from . import vcs
 from . import utils
+from . import download
+from .download import get_content_type  # noqa
 from .utils import option_splitlines, option_strip, conf_ensure_section
+from .requirements import parse_requirements, editable_project_name
 
 logger = logging.getLogger(__name__)
 
 if sys.version_info >= (2, 7):
     unicode = str
-else:
-    from .utils import next
-
-
-def rfc822_time(h):
-    """Parse RFC 2822-formatted http header and return a time int."""
-    email_utils.mktime_tz(email_utils.parsedate_tz(h))
-
-
-def get_content_type(msg):
-    """Return the mimetype of the HTTP message.
-    This is a helper to support Python 2 and 3.
-    """
-    try:
-        return msg.type
-    except AttributeError:
-        return msg.get_content_type()
 
 
 class MainSoftware(object):
@@ -89,25 +69,10 @@ GP_DEVELOP_DIR = 'develop-dir'
 
 WITH_ODOO_REQUIREMENTS_FILE_OPTION = 'apply-requirements-file'
 
+EXTRACT_MANIFEST = '.buildout-extract-manifest.json'
+"""Name of the file listing the members extracted from the main archive.
 
-def pip_version():
-    import pip
-    # we don't use pip or setuptools APIs for that to avoid going
-    # in a swath of instability.
-    # TODO we could try and use the version class from runtime.session
-    # (has the advantage over pkf_resources' of direct transparent
-    # comparison to tuples), but that'd introduced logical deps problems
-    # that I don't want to solve right now.
-
-    pip_version = pip.__version__
-    # Naturally, pip has strictly conformed to PEP440, and does not use
-    # version epochs, since at least v1.2. the oldest I could easily check
-    # (we claim to support >= 1.4.1).
-    # This equates all pre versions with the final one, and that's good
-    # enough for current purposes:
-    for suffix in ('a', 'b', 'rc', '.dev', '.post'):
-        pip_version = pip_version.split(suffix)[0]
-    return tuple(int(x) for x in pip_version.split('.'))
+It lies in the extracted directory."""
 
 
 class BaseRecipe(object):
@@ -178,7 +143,8 @@ class BaseRecipe(object):
     addons_paths = ()
 
     # Caching logic for the main Odoo part (e.g, without addons)
-    # Can be 'filename' or 'http-head'
+    # Can be 'filename' or 'http-head' (the latter actually meaning
+    # a conditional GET request)
     main_http_caching = 'filename'
 
     is_git_layout = False
@@ -203,6 +169,24 @@ class BaseRecipe(object):
         options = self.b_options if is_global else self.options
         return options.get(name, '').lower() == 'true'
 
+    def int_opt_get(self, name, default):
+        """Retrieve an option and interpret it as a positive integer.
+
+        :raises UserError: if the value is not a positive integer
+        """
+        value = self.options.get(name)
+        if value is None or not value.strip():
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            value = 0
+        if value <= 0:
+            raise UserError("Invalid value %r for option %r in part %r "
+                            "(expecting a positive integer)" % (
+                                self.options[name], name, self.name))
+        return value
+
     def __init__(self, buildout, name, options):
         self.requirements = list(self.requirements)
         self.recipe_requirements_path = []
@@ -218,13 +202,20 @@ class BaseRecipe(object):
         self.vcs_clear_locks = clear_locks == 'true'
         clear_retry = options.get('vcs-clear-retry', '').lower()
         self.clear_retry = clear_retry == 'true'
+        self.vcs_jobs = self.int_opt_get('vcs-jobs', 1)
+        self.vcs_fingerprint = options.get(
+            'vcs-fingerprint', 'true').lower() == 'true'
+        self.working_set_cache = options.get(
+            'working-set-cache', 'true').lower() == 'true'
+        refs_cache_ttl = self.int_opt_get('vcs-refs-cache-ttl', None)
+        self.refs_cache = None
+        if refs_cache_ttl is not None and not self.offline:
+            self.refs_cache = vcs.RefsCache(
+                os.path.splitext(self.b_options['installed'])[0] +
+                '.vcs-refs.json', refs_cache_ttl)
 
         if self.bool_opt_get(WITH_ODOO_REQUIREMENTS_FILE_OPTION):
-            logger.debug("%s option: adding 'pip' to the recipe requirements",
-                         WITH_ODOO_REQUIREMENTS_FILE_OPTION)
             self.with_odoo_requirements_file = True
-            self.recipe_requirements = list(self.recipe_requirements)
-            self.recipe_requirements.append('pip')
 
         self.python_scripts_executable = options.get(
             'python-scripts-executable')
@@ -245,14 +236,45 @@ class BaseRecipe(object):
         ]
         self.options['extra-paths'] = os.linesep.join(self.extra_paths)
 
+        for opt in ('git-cache-directory', 'bzr-shared-repo', 'wheelhouse'):
+            shared_dir = option_strip(self.options.get(opt))
+            if shared_dir:
+                # typically host-wide, hence in the user's home directory
+                self.options[opt] = self.make_absolute(
+                    os.path.expanduser(shared_dir))
+
+        self.wheelhouse = self.options.get('wheelhouse')
+        self.wheelhouse_fill = self.bool_opt_get('wheelhouse-fill')
+        if self.wheelhouse:
+            # looked up first, and prebuilt distributions have precedence
+            # over source ones for the same version anyway
+            links = self.options.get('find-links',
+                                     self.b_options.get('find-links', ''))
+            self.options['find-links'] = os.linesep.join(
+                [self.wheelhouse] + links.split())
+
         self.downloads_dir = self.make_absolute(
             self.b_options.get('odoo-downloads-directory', 'downloads'))
+        self.download_cache = None
+        cache_dir = option_strip(self.b_options.get('odoo-download-cache'))
+        if cache_dir:
+            cache_size = self.b_options.get('odoo-download-cache-size',
+                                            download.DEFAULT_CACHE_SIZE)
+            try:
+                cache_size = download.parse_size(cache_size)
+            except ValueError:
+                raise UserError("Invalid odoo-download-cache-size: %r" % (
+                    cache_size,))
+            self.download_cache = download.DownloadCache(
+                self.make_absolute(os.path.expanduser(cache_dir)),
+                max_size=cache_size)
         self.version_wanted = None  # from the buildout
         self.version_detected = None  # string from the odoo setup.py
         self.parts = self.buildout['buildout']['parts-directory']
         self.odoo_dir = None
         self.archive_filename = None
         self.archive_path = None  # downloaded tar.gz
+        self.archive_mirrors = []  # alternative URLs of the archive
 
         if options.get('scripts') is None:
             options['scripts'] = ''
@@ -307,11 +329,9 @@ class BaseRecipe(object):
 
             self.archive_filename = pattern % self.version_wanted
             self.archive_path = join(self.downloads_dir, self.archive_filename)
-            base_url = self.options.get(
-                'base_url', self.release_dl_url[major_wanted])
-            self.sources[main_software] = (
-                'downloadable',
-                '/'.join((base_url.strip('/'), self.archive_filename)), None)
+            urls = self.archive_urls(self.release_dl_url[major_wanted])
+            self.sources[main_software] = ('downloadable', urls[0], None)
+            self.archive_mirrors = urls[1:]
             return
 
         # in all other cases, the first token is the type of version
@@ -323,13 +343,15 @@ class BaseRecipe(object):
             url = version_split[1]
             self.archive_filename = urlparse(url).path.split('/')[-1]
             self.archive_path = join(self.downloads_dir, self.archive_filename)
-            self.sources[main_software] = ('downloadable', url, None)
+            self.sources[main_software] = (
+                'downloadable', url,
+                self.parse_download_options(version_split[2:]))
         elif type_spec == 'nightly':
-            if len(version_split) != 3:
+            if len(version_split) < 3:
                 raise UserError(
                     "Unrecognized nightly version specification: "
                     "%r (expecting series, number) % version_split[1:]")
-            self.nightly_series, self.version_wanted = version_split[1:]
+            self.nightly_series, self.version_wanted = version_split[1:3]
             type_spec = 'downloadable'
             if self.version_wanted == 'latest':
                 self.main_http_caching = 'http-head'
@@ -337,20 +359,51 @@ class BaseRecipe(object):
             self.archive_filename = (
                 self.nightly_filenames[series] % self.version_wanted)
             self.archive_path = join(self.downloads_dir, self.archive_filename)
-            base_url = self.options.get('base_url',
-                                        self.nightly_dl_url[series])
+            urls = self.archive_urls(self.nightly_dl_url[series])
             self.sources[main_software] = (
-                'downloadable',
-                '/'.join((base_url.strip('/'), self.archive_filename)),
-                None)
+                'downloadable', urls[0],
+                self.parse_download_options(version_split[3:]))
+            self.archive_mirrors = urls[1:]
         else:
             # VCS types
             type_spec, url, repo_dir, self.version_wanted = version_split[0:4]
-            options = dict(opt.split('=') for opt in version_split[4:])
+            options = dict(opt.split('=', 1) for opt in version_split[4:])
             self.odoo_dir = join(self.parts, repo_dir)
             self.sources[main_software] = (type_spec,
                                            (url, self.version_wanted), options)
 
+    def archive_urls(self, default_base_url):
+        """Return the URLs of :attr:`archive_filename` for all mirrors.
+
+        The ``base_url`` option can list several mirrors, the first one
+        being used as the reference URL of the archive.
+        """
+        base_urls = self.options.get('base_url', default_base_url).split()
+        if not base_urls:
+            raise UserError("Empty base_url option")
+        return ['/'.join((base_url.strip('/'), self.archive_filename))
+                for base_url in base_urls]
+
+    def parse_download_options(self, tokens):
+        """Parse the options of a downloadable version specification.
+
+        The only option currently is ``sha256``, to check the download.
+
+        :returns: the options ``dict``, or ``None`` if there aren't any.
+        """
+        if not tokens:
+            return None
+        try:
+            options = dict(opt.split('=', 1) for opt in tokens)
+        except ValueError:
+            raise UserError("Unrecognized options in version "
+                            "specification: %r" % ' '.join(tokens))
+        unknown = set(options) - set(('sha256', ))
+        if unknown:
+            raise UserError("Unknown options in version specification: "
+                            "%s" % ', '.join(sorted(unknown)))
+        return options
+
     def preinstall_version_check(self):
         """Perform version checks before any attempt to install.
 
@@ -361,7 +414,10 @@ class BaseRecipe(object):
         """Install requirements for the recipe to run."""
         to_install = self.recipe_requirements
         eggs_option = os.linesep.join(to_install)
-        eggs = zc.recipe.egg.Eggs(self.buildout, '', dict(eggs=eggs_option))
+        eggs_options = dict(eggs=eggs_option)
+        if self.wheelhouse:
+            eggs_options['find-links'] = self.options['find-links']
+        eggs = zc.recipe.egg.Eggs(self.buildout, '', eggs_options)
         ws = eggs.install()
         _, ws = eggs.working_set()
         self.recipe_requirements_paths = [ws.by_key[dist].location
@@ -428,125 +484,26 @@ class BaseRecipe(object):
                         "Proceeding anyway.", req_fname)
             return
 
-        # pip wouldn't be importable before the call to
-        # install_recipe_requirements()
-
-        # if an extension has used pip before, it can be left in a
-        # strange state where pip.req is not usable nor reloadable
-        # anymore. (may have something to do with the fact that the
-        # first import is done from a tmp dir
-        # that does not exist any more).
-        # So, better to clean that before hand.
-        for k in list(sys.modules.keys()):
-            if k.split('.', 1)[0] == 'pip':
-                del sys.modules[k]
-
         # it is useless to mutate the versions section at this point
         # it's already been used to populate the Installer class variable
         versions = Installer._versions
         develops = self.list_develops()
-
-        if pip_version() < (8, 1, 2):
-            self.read_requirements_pip_before_v8(req_path, versions, develops)
-        else:
-            self.read_requirements_pip_after_v8(req_path, versions, develops)
+        self.read_requirements(req_path, versions, develops)
         self.merge_requirements()
 
-    def read_requirements_pip_before_v8(self, req_path, versions, develops):
-        from pip.req import parse_requirements
-        if pip_version() < (1, 5):
-            parsed = parse_requirements(req_path)
-        else:
-            # pip internals are protected against the fact of not passing
-            # a session with ``is None``. OTOH, the session is not used
-            # if the file is local (direct path, not an URL), so we cheat
-            # it.
-            # Although this hack still works with pip 8, it's considered to be
-            # the kind of thing that can depend on pip version
-            fake_session = object()
-            parsed = parse_requirements(req_path, session=fake_session)
-
-        for inst_req in parsed:
-            req = inst_req.req
-            logger.debug("Considering requirement from Odoo's file %s",
-                         req)
-            # GR something more interesting would be to apply the
-            # requirement if it does not contradict an existing one.
-            # For now that's too much complicated, but check later if
-            # zc.buildout.easy_install._constrain() fits the bill.
+    def read_requirements(self, req_path, versions, develops):
+        """Apply the requirements file to versions and self.requirements.
 
-            project_name = req.project_name
-            if project_name not in self.requirements:
-                # TODO maybe convert self.requirements to a set (in
-                # next unstable branch)
-                self.requirements.append(str(project_name))
-
-            if inst_req.markers:
-                logger.warn("Requirement %s has a marker %s but the evaluation"
-                            " of markers is not supported in this old version "
-                            "of pip. Please upgrade to pip 8.2 or higher. ",
-                            project_name, inst_req.markers)
-
-            if project_name in versions:
-                logger.debug("Requirement from Odoo's file %s superseded "
-                             "by buildout versions configuration as %r",
-                             req, versions[project_name])
-                continue
-
-            if project_name in develops:
-                logger.debug("Requirement from Odoo's file %s superseded "
-                             "by a direct develop directive", req)
-                continue
-
-            if not req.specs:
-                continue
-
-            supported = True
-
-            if len(req.specs) > 1:
-                supported = False
-            spec = req.specs[0]
-            if spec[0] != '==' or '*' in spec[1]:
-                supported = False
-
-            if not supported:
-                raise UserError(
-                    "Version requirement %s from Odoo's requirement file "
-                    "is too complicated to be taken automatically into "
-                    "account. Please override it in your [%s] "
-                    "configuration section. Future support of this format "
-                    "is pending the release of buildout 3.0.0 which relies on "
-                    "pip rather than setuptools.easy_install." % (
-                        req, self.b_options.get('versions', 'versions')))
-
-            logger.debug("Applying requirement %s from Odoo's file",
-                         req)
-            versions[project_name] = spec[1]
-
-    def read_requirements_pip_after_v8(self, req_path, versions, develops):
-        # pip internals are protected against the fact of not passing
-        # a session with ``is None``. OTOH, the session is not used
-        # if the file is local (direct path, not an URL), so we cheat
-        # it.
-        fake_session = object()
-        if pip_version() < (10, 0, 0):
-            from pip.req import parse_requirements
-        else:
-            from pip._internal.req import parse_requirements
-        for inst_req in parse_requirements(req_path, session=fake_session):
-            if pip_version() < (20, 0, 0):
-                req = inst_req.req
-                project_name = req.name.lower()
-                marker = inst_req.markers
-            else:
-                req = pkg_resources.Requirement.parse(inst_req.requirement)
-                project_name = req.project_name.lower()
-                marker = req.marker
+        The file is parsed statically (see
+        :func:`.requirements.parse_requirements`), without importing pip.
+        """
+        for req in parse_requirements(req_path):
+            project_name = req.project_name.lower()
+            marker = getattr(req, 'marker', None)
             if marker and not marker.evaluate():
                 logger.debug("Skipping requirement %s with marker %s",
                              project_name, marker)
                 continue
-            specs = req.specifier
             logger.debug("Considering requirement from Odoo's file %s",
                          req)
             # GR something more interesting would be to apply the
@@ -572,19 +529,11 @@ class BaseRecipe(object):
                              "by a direct develop directive", req)
                 continue
 
-            specs = req.specifier
-            if not specs:
+            if not req.specs:
                 continue
 
-            supported = True
-
-            if len(specs) > 1:
-                supported = False
-            spec = next(specs.__iter__())
-            if spec.operator != '==' or '*' in spec.version:
-                supported = False
-
-            if not supported:
+            operator, version = req.specs[0]
+            if len(req.specs) > 1 or operator != '==' or '*' in version:
                 raise UserError(
                     "Version requirement %s from Odoo's requirement file "
                     "is too complicated to be taken automatically into "
@@ -596,7 +545,7 @@ class BaseRecipe(object):
 
             logger.debug("Applying requirement %s from Odoo's file",
                          req)
-            versions[project_name] = spec.version
+            versions[project_name] = version
 
     def install_requirements(self):
         """Install egg requirements and scripts.
@@ -607,16 +556,36 @@ class BaseRecipe(object):
         if self.with_odoo_requirements_file:
             self.apply_odoo_requirements_file()
 
+        ws_key = None
+        if self.working_set_cache:
+            ws_key = self.working_set_key()
+            if self.load_working_set(ws_key):
+                # still needed for the options it sets (bin-directory etc.)
+                zc.recipe.egg.Scripts(self.buildout, '', self.options)
+                return
+
+        missing_soft = self.missing_soft_requirements()
+        if missing_soft:
+            for missing in missing_soft:
+                logger.warn("Soft requirement %r is not available, "
+                            "not installing it. " +
+                            self.missing_deps_instructions.get(missing, ''),
+                            missing)
+            eggs = self.options['eggs'].split(os.linesep)
+            self.options['eggs'] = os.linesep.join(
+                egg for egg in eggs if egg not in missing_soft)
+
         while True:
             missing = None
             eggs_recipe = zc.recipe.egg.Scripts(self.buildout, '',
                                                 self.options)
             raised_exc = None
             try:
-                eggs_recipe.install()
-            except MissingDistribution as exc:
-                raised_exc = exc
-                missing = exc.data[0].project_name
+                # install() resolves again, only needed to generate scripts
+                self.eggs_reqs, self.eggs_ws = eggs_recipe.working_set()
+                self.eggs_scripts = []
+                if self.options.get('scripts'):
+                    self.eggs_scripts = list(eggs_recipe.install())
             except VersionConflict as exc:
                 # GR not 100% sure, but this should mean a conflict with an
                 # already loaded version (don't know what can lead to this
@@ -625,13 +594,10 @@ class BaseRecipe(object):
                 # recovery
                 raised_exc = exc
                 raise
-            except IncompatibleConstraintError as exc:
-                raised_exc = exc
-                missing = exc.args[2].project_name
-            except UserError as exc:  # happens only for zc.buildout >= 2.0
+            except (MissingDistribution, IncompatibleConstraintError,
+                    UserError) as exc:
                 raised_exc = exc
-                missing = unicode(exc).split(os.linesep)[0].split()[-1]
-                missing = re.split(r'[=<>]', missing)[0]
+                missing = self.missing_project_name(exc)
             else:
                 break
 
@@ -656,8 +622,208 @@ class BaseRecipe(object):
             eggs.discard(missing)
             self.options['eggs'] = os.linesep.join(eggs)
 
-        self.eggs_reqs, self.eggs_ws = eggs_recipe.working_set()
         self.ws = self.eggs_ws
+        if ws_key is not None:
+            self.save_working_set(ws_key)
+
+    def fill_wheelhouse(self):
+        """Store the distributions of the working set into the wheelhouse.
+
+        These are the distributions installed as egg directories in the
+        eggs directory: they are zipped back into eggs, that can be
+        installed without building anything by other buildouts having the
+        same wheelhouse. Develop eggs and system-wide distributions are
+        left out.
+        """
+        if not self.wheelhouse:
+            raise UserError("The wheelhouse-fill option needs a "
+                            "wheelhouse directory")
+        if not os.path.isdir(self.wheelhouse):
+            os.makedirs(self.wheelhouse)
+        eggs_dir = os.path.realpath(self.b_options['eggs-directory'])
+        for dist in self.ws:
+            location = os.path.realpath(dist.location)
+            if (os.path.dirname(location) != eggs_dir or
+                    not os.path.isdir(location) or
+                    not location.endswith('.egg')):
+                continue
+            target = join(self.wheelhouse, basename(location))
+            if os.path.exists(target):
+                continue
+            logger.info("Adding %s to wheelhouse", basename(location))
+            utils.zip_directory(location, target + '.tmp')
+            os.rename(target + '.tmp', target)
+
+    @staticmethod
+    def missing_project_name(exc):
+        """Return the name of the project an installation error is about."""
+        if isinstance(exc, MissingDistribution):
+            return exc.data[0].project_name
+        if isinstance(exc, IncompatibleConstraintError):
+            return exc.args[2].project_name
+        # UserError, happens only for zc.buildout >= 2.0
+        missing = unicode(exc).split(os.linesep)[0].split()[-1]
+        return re.split(r'[=<>]', missing)[0]
+
+    def missing_soft_requirements(self):
+        """Return the direct soft requirements that can't be installed.
+
+        They are looked for concurrently, in the eggs and develop-eggs
+        directories, then in the package index and find-links (unless
+        offline), taking the versions section into account. This avoids
+        resolving all requirements again for each missing one.
+        """
+        eggs = set(self.options['eggs'].split(os.linesep))
+        soft = [name for name in self.soft_requirements if name in eggs]
+        if not soft:
+            return []
+        b_options = self.b_options
+        links = self.options.get('find-links', b_options['find-links'])
+        allow_hosts = tuple(host.strip()
+                            for host in b_options['allow-hosts'].split('\n')
+                            if host.strip()) or ('*', )
+        missing = set()
+
+        def check(name):
+            # one installer (hence package index) per thread
+            installer = Installer(
+                dest=b_options['eggs-directory'],
+                links=links.split(),
+                index=self.options.get('index', b_options.get('index')),
+                path=[b_options['develop-eggs-directory']],
+                newest=False,
+                allow_hosts=allow_hosts)
+            try:
+                req = installer._constrain(
+                    pkg_resources.Requirement.parse(name))
+                if any(dist in req
+                       for dist in installer._env[req.project_name]):
+                    return
+                if self.offline or installer._obtain(req) is None:
+                    missing.add(name)
+            except (MissingDistribution, IncompatibleConstraintError,
+                    UserError) as exc:
+                # if about another project, left to the full resolution
+                if self.missing_project_name(exc) == name:
+                    missing.add(name)
+
+        failures = utils.run_jobs(len(soft), [(name, partial(check, name))
+                                              for name in soft])
+        if failures:
+            utils.reraise(failures[0][1])
+        return [name for name in soft if name in missing]
+
+    @property
+    def working_set_path(self):
+        return (os.path.splitext(self.b_options['installed'])[0] +
+                '.%s-working-set.json' % self.name)
+
+    working_set_script_options = ('scripts', 'interpreter', 'entry-points',
+                                  'extra-paths', 'initialization',
+                                  'arguments', 'dependent-scripts')
+    """Options of ``zc.recipe.egg`` that affect the generated scripts."""
+
+    def working_set_key(self):
+        """Hash everything the resolution of requirements depends upon.
+
+        That is the ``eggs`` option, the versions in use (including those
+        coming from Odoo's requirements file), the develop eggs (egg links
+        and metadata of their source directories, see
+        :meth:`develop_fingerprint`), the package indexes and the
+        interpreter. Since scripts are not generated again on a cache hit,
+        the options that control them are included as well.
+        """
+        develop_dir = self.b_options['develop-eggs-directory']
+        develops = []
+        if os.path.isdir(develop_dir):
+            for name in sorted(os.listdir(develop_dir)):
+                path = join(develop_dir, name)
+                if name.startswith('.') or not os.path.isfile(path):
+                    continue
+                with open(path) as f:
+                    content = f.read()
+                src_dir = content.split('\n', 1)[0].strip()
+                develops.append((name, content, os.path.isdir(src_dir) and
+                                 self.develop_fingerprint(src_dir)))
+        material = dict(
+            eggs=self.options.get('eggs', ''),
+            versions=sorted(Installer._versions.items()),
+            develops=develops,
+            find_links=self.options.get('find-links',
+                                        self.b_options.get('find-links')),
+            index=self.options.get('index', self.b_options.get('index')),
+            executable=sys.executable,
+            scripts=dict((opt, self.options.get(opt))
+                         for opt in self.working_set_script_options),
+        )
+        return hashlib.sha256(
+            json.dumps(material, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load_working_set(self, key):
+        """Set the resolved requirements from the working set cache.
+
+        The cache is not used if ``newest`` is in effect and some of the
+        cached distributions are not pinned to their exact version in the
+        versions section, since a newer one could be available. Neither is
+        it used if some of the scripts generated along are missing.
+
+        :returns: ``True`` if the cache was valid for the given key.
+        """
+        try:
+            with open(self.working_set_path) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if cached.get('key') != key:
+            return False
+        # scripts are not generated again on a cache hit
+        for script in cached.get('scripts', ()):
+            if not os.path.exists(script):
+                logger.info("Script %s is missing, resolving requirements "
+                            "again", script)
+                return False
+
+        check_pins = (self.b_options.get('newest') == 'true' and
+                      not self.offline)
+        eggs_dir = self.b_options['eggs-directory']
+        ws = pkg_resources.WorkingSet([])
+        for project_name, version, location in cached['dists']:
+            if check_pins and location.startswith(eggs_dir):
+                pinned = Installer._versions.get(project_name.lower())
+                if pinned is None or (pkg_resources.parse_version(pinned) !=
+                                      pkg_resources.parse_version(version)):
+                    return False
+            if not os.path.exists(location):
+                return False
+            for dist in pkg_resources.find_distributions(location):
+                if (dist.project_name == project_name and
+                        dist.version == version):
+                    ws.add(dist)
+                    break
+            else:
+                return False
+
+        logger.info("Requirements unchanged, using the working set resolved "
+                    "previously (%d distributions)", len(cached['dists']))
+        # buildout options must be native strings (JSON gives unicode)
+        self.options['eggs'] = str(cached['eggs'])
+        self.eggs_reqs, self.eggs_ws = [str(r) for r in cached['reqs']], ws
+        self.eggs_scripts = [str(p) for p in cached.get('scripts', ())]
+        self.ws = self.eggs_ws
+        return True
+
+    def save_working_set(self, key):
+        """Persist the resolved requirements, for :meth:`load_working_set`.
+        """
+        cached = dict(key=key, eggs=self.options['eggs'],
+                      reqs=list(self.eggs_reqs),
+                      scripts=self.eggs_scripts,
+                      dists=[(dist.project_name, dist.version, dist.location)
+                             for dist in self.eggs_ws])
+        tmp_path = self.working_set_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cached, f)
+        os.rename(tmp_path, self.working_set_path)
 
     def apply_version_dependent_decisions(self):
         """Store some booleans depending on detected version.
@@ -754,18 +920,81 @@ class BaseRecipe(object):
         main directory in parts.
         It is taken for granted that this first member has already been
         checked.
+
+        Members are read forward only, so that this works with tar files
+        opened in stream mode (``'r|*'``), which are decompressed only once.
         """
 
         if first is not None:
             tarfile.extract(first)
 
-        for tinfo in tarfile:
+        for tinfo in iter(tarfile.next, None):
             if tinfo.name.startswith(sandbox + '/'):
                 tarfile.extract(tinfo)
             else:
                 logger.warn('Tarball member %r is outside of %r. Ignored.',
                             tinfo, sandbox)
 
+    @staticmethod
+    def tar_member_signature(tinfo):
+        """What tells apart two versions of a tar member, as a JSON list."""
+        for kind in ('dir', 'reg', 'sym', 'lnk'):
+            if getattr(tinfo, 'is' + kind)():
+                break
+        else:
+            kind = 'other'
+        return [kind, tinfo.size, int(tinfo.mtime), tinfo.mode,
+                tinfo.linkname]
+
+    def incremental_tar_extract(self, sandbox, tar, first, previous):
+        """Extract the members below sandbox that changed since last time.
+
+        Works as :meth:`sandboxed_tar_extract`, with target directory
+        :attr:`parts`.
+
+        :param previous: a ``dict`` giving the signatures of the members
+                         (see :meth:`tar_member_signature`) of the previous
+                         extraction. Unchanged members are skipped, and those
+                         that don't exist anymore are removed, along with
+                         their compiled files for Python modules.
+        :returns: the ``dict`` of current signatures.
+        """
+        current = {}
+        # no list: in stream mode, members must be extracted as they come
+        for tinfo in chain((first, ), iter(tar.next, None)):
+            if tinfo is not first and not tinfo.name.startswith(
+                    sandbox + '/'):
+                logger.warn('Tarball member %r is outside of %r. Ignored.',
+                            tinfo, sandbox)
+                continue
+            signature = current[tinfo.name] = self.tar_member_signature(
+                tinfo)
+            path = join(self.parts, tinfo.name)
+            if previous.get(tinfo.name) == signature and (
+                    os.path.lexists(path) and (
+                        not tinfo.isreg() or
+                        os.path.getsize(path) == tinfo.size)):
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                if not tinfo.isdir():
+                    shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)  # no overwriting, in case of hard links
+            tar.extract(tinfo, self.parts)
+
+        # reverse order: directory contents come before directories
+        for name in sorted(set(previous) - set(current), reverse=True):
+            path = join(self.parts, name)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)
+                if path.endswith('.py'):
+                    for compiled in (path + 'c', path + 'o'):
+                        if os.path.exists(compiled):
+                            os.unlink(compiled)
+        return current
+
     def develop(self, src_directory):
         """Develop the specified source distribution.
 
@@ -782,8 +1011,27 @@ class BaseRecipe(object):
                   This is useful for OpenERP/Odoo itself, whose project name
                   changed within the 8.0 stable branch.
         """
-        logger.debug("Developing %r", src_directory)
         develop_dir = self.b_options['develop-eggs-directory']
+        fingerprint = self.develop_fingerprint(src_directory)
+        # the name must have a dot (see list_develops())
+        fingerprint_path = join(develop_dir, '.develop-%s.json' % (
+            hashlib.sha1(src_directory.encode('utf-8')).hexdigest()[:12]))
+        try:
+            with open(fingerprint_path) as f:
+                previous = json.load(f)
+        except (IOError, ValueError):
+            previous = {}
+        egg_link = previous.get('egg_link')
+        if (previous.get('fingerprint') == fingerprint and
+                egg_link is not None and
+                self.egg_link_target(egg_link) == os.path.normcase(
+                    os.path.realpath(src_directory))):
+            logger.debug("Setup of %r unchanged, keeping %s",
+                         src_directory, egg_link)
+            # buildout options must be native strings (JSON gives unicode)
+            return str(os.path.basename(egg_link)[:-len('.egg-link')])
+
+        logger.debug("Developing %r", src_directory)
         pythonpath_bak = os.getenv('PYTHONPATH')
         os.putenv('PYTHONPATH', ':'.join(self.recipe_requirements_paths))
 
@@ -801,8 +1049,51 @@ class BaseRecipe(object):
                 "Development of OpenERP/Odoo distribution "
                 "produced an unexpected egg link: %r" % egg_link)
 
+        # develop itself rewrites the metadata
+        with open(fingerprint_path, 'w') as f:
+            json.dump(dict(src=src_directory, egg_link=egg_link,
+                           fingerprint=self.develop_fingerprint(
+                               src_directory)), f)
         return os.path.basename(egg_link)[:-len(suffix)]
 
+    @staticmethod
+    def egg_link_target(egg_link):
+        """Return the normalized directory an egg link points to.
+
+        :returns: ``None`` if the egg link can't be read.
+        """
+        try:
+            with open(egg_link) as f:
+                target = f.readline().strip()
+        except IOError:
+            return None
+        return target and os.path.normcase(os.path.realpath(target)) or None
+
+    @staticmethod
+    def develop_fingerprint(src_directory):
+        """Hash what the result of developing src_directory depends upon.
+
+        That is the contents of ``setup.py``, ``setup.cfg`` and of the
+        package metadata (``.egg-info`` directories), along with the
+        Python interpreter.
+        """
+        hasher = hashlib.sha256(sys.executable.encode('utf-8'))
+        paths = [join(src_directory, name)
+                 for name in ('setup.py', 'setup.cfg')]
+        for name in sorted(os.listdir(src_directory)):
+            egg_info = join(src_directory, name)
+            if name.endswith('.egg-info') and os.path.isdir(egg_info):
+                paths.extend(join(egg_info, md)
+                             for md in sorted(os.listdir(egg_info))
+                             # lists all files, updated by develop itself
+                             if md != 'SOURCES.txt')
+        for path in paths:
+            hasher.update(b'\0' + path.encode('utf-8') + b'\0')
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    hasher.update(f.read())
+        return hasher.hexdigest()
+
     def parse_addons(self, options):
         """Parse the addons options into :attr:`sources`.
 
@@ -817,7 +1108,7 @@ class BaseRecipe(object):
                 loc_type = split[0]
                 spec_len = 2 if loc_type == 'local' else 4
 
-                options = dict(opt.split('=') for opt in split[spec_len:])
+                options = dict(opt.split('=', 1) for opt in split[spec_len:])
                 if loc_type == 'local':
                     addons_dir = split[1]
                     location_spec = None
@@ -849,7 +1140,7 @@ class BaseRecipe(object):
             if loc_type not in ('bzr', 'git'):
                 raise UserError("Only merges of type 'bzr' and 'git' are "
                                 "currently supported.")
-            options = dict(opt.split('=') for opt in split[4:])
+            options = dict(opt.split('=', 1) for opt in split[4:])
             if loc_type == 'bzr':
                 options['bzr-init'] = 'merge'
             else:
@@ -899,12 +1190,46 @@ class BaseRecipe(object):
                 (source[0], (source[1][0], revision)) + source[2:]
             )
 
+    def run_vcs_tasks(self, tasks):
+        """Run VCS tasks, up to ``vcs-jobs`` of them at the same time.
+
+        All tasks are run, even if some of them fail. Failures are then
+        logged, and an exception is raised: the original one if only one task
+        failed, an :class:`UserError` summing all of them up otherwise.
+
+        :param tasks: list of ``(description, callable)`` pairs.
+        """
+        failures = utils.run_jobs(self.vcs_jobs, tasks)
+        for descr, exc_info in failures:
+            logger.error("Failed retrieval for %s: %s.%s: %s",
+                         descr, exc_info[0].__module__, exc_info[0].__name__,
+                         exc_info[1])
+            logger.debug("Full traceback for %s", descr, exc_info=exc_info)
+        if len(failures) == 1:
+            utils.reraise(failures[0][1])
+        elif failures:
+            raise UserError("Retrieval failed for %d sources: %s. "
+                            "See the log above for details." % (
+                                len(failures),
+                                ', '.join(descr for descr, _ in failures)))
+
     def retrieve_addons(self):
         """Peform all lookup and downloads specified in :attr:`sources`.
 
         See :class:`BaseRecipe` for the structure of :attr:`sources`.
+
+        VCS operations are independent from one another, and are run
+        concurrently if the ``vcs-jobs`` option is greater than one.
+        The order of :attr:`addons_paths` stays the one of the ``addons``
+        option.
         """
         self.addons_paths = []
+        # each task is a list of directories and a list of updates to
+        # perform sequentially, because they share a Git repository
+        tasks = []
+        git_urls = set()
+        git_worktrees = self.bool_opt_get('git-worktrees')
+        git_tasks = {}  # URL -> task of the main repository
         for local_dir, source_spec in self.sources.items():
             if local_dir is main_software:
                 continue
@@ -912,9 +1237,12 @@ class BaseRecipe(object):
             local_dir = self.make_absolute(local_dir)
             options = dict(offline=self.offline,
                            clear_locks=self.vcs_clear_locks,
+                           refs_cache=self.refs_cache,
+                           fingerprint=self.vcs_fingerprint,
                            clean=self.clean)
             if loc_type == 'git':
                 options['depth'] = self.options.get('git-depth')
+                options['filter'] = self.options.get('git-filter')
             options.update(addons_options)
 
             group = addons_options.get('group')
@@ -931,6 +1259,7 @@ class BaseRecipe(object):
                         "you create yourself the intermediate directory." % (
                             local_dir, ))
 
+                # done before any VCS operation, hence never concurrently
                 group_dir = os.path.dirname(local_dir)
                 if not os.path.exists(group_dir):
                     os.makedirs(group_dir)
@@ -940,9 +1269,23 @@ class BaseRecipe(object):
                         options[k] = v
 
                 repo_url, repo_rev = loc_spec
-                vcs.get_update(loc_type, local_dir, repo_url, repo_rev,
-                               clear_retry=self.clear_retry,
-                               **options)
+                task = None
+                if loc_type == 'git':
+                    git_urls.add(repo_url)
+                    if git_worktrees:
+                        task = git_tasks.get(repo_url)
+                if task is not None:
+                    options['worktree_of'] = task[0][0]
+                else:
+                    task = ([], [])
+                    tasks.append(task)
+                    if loc_type == 'git':
+                        git_tasks[repo_url] = task
+                task[0].append(local_dir)
+                task[1].append(partial(vcs.get_update, loc_type, local_dir,
+                                       repo_url, repo_rev,
+                                       clear_retry=self.clear_retry,
+                                       **options))
             elif self.clean:
                 utils.clean_object_files(local_dir)
 
@@ -955,6 +1298,22 @@ class BaseRecipe(object):
             if subdir:
                 addons_dir = join(addons_dir, subdir)
 
+            if addons_dir not in self.addons_paths:
+                self.addons_paths.append(addons_dir)
+
+        # one ls-remote per distinct remote instead of one per repository
+        # (with a cache mirror, refs are resolved from the mirror anyway)
+        if (git_urls and not self.offline and
+                not self.options.get('git-cache-directory')):
+            vcs.GitRepo.preload_remote_refs(git_urls, jobs=self.vcs_jobs)
+        try:
+            self.run_vcs_tasks([(', '.join(dirs),
+                                 partial(utils.run_all, calls))
+                                for dirs, calls in tasks])
+        finally:
+            vcs.GitRepo.clear_remote_refs()
+
+        for addons_dir in self.addons_paths:
             manifest = os.path.join(addons_dir, '__manifest__.py')
             manifest_pre_v10 = os.path.join(addons_dir, '__openerp__.py')
             if os.path.isfile(manifest) or os.path.isfile(manifest_pre_v10):
@@ -964,9 +1323,6 @@ class BaseRecipe(object):
                                 "update your buildout configuration. " % (
                                     addons_dir))
 
-            if addons_dir not in self.addons_paths:
-                self.addons_paths.append(addons_dir)
-
     def revert_sources(self):
         """Revert all sources to the revisions specified in :attr:`sources`.
         """
@@ -977,26 +1333,35 @@ class BaseRecipe(object):
             vcs_type, vcs_spec, options = desc
             local_dir = self.odoo_dir if target is main_software else target
             local_dir = self.make_absolute(local_dir)
-            repo = vcs.repo(vcs_type, local_dir, vcs_spec[0], **options)
-            try:
-                repo.revert(vcs_spec[1])
-            except NotImplementedError:
-                logger.warn("vcs-revert: not implemented for %s "
-                            "repository at %s", vcs_type, local_dir)
-            else:
-                logger.info("Reverted %s repository at %s",
-                            vcs_type, local_dir)
+            with vcs.repo(vcs_type, local_dir, vcs_spec[0],
+                          **options) as repo:
+                try:
+                    repo.revert(vcs_spec[1])
+                except NotImplementedError:
+                    logger.warn("vcs-revert: not implemented for %s "
+                                "repository at %s", vcs_type, local_dir)
+                else:
+                    logger.info("Reverted %s repository at %s",
+                                vcs_type, local_dir)
 
     def retrieve_merges(self):
         """Peform all VCS merges specified in :attr:`merges`.
+
+        Merges into a given directory are done in order, but different
+        directories are handled concurrently if the ``vcs-jobs`` option is
+        greater than one.
         """
         if self.options.get('vcs-revert', '').strip().lower() == 'on-merge':
             logger.info("Reverting all sources before merge")
             self.revert_sources()
+        tasks = []
+        git_urls = set()
         for local_dir, source_specs in self.merges.items():
+            local_dir = self.make_absolute(local_dir)
+            calls = []
+            git_merges = OrderedDict()  # URL -> (options, revisions)
             for source_spec in source_specs:
                 loc_type, loc_spec, merge_options = source_spec
-                local_dir = self.make_absolute(local_dir)
                 options = dict(offline=self.offline,
                                clear_locks=self.vcs_clear_locks)
                 options.update(merge_options)
@@ -1006,70 +1371,147 @@ class BaseRecipe(object):
                         options[k] = v
 
                 repo_url, repo_rev = loc_spec
-                vcs.get_update(loc_type, local_dir, repo_url, repo_rev,
-                               clear_retry=self.clear_retry,
-                               **options)
+                calls.append(partial(vcs.get_update, loc_type, local_dir,
+                                     repo_url, repo_rev,
+                                     clear_retry=self.clear_retry,
+                                     **options))
+                if loc_type == 'git' and not self.offline:
+                    git_urls.add(repo_url)
+                    git_merges.setdefault(
+                        repo_url, (options, []))[1].append(repo_rev)
+
+            # one fetch per Git remote for all the branches to merge
+            fetches = [partial(vcs.repo('git', local_dir, url, **git_options)
+                               .fetch_merge_revisions, revisions)
+                       for url, (git_options, revisions) in git_merges.items()
+                       if len(revisions) > 1]
+            tasks.append((local_dir, partial(utils.run_all,
+                                             fetches + calls)))
+
+        # one ls-remote per distinct remote, whose result is used both
+        # by fetch_merge_revisions() and by the merges themselves
+        if git_urls:
+            vcs.GitRepo.preload_remote_refs(git_urls, jobs=self.vcs_jobs)
+        try:
+            self.run_vcs_tasks(tasks)
+        finally:
+            vcs.GitRepo.clear_remote_refs()
 
-    def main_download(self):
+    def main_download(self, conditional=False):
         """HTTP download for main part of the software to self.archive_path.
+
+        If the ``odoo-download-cache`` option is set, the archive is taken
+        from the host-wide download cache if possible, and stored in it
+        otherwise.
+
+        :param conditional: if ``True``, the archive is downloaded only if
+                            it changed on the server since last time.
+        """
+        url, options = self.sources[main_software][1:3]
+        sha256 = (options or {}).get('sha256')
+        cache = self.download_cache
+        if cache is None:
+            self.fetch_archive(url, sha256, conditional)
+            return
+
+        with cache.url_lock(url):
+            if (not os.path.exists(self.archive_path) and
+                    cache.restore(url, self.archive_path, sha256=sha256)):
+                logger.info("Got %s from the download cache", url)
+                if self.offline or self.main_http_caching != 'http-head':
+                    return
+                conditional = True
+            headers = self.fetch_archive(url, sha256, conditional)
+            if headers is not None or cache.lookup(url) is None:
+                cache.store(url, self.archive_path)
+
+    def fetch_archive(self, url, sha256, conditional):
+        """Download the main software archive (see :meth:`main_download`).
+
+        :returns: the response headers, or ``None`` if the archive has not
+                  changed (conditional downloads only).
         """
         if self.offline:
             raise IOError("%s not found, and offline "
                           "mode requested" % self.archive_path)
-        url = self.sources[main_software][1]
         logger.info("Downloading %s ..." % url)
 
+        urls = [url] + self.archive_mirrors
         try:
-            msg = urlretrieve(url, self.archive_path)
-            if get_content_type(msg[1]) == 'text/html':
+            return download.download_mirrors(
+                urls, self.archive_path, sha256=sha256,
+                conditional=conditional)
+        except LookupError:
+            raise LookupError(
+                'Wanted version %r not found on server (tried %s)' % (
+                    self.version_wanted, ', '.join(urls)))
+        except download.ChecksumError:
+            raise
+        except IOError as exc:
+            # partial HTTP downloads are kept, to be resumed next time
+            if os.path.exists(self.archive_path):
                 os.unlink(self.archive_path)
-                raise LookupError(
-                    'Wanted version %r not found on server (tried %s)' % (
-                        self.version_wanted, url))
-
-        except (tarfile.TarError, IOError):
-            # GR: ContentTooShortError subclasses IOError
-            os.unlink(self.archive_path)
-            raise IOError('The archive does not seem valid: ' +
-                          repr(self.archive_path))
-
-    def is_stale_http_head(self):
-        """Tell if the download is stale by doing a HEAD request.
-
-        Assumes the correct date had been written upon download.
-        This is the same system as in GNU Wget 1.12. It works even if
-        the server does not implement conditional responses such as 304
-        """
-        archivestat = os.stat(self.archive_path)
-        length, modified = archivestat.st_size, archivestat.st_mtime
-
-        url = self.sources[main_software][1]
-        logger.info("Checking if %s if fresh wrt %s",
-                    self.archive_path, url)
-        parsed = urlparse(url)
-        if parsed.scheme == 'https':
-            cnx_cls = httplib.HTTPSConnection
-        else:
-            cnx_cls = httplib.HTTPConnection
-        try:
-            cnx = cnx_cls(parsed.netloc)
-            cnx.request('HEAD', parsed.path)  # TODO query ? fragment ?
-            res = cnx.getresponse()
-        except IOError:
-            return True
+            raise IOError('The archive does not seem valid: %r (%s)' % (
+                self.archive_path, exc))
 
-        if res.status != 200:
-            return True
+    def main_extract(self, tar):
+        """Extract the main software from the given tar file.
 
-        if int(res.getheader('Content-Length')) != length:
-            return True
+        Set :attr:`odoo_dir` from the first member of the archive, and
+        extract incrementally into it (see :meth:`incremental_tar_extract`),
+        unless the archive is the same as for the previous extraction.
 
-        head_modified = res.getheader('Last-Modified')
-        logger.debug("Last-modified from HEAD request: %s", head_modified)
-        if rfc822_time(head_modified) > modified:
-            return True
+        :returns: the new extraction manifest, to be written once the whole
+                  archive has been checked (see
+                  :meth:`write_extract_manifest`), or ``None`` if nothing
+                  was extracted.
+        """
+        first = tar.next()
+        # Everything that follows assumes all tarball members
+        # are inside a directory with an expected name such
+        # as odoo-6.1-1
+        assert(first.isdir())
+        extracted_name = first.name.split('/')[0]
+        self.odoo_dir = join(self.parts, extracted_name)
+        # protection against malicious tarballs
+        assert(not os.path.isabs(extracted_name))
+        assert(self.odoo_dir.startswith(self.parts))
+
+        manifest_path = join(self.odoo_dir, EXTRACT_MANIFEST)
+        manifest = None
+        if not self.clean and os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                try:
+                    manifest = json.load(manifest_file)
+                except ValueError:
+                    logger.warn("Invalid %s, ignoring it", manifest_path)
+        archive_stat = os.stat(self.archive_path)
+        archive_signature = [archive_stat.st_size,
+                             int(archive_stat.st_mtime)]
+
+        if manifest is not None and (
+                manifest['archive'] == archive_signature):
+            logger.info("%s has already been extracted",
+                        self.archive_path)
+            return
 
-        logger.info("No need to re-download %s", self.archive_path)
+        if manifest is None:
+            logger.info("Cleaning existing %s", self.odoo_dir)
+            if os.path.exists(self.odoo_dir):
+                shutil.rmtree(self.odoo_dir)
+            manifest = dict(members={})
+        else:
+            # stale as soon as extraction starts, in case it fails
+            os.unlink(manifest_path)
+        logger.info(u'Extracting %s ...' % self.archive_path)
+        members = self.incremental_tar_extract(
+            extracted_name, tar, first, manifest['members'])
+        return dict(archive=archive_signature, members=members)
+
+    def write_extract_manifest(self, manifest):
+        """Record a successful extraction of the main software archive."""
+        with open(join(self.odoo_dir, EXTRACT_MANIFEST), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
 
     def retrieve_main_software(self):
         """Lookup or fetch the main software.
@@ -1086,43 +1528,34 @@ class BaseRecipe(object):
                 utils.clean_object_files(self.odoo_dir)
         elif type_spec == 'downloadable':
             # download if needed
-            if ((self.archive_path and
-                 not os.path.exists(self.archive_path)) or
-                (self.main_http_caching == 'http-head' and
-                 self.is_stale_http_head())):
+            if self.archive_path and not os.path.exists(self.archive_path):
                 self.main_download()
+            elif self.main_http_caching == 'http-head' and not self.offline:
+                self.main_download(conditional=True)
 
             logger.info(u'Inspecting %s ...' % self.archive_path)
-            tar = tarfile.open(self.archive_path)
-            first = tar.members[0]
-            # Everything that follows assumes all tarball members
-            # are inside a directory with an expected name such
-            # as odoo-6.1-1
-            assert(first.isdir())
-            extracted_name = first.name.split('/')[0]
-            self.odoo_dir = join(self.parts, extracted_name)
-            # protection against malicious tarballs
-            assert(not os.path.isabs(extracted_name))
-            assert(self.odoo_dir.startswith(self.parts))
-
-            logger.info("Cleaning existing %s", self.odoo_dir)
-            if os.path.exists(self.odoo_dir):
-                shutil.rmtree(self.odoo_dir)
-            logger.info(u'Extracting %s ...' % self.archive_path)
-            self.sandboxed_tar_extract(extracted_name, tar, first=first)
-            tar.close()
+            # stream mode: one pass, without building the members list
+            # beforehand, and with a concurrent decompression
+            with utils.open_tar_stream(self.archive_path) as tar:
+                manifest = self.main_extract(tar)
+            # only now is the decompressor's exit status known
+            if manifest is not None:
+                self.write_extract_manifest(manifest)
         else:
             url, rev = source[1]
             options = dict((k, v) for k, v in self.options.items()
                            if k.startswith(type_spec + '-'))
             if type_spec == 'git':
                 options['depth'] = options.pop('git-depth', None)
+                options['filter'] = options.pop('git-filter', None)
 
             options.update(source[2])
             if self.clean:
                 options['clean'] = True
             vcs.get_update(type_spec, self.odoo_dir, url, rev,
                            offline=self.offline,
+                           refs_cache=self.refs_cache,
+                           fingerprint=self.vcs_fingerprint,
                            clear_retry=self.clear_retry, **options)
 
     def _register_extra_paths(self):
@@ -1154,6 +1587,8 @@ class BaseRecipe(object):
         self.retrieve_main_software()
         self.retrieve_addons()
         self.retrieve_merges()
+        if self.refs_cache is not None:
+            self.refs_cache.save()
 
         self.install_recipe_requirements()
         os.chdir(self.odoo_dir)  # GR probably not needed any more
@@ -1173,6 +1608,8 @@ class BaseRecipe(object):
             raise EnvironmentError('Version of Odoo could not be detected')
         self.merge_requirements()
         self.install_requirements()
+        if self.wheelhouse_fill:
+            self.fill_wheelhouse()
 
         self._install_startup_scripts()
 
@@ -1297,35 +1734,9 @@ class BaseRecipe(object):
         if not lines:
             return ()
 
-        try:
-            import pip.req
-        except ImportError:
-            logger.error("You have vcs-extends-develop distributions "
-                         "but pip is not available. That means that "
-                         "gp.vcsdevelop is not properly installed. Did "
-                         "you ever run that buildout ?")
-            raise
-
-        if 'parse_editable' in dir(pip.req):  # pip < 6.0
-            def parse_egg_dir(req_str):
-                return pip.req.parse_editable(req_str)[0]
-        else:
-            def parse_egg_dir(req_str):
-                ireq = pip.req.InstallRequirement.from_editable(req_str)
-                # GR I'm worried because now this is also used as project
-                # name in requirement, whereas it used to just be the target
-                # directory
-                editable_options = getattr(ireq, 'editable_options', None)
-                if editable_options is not None:  # pip < 8.1.0
-                    return editable_options['egg']
-                try:
-                    return ireq.req.name  # pip >= 8.1.2
-                except AttributeError:
-                    return ireq.req.project_name  # pip >=8.1.0, < 8.1.2
-
         ret = []
         for raw in option_splitlines(lines):
-            target = parse_egg_dir(raw)
+            target = editable_project_name(raw)
             abs_path = os.path.join(base_path, target)
             ret.append((raw, target, sub_dir, abs_path))
         return tuple(ret)
@@ -1415,14 +1826,14 @@ class BaseRecipe(object):
                   specification.
         """
 
-        repo = vcs.repo(vcs_type, abspath, '')  # no need of remote URL
-
-        if not allow_local_modification and repo.uncommitted_changes():
-            self.local_modifications.append(abspath)
+        # no need of remote URL
+        with vcs.repo(vcs_type, abspath, '') as repo:
+            if not allow_local_modification and repo.uncommitted_changes():
+                self.local_modifications.append(abspath)
 
-        if revspec is not None and repo.is_local_fixed_revision(revspec):
-            return revspec
-        parents = repo.parents(pip_compatible=pip_compatible)
+            if revspec is not None and repo.is_local_fixed_revision(revspec):
+                return revspec
+            parents = repo.parents(pip_compatible=pip_compatible)
         if len(parents) > 1:
             self.local_modifications.append(abspath)
 
@@ -1556,8 +1967,9 @@ class BaseRecipe(object):
         if target_path in extracted:
             return
 
-        repo = vcs.repo(vcs_type, repo_path, '')  # no need of remote URL
-        repo.archive(target_path)
+        # no need of remote URL
+        with vcs.repo(vcs_type, repo_path, '') as repo:
+            repo.archive(target_path)
         extracted.add(target_path)
 
     def _extract_main_software(self, source_type, target_dir, extracted):
@@ -0,0 +1,713 @@
+"""Resumable and checked downloads of the main software archives."""
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from os.path import join
+try:
+    import httplib  # Python 2
+except ImportError:
+    from http import client as httplib  # Python 3
+from email import utils as email_utils
+try:
+    from urllib import urlretrieve  # Python 2
+except ImportError:
+    from urllib.request import urlretrieve  # Python 3
+try:
+    from urlparse import urlparse, urljoin  # Python 2
+except ImportError:
+    from urllib.parse import urlparse, urljoin  # Python 3
+
+from .utils import file_lock
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+PROGRESS_INTERVAL = 5  # seconds
+
+MAX_REDIRECTS = 5
+
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+TIMEOUT = 60  # seconds without receiving anything before giving up
+
+PROBE_SIZE = 64 * 1024
+
+PROBE_TIMEOUT = 10  # seconds
+
+DEFAULT_CACHE_SIZE = '5G'
+
+SIZE_UNITS = dict(K=1024, M=1024 ** 2, G=1024 ** 3, T=1024 ** 4)
+
+
+def get_content_type(msg):
+    """Return the mimetype of the HTTP message.
+    This is a helper to support Python 2 and 3.
+    """
+    try:
+        return msg.type
+    except AttributeError:
+        return msg.get_content_type()
+
+
+def http_date(timestamp):
+    """Format a timestamp for HTTP headers.
+
+    >>> http_date(0)
+    'Thu, 01 Jan 1970 00:00:00 GMT'
+    """
+    return email_utils.formatdate(timestamp, usegmt=True)
+
+
+def parse_http_date(value):
+    """Return the timestamp of a HTTP header date, or ``None``.
+
+    >>> parse_http_date('Thu, 01 Jan 1970 00:01:00 GMT')
+    60
+    >>> parse_http_date('garbage') is None
+    True
+    """
+    parsed = email_utils.parsedate_tz(value or '')
+    if parsed is None:
+        return None
+    return email_utils.mktime_tz(parsed)
+
+
+def format_size(size):
+    """Human readable size.
+
+    >>> format_size(123)
+    '123 B'
+    >>> format_size(3 * 1024 * 1024 + 1)
+    '3.0 MiB'
+    """
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return ('%d %s' if unit == 'B' else '%.1f %s') % (size, unit)
+        size /= 1024.0
+    return '%.1f GiB' % size
+
+
+def parse_size(value):
+    """Parse a size in bytes, with an optional binary unit.
+
+    >>> parse_size('1024')
+    1024
+    >>> parse_size(' 5G ')
+    5368709120
+    >>> parse_size('512m')
+    536870912
+    >>> parse_size('big')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid size: 'big'
+    """
+    stripped = value.strip().upper()
+    factor = SIZE_UNITS.get(stripped[-1:], 1)
+    if factor != 1:
+        stripped = stripped[:-1]
+    if not stripped.isdigit():
+        raise ValueError("Invalid size: %r" % value)
+    return int(stripped) * factor
+
+
+class ChecksumError(IOError):
+    """Raised if the downloaded data doesn't have the expected checksum."""
+
+
+class Progress(object):
+    """Log progress and throughput of a download, at regular intervals."""
+
+    def __init__(self, url, total, start=0):
+        self.url = url
+        self.total = total
+        self.start = start
+        self.done = start
+        self.start_time = self.last_log = time.time()
+
+    def throughput(self):
+        elapsed = time.time() - self.start_time
+        if not elapsed:
+            return ''
+        return ', %s/s' % format_size((self.done - self.start) / elapsed)
+
+    def update(self, size):
+        self.done += size
+        now = time.time()
+        if now - self.last_log < PROGRESS_INTERVAL:
+            return
+        self.last_log = now
+        if self.total:
+            logger.info("Downloading %s: %d%% (%s of %s%s)", self.url,
+                        100 * self.done // self.total,
+                        format_size(self.done), format_size(self.total),
+                        self.throughput())
+        else:
+            logger.info("Downloading %s: %s%s", self.url,
+                        format_size(self.done), self.throughput())
+
+    def finish(self):
+        logger.info("Downloaded %s (%s%s)", self.url,
+                    format_size(self.done), self.throughput())
+
+
+def http_connection(parsed, timeout=TIMEOUT):
+    if parsed.scheme == 'https':
+        return httplib.HTTPSConnection(parsed.netloc, timeout=timeout)
+    return httplib.HTTPConnection(parsed.netloc, timeout=timeout)
+
+
+class Connections(object):
+    """Keep-alive HTTP connections, by scheme and host.
+
+    A connection can be reused once the previous response has been fully
+    read. Otherwise, it has to be discarded.
+    """
+
+    def __init__(self, timeout=TIMEOUT):
+        self.connections = {}
+        self.timeout = timeout
+
+    def get(self, parsed):
+        key = parsed.scheme, parsed.netloc
+        cnx = self.connections.get(key)
+        if cnx is None:
+            cnx = self.connections[key] = http_connection(
+                parsed, timeout=self.timeout)
+        return cnx
+
+    def discard(self, parsed):
+        cnx = self.connections.pop((parsed.scheme, parsed.netloc), None)
+        if cnx is not None:
+            cnx.close()
+
+    def close(self):
+        for cnx in self.connections.values():
+            cnx.close()
+        self.connections.clear()
+
+
+def http_get(url, headers, connections):
+    """Perform a GET request, following redirections.
+
+    :param connections: a :class:`Connections` instance.
+    :returns: the final URL and the response (to be read and closed).
+    """
+    for _ in range(MAX_REDIRECTS + 1):
+        parsed = urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        for attempt in range(2):
+            cnx = connections.get(parsed)
+            try:
+                cnx.request('GET', path, headers=headers)
+                res = cnx.getresponse()
+                break
+            except (IOError, httplib.HTTPException):
+                # the server may have closed a kept alive connection
+                connections.discard(parsed)
+                if attempt:
+                    raise
+        if res.status not in REDIRECT_STATUSES:
+            return url, res
+        location = res.getheader('Location')
+        res.read()
+        res.close()
+        if not location:
+            raise IOError("Redirection without location from %s" % url)
+        url = urljoin(url, location)
+    raise IOError("Too many redirections for %s" % url)
+
+
+def validators_path(path):
+    """Where to store the HTTP validators (ETag etc.) of a downloaded file.
+    """
+    return path + '.validators.json'
+
+
+def read_validators(url, path):
+    """Return conditional request headers for a previous download of url.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(validators_path(path)) as f:
+            validators = json.load(f)
+    except (IOError, ValueError):
+        validators = {}
+    if validators.get('url') != url:
+        # older download, or from another URL: the file date is
+        # the best we have
+        return {'If-Modified-Since': http_date(os.path.getmtime(path))}
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    return headers
+
+
+def validators_url(path):
+    """Return the URL path was downloaded from, according to its validators.
+
+    :returns: ``None`` if unknown.
+    """
+    try:
+        with open(validators_path(path)) as f:
+            return json.load(f).get('url')
+    except (IOError, ValueError, AttributeError):
+        return None
+
+
+def write_validators(url, path, res):
+    validators = dict(url=url, etag=res.getheader('ETag'),
+                      last_modified=res.getheader('Last-Modified'))
+    with open(validators_path(path), 'w') as f:
+        json.dump(validators, f)
+
+
+def download(url, path, sha256=None, conditional=False, retries=2):
+    """Download url to path.
+
+    HTTP(S) transfers are streamed into ``path + '.part'``, which is kept
+    if they fail. They are then resumed with a ``Range`` request,
+    provided the server tells it has the same version of the file
+    (``If-Range`` header). Other URL schemes are simply retrieved in one go.
+
+    The validators of HTTP responses (``ETag`` and ``Last-Modified``
+    headers) are stored along the file (see :func:`validators_path`).
+
+    :param sha256: if not ``None``, the expected hexadecimal SHA-256 digest
+                   of the file, computed while downloading.
+    :param conditional: if ``True`` and path exists, the validators are
+                        used to download only if the file has changed.
+    :param retries: how many times an interrupted HTTP transfer is resumed.
+    :returns: the response headers, or ``None`` if path is up to date
+              (conditional requests only).
+    :raises: :class:`LookupError` if the server answers with a HTML page,
+             which usually means that the wanted file doesn't exist,
+             :class:`ChecksumError` (a subclass of :class:`IOError`) if the
+             digest isn't the expected one, and :class:`IOError` for
+             other errors.
+    """
+    if urlparse(url).scheme not in ('http', 'https'):
+        # path may be a hardlink to a cache object: never write into it
+        tmp_path = path + '.tmp'
+        try:
+            headers = urlretrieve(url, tmp_path)[1]
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        if get_content_type(headers) == 'text/html':
+            os.unlink(tmp_path)
+            raise LookupError("Got a HTML page for %s" % url)
+        if sha256 is not None:
+            check_file_sha256(tmp_path, sha256)
+        os.rename(tmp_path, path)
+        return headers
+
+    headers = read_validators(url, path) if conditional else {}
+    part_path = path + '.part'
+    connections = Connections()
+    try:
+        while True:
+            try:
+                res = _download_part(url, part_path, sha256, headers,
+                                     connections)
+                break
+            except _RangeNotSatisfiable:
+                logger.info("Partial download %s is stale, starting over",
+                            part_path)
+                os.unlink(part_path)
+            except (ChecksumError, _HTTPStatusError):
+                raise
+            except (IOError, httplib.HTTPException) as exc:
+                if not retries:
+                    raise
+                retries -= 1
+                logger.warn("Download of %s failed (%s), retrying",
+                            url, exc)
+    except httplib.HTTPException as exc:
+        raise IOError("HTTP error while downloading %s: %r" % (url, exc))
+    finally:
+        connections.close()
+
+    if res.status == 304:
+        logger.info("%s has not changed since last download", url)
+        return None
+    os.rename(part_path, path)
+    write_validators(url, path, res)
+    # same as what urlretrieve did if there's no Last-Modified header
+    modified = parse_http_date(res.getheader('Last-Modified'))
+    os.utime(path, None if modified is None else (modified, modified))
+    return res.msg
+
+
+def probe_mirror(url):
+    """Measure how long it takes to get the first bytes of url.
+
+    A ``Range`` request is used, but servers ignoring it are fine, since
+    only :data:`PROBE_SIZE` bytes are read anyway.
+
+    :returns: the elapsed time in seconds, or ``None`` if the mirror
+              doesn't answer properly.
+    """
+    connections = Connections(timeout=PROBE_TIMEOUT)
+    start = time.time()
+    try:
+        final_url, res = http_get(
+            url, {'Range': 'bytes=0-%d' % (PROBE_SIZE - 1)}, connections)
+        try:
+            if (res.status not in (200, 206) or
+                    get_content_type(res.msg) == 'text/html'):
+                logger.warn("Mirror %s answered with status %d %s (%s)", url,
+                            res.status, res.reason, get_content_type(res.msg))
+                return None
+            received = 0
+            while received < PROBE_SIZE:
+                chunk = res.read(min(CHUNK_SIZE, PROBE_SIZE - received))
+                if not chunk:
+                    break
+                received += len(chunk)
+        finally:
+            res.close()
+    except (IOError, httplib.HTTPException) as exc:
+        logger.warn("Mirror %s is not reachable (%s)", url, exc)
+        return None
+    finally:
+        connections.close()
+    return time.time() - start
+
+
+def rank_mirrors(urls):
+    """Sort the URLs of the same file, fastest mirror first.
+
+    HTTP(S) mirrors are probed concurrently (see :func:`probe_mirror`).
+    Those that failed come last, and URLs with other schemes first,
+    keeping the original order among them.
+    """
+    http_urls = [url for url in urls
+                 if urlparse(url).scheme in ('http', 'https')]
+    timings = {}
+
+    def probe(url):
+        timings[url] = probe_mirror(url)
+
+    threads = [threading.Thread(target=probe, args=(url, ))
+               for url in http_urls]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    def key(url):
+        timing = timings.get(url, 0)
+        return (timing is None, timing)
+    ranked = sorted(urls, key=key)
+    logger.info("Download mirrors, fastest first: %s", ', '.join(
+        '%s (%s)' % (url, 'failed' if timings.get(url, 0) is None
+                     else '%.2fs' % timings.get(url, 0))
+        for url in ranked))
+    return ranked
+
+
+def download_mirrors(urls, path, **kwargs):
+    """Download one of the urls to path, from the fastest mirror.
+
+    The mirrors are tried in turn (see :func:`rank_mirrors`), until
+    one of them works. With only one URL, this is the same as
+    :func:`download`, which gets all keyword arguments.
+
+    For conditional downloads, the mirror of the previous download is
+    tried first without probing, since its validators can spare the
+    whole transfer.
+
+    :raises: the error of the last mirror if none of them worked.
+    """
+    if len(urls) == 1:
+        return download(urls[0], path, **kwargs)
+    if kwargs.get('conditional') and os.path.exists(path):
+        previous = validators_url(path)
+        if previous in urls:
+            try:
+                return download(previous, path, **kwargs)
+            except (IOError, LookupError) as exc:
+                logger.warn("Download from %s failed (%s), trying other "
+                            "mirrors", previous, exc)
+            urls = [url for url in urls if url != previous]
+            if len(urls) == 1:
+                return download(urls[0], path, **kwargs)
+    ranked = rank_mirrors(urls)
+    for i, url in enumerate(ranked):
+        try:
+            return download(url, path, **kwargs)
+        except (IOError, LookupError) as exc:
+            if i == len(ranked) - 1:
+                raise
+            logger.warn("Download from %s failed (%s), trying next mirror",
+                        url, exc)
+
+
+class _RangeNotSatisfiable(Exception):
+    pass
+
+
+class _HTTPStatusError(IOError):
+    pass
+
+
+def _download_part(url, part_path, sha256, headers, connections):
+    """Download or resume downloading url into part_path.
+
+    :param headers: additional request headers.
+    """
+    headers = dict(headers)
+    hasher = hashlib.sha256()
+    offset = 0
+    if os.path.exists(part_path):
+        # the mtime of the partial file is the Last-Modified date of its
+        # source, or zero if unknown: then we can't tell if it's the same
+        # file, and don't resume
+        part_mtime = os.path.getmtime(part_path)
+        offset = os.path.getsize(part_path)
+        if offset and part_mtime:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = http_date(part_mtime)
+
+    final_url, res = http_get(url, headers, connections)
+    complete = False
+    try:
+        if res.status not in (200, 206):
+            res.read()
+            complete = True
+            if res.status == 304:
+                return res
+            if res.status == 416:
+                raise _RangeNotSatisfiable()
+            raise _HTTPStatusError("Got HTTP status %d %s for %s" % (
+                res.status, res.reason, final_url))
+        if get_content_type(res.msg) == 'text/html':
+            raise LookupError("Got a HTML page for %s" % final_url)
+
+        if res.status == 206:
+            content_range = res.getheader('Content-Range', '')
+            if not content_range.startswith('bytes %d-' % offset):
+                raise IOError("Unexpected range %r in response for %s" % (
+                    content_range, final_url))
+            logger.info("Resuming download of %s at %s", final_url,
+                        format_size(offset))
+            mode = 'ab'
+            if sha256 is not None:
+                with open(part_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                        hasher.update(chunk)
+        else:
+            offset = 0
+            mode = 'wb'
+
+        length = res.getheader('Content-Length')
+        length = int(length) if length is not None else None
+        modified = parse_http_date(res.getheader('Last-Modified'))
+
+        progress = Progress(final_url,
+                            length and length + offset, start=offset)
+        received = 0
+        try:
+            with open(part_path, mode) as f:
+                for chunk in iter(lambda: res.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    received += len(chunk)
+                    progress.update(len(chunk))
+        finally:
+            # marking with the source date, so that resuming is possible
+            os.utime(part_path, (modified or 0, modified or 0))
+        if length is not None and received != length:
+            raise IOError("Download of %s interrupted after %s of %s" % (
+                final_url, format_size(received + offset),
+                format_size(length + offset)))
+        complete = True
+        progress.finish()
+    finally:
+        res.close()
+        if not complete:
+            connections.discard(urlparse(final_url))
+
+    if sha256 is not None and hasher.hexdigest() != sha256.lower():
+        os.unlink(part_path)
+        raise ChecksumError("SHA-256 checksum mismatch for %s: expected %s, "
+                            "got %s" % (final_url, sha256, hasher.hexdigest()))
+    return res
+
+
+def file_sha256(path):
+    """Return the hexadecimal SHA-256 digest of the file."""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def check_file_sha256(path, sha256):
+    """Raise :class:`ChecksumError` if the file does not have that digest."""
+    digest = file_sha256(path)
+    if digest != sha256.lower():
+        os.unlink(path)
+        raise ChecksumError("SHA-256 checksum mismatch for %s: expected %s, "
+                            "got %s" % (path, sha256, digest))
+
+
+def link_or_copy(src, dst):
+    """Atomically make dst a hardlink to src, or a copy of it.
+
+    Copying is the fallback if src and dst are not on the same filesystem.
+    """
+    tmp = dst + '.tmp'
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except (OSError, AttributeError):
+        shutil.copy2(src, tmp)
+    os.rename(tmp, dst)
+
+
+class DownloadCache(object):
+    """A host-wide cache of downloaded files, shared among buildouts.
+
+    Files are stored once, named after their SHA-256 digest, in the
+    ``objects`` subdirectory. The ``urls`` subdirectory indexes the URLs
+    they have been downloaded from, along with their HTTP validators.
+    Files are hardlinked from the cache into the buildouts if possible.
+
+    All writes are atomic (by renaming). Buildouts downloading the same URL
+    concurrently are serialized by a lock file per URL
+    (see :meth:`url_lock`), and modifications of the objects are serialized
+    by a global lock file.
+
+    The cache is kept within ``max_size`` bytes by evicting the least
+    recently used files. Their access time is explicitly set on each use,
+    so that this works even on filesystems mounted with ``noatime``, and
+    without changing their modification time.
+    """
+
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.objects_dir = join(directory, 'objects')
+        self.urls_dir = join(directory, 'urls')
+        for d in (self.objects_dir, self.urls_dir):
+            try:
+                os.makedirs(d)
+            except OSError:
+                if not os.path.isdir(d):
+                    raise
+
+    def object_path(self, sha256):
+        return join(self.objects_dir, sha256.lower())
+
+    def index_path(self, url):
+        return join(self.urls_dir,
+                    hashlib.sha1(url.encode('utf-8')).hexdigest() + '.json')
+
+    def url_lock(self, url):
+        """Lock for the whole retrieval (download included) of url."""
+        return file_lock(self.index_path(url)[:-5] + '.lock')
+
+    def lookup(self, url):
+        """Return the index entry of url, if its file is still in the cache.
+        """
+        try:
+            with open(self.index_path(url)) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        if entry.get('url') != url or not os.path.exists(
+                self.object_path(entry['sha256'])):
+            return None
+        return entry
+
+    def touch(self, obj_path):
+        """Mark the file as recently used, keeping its modification time."""
+        os.utime(obj_path, (time.time(), os.path.getmtime(obj_path)))
+
+    def restore(self, url, path, sha256=None):
+        """Put the cached file for url (or for the sha256 digest) at path.
+
+        The HTTP validators are restored as well, so that a subsequent
+        conditional download of url to path works as expected.
+
+        :returns: ``True`` if the file has been found in the cache.
+        """
+        entry = self.lookup(url)
+        if sha256 is not None:
+            if entry is None or entry['sha256'] != sha256.lower():
+                # content addressing: another URL may have provided it
+                entry = dict(sha256=sha256.lower())
+            if not os.path.exists(self.object_path(sha256)):
+                return False
+        elif entry is None:
+            return False
+
+        obj_path = self.object_path(entry['sha256'])
+        link_or_copy(obj_path, path)
+        self.touch(obj_path)
+        validators = entry.get('validators')
+        if validators:
+            with open(validators_path(path), 'w') as f:
+                json.dump(validators, f)
+        return True
+
+    def store(self, url, path):
+        """Add the file at path, downloaded from url, to the cache."""
+        sha256 = file_sha256(path)
+        obj_path = self.object_path(sha256)
+        try:
+            with open(validators_path(path)) as f:
+                validators = json.load(f)
+        except (IOError, ValueError):
+            validators = None
+        index_path = self.index_path(url)
+        with file_lock(join(self.directory, 'cache.lock')):
+            if not os.path.exists(obj_path):
+                link_or_copy(path, obj_path)
+            self.touch(obj_path)
+            with open(index_path + '.tmp', 'w') as f:
+                json.dump(dict(url=url, sha256=sha256, validators=validators),
+                          f)
+            os.rename(index_path + '.tmp', index_path)
+            self.evict(keep=obj_path)
+
+    def evict(self, keep=None):
+        """Remove the least recently used files beyond :attr:`max_size`.
+
+        Buildouts having a hardlink to an evicted file are not affected.
+        Must be called with the global lock held.
+
+        :param keep: path of a file that must not be evicted.
+        """
+        if self.max_size is None:
+            return
+        objects = []
+        for name in os.listdir(self.objects_dir):
+            obj_path = join(self.objects_dir, name)
+            st = os.stat(obj_path)
+            objects.append((st.st_atime, st.st_size, obj_path))
+        total = sum(obj[1] for obj in objects)
+        for _, size, obj_path in sorted(objects):
+            if total <= self.max_size:
+                break
+            if obj_path == keep:
+                continue
+            logger.info("Evicting %s (%s) from download cache", obj_path,
+                        format_size(size))
+            os.unlink(obj_path)
+            total -= size
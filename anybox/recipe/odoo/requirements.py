@@ -0,0 +1,123 @@
+"""Static parsing of pip requirements files, without importing pip.
+
+Only the subset of the format that is relevant for Odoo's
+``requirements.txt`` is supported: requirement specifiers with versions
+and environment markers, comments, line continuations, nested requirement
+files (``-r``) and editable requirements (``-e``). Other options are
+ignored.
+"""
+import os
+import re
+import logging
+import pkg_resources
+from zc.buildout import UserError
+
+logger = logging.getLogger(__name__)
+
+COMMENT_RE = re.compile(r'(^|\s+)#.*$')
+
+OPTION_RE = re.compile(r'^(--?[a-zA-Z][-\w]*)(?:[ =]\s*(.*))?$')
+
+REQUIREMENT_OPTION_RE = re.compile(r'\s+--?[a-zA-Z][-\w]*([ =]|$)')
+
+EGG_FRAGMENT_RE = re.compile(r'[#&]egg=([^&]+)')
+
+
+def logical_lines(lines):
+    """Join continued lines and strip comments and blank lines.
+
+    >>> list(logical_lines(['a==1  # pinned', 'b>=2,\\\\', '<3', '', '#']))
+    [(1, 'a==1'), (2, 'b>=2,<3')]
+    """
+    buf = []
+    start = None
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip('\r\n')
+        if not buf:
+            start = lineno
+        if line.endswith('\\'):
+            buf.append(line[:-1])
+            continue
+        buf.append(line)
+        joined = COMMENT_RE.sub('', ''.join(buf)).strip()
+        buf = []
+        if joined:
+            yield start, joined
+    if buf:
+        joined = COMMENT_RE.sub('', ''.join(buf)).strip()
+        if joined:
+            yield start, joined
+
+
+def editable_project_name(spec):
+    """Return the project name of an editable requirement.
+
+    It is read from the ``egg`` URL fragment, as pip does.
+
+    >>> editable_project_name('git+https://example.com/p.git@2.0#egg=p')
+    'p'
+    >>> editable_project_name('hg+http://h.example/p#egg=p[x]&subdirectory=s')
+    'p'
+    >>> editable_project_name('git+https://example.com/p.git')
+    ... # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    UserError: Editable requirement ... has no #egg=<project> fragment
+    """
+    match = EGG_FRAGMENT_RE.search(spec)
+    if match is None:
+        raise UserError("Editable requirement %r has no "
+                        "#egg=<project> fragment" % spec)
+    return match.group(1).split('[')[0].strip()
+
+
+def parse_requirements(path, _seen=None):
+    """Iterate over the requirements listed in a requirements file.
+
+    Nested requirement files are read recursively, relative to the
+    including file. Editable requirements are yielded as requirements on
+    their project name, without version. Other options (indexes, hashes,
+    constraints files...) are ignored.
+
+    :returns: an iterator over :class:`pkg_resources.Requirement` instances.
+              Environment markers are not evaluated.
+    :raises: :class:`UserError` if a line can't be parsed
+    """
+    path = os.path.abspath(path)
+    if _seen is None:
+        _seen = set()
+    if path in _seen:
+        logger.warn("Requirements file %s included twice, ignoring", path)
+        return
+    _seen.add(path)
+
+    with open(path) as req_file:
+        lines = list(logical_lines(req_file))
+
+    for lineno, line in lines:
+        option = OPTION_RE.match(line) if line.startswith('-') else None
+        if option is not None:
+            name, value = option.groups()
+            if name in ('-r', '--requirement') and value:
+                if '://' in value:
+                    raise UserError(
+                        "%s, line %d: remote requirements files are not "
+                        "supported (%r)" % (path, lineno, value))
+                for req in parse_requirements(
+                        os.path.join(os.path.dirname(path), value),
+                        _seen=_seen):
+                    yield req
+            elif name in ('-e', '--editable') and value:
+                yield pkg_resources.Requirement.parse(
+                    editable_project_name(value))
+            else:
+                logger.debug("%s, line %d: ignoring option %r",
+                             path, lineno, line)
+            continue
+
+        # per-requirement options, such as --hash
+        line = REQUIREMENT_OPTION_RE.split(line, 1)[0]
+        try:
+            yield pkg_resources.Requirement.parse(line)
+        except ValueError as exc:
+            raise UserError("%s, line %d: could not parse requirement "
+                            "%r (%s)" % (path, lineno, line, exc))
@@ -9,7 +9,6 @@ from tempfile import mkdtemp
 from UserDict import UserDict
 
 from zc.buildout.easy_install import Installer
-from pip.vcs import vcs as pip_vcs
 
 from . import vcs
 from .base import BaseRecipe
@@ -46,8 +45,6 @@ class FakeRepo(vcs.base.BaseRepo):
 
     revision = 'fakerev'
 
-    name = 'fakevcs'  # for pip.vcs.VersionSupport registration
-
     def get_update(self, revision):
         self.revision = revision
         if not os.path.isdir(self.target_dir):
@@ -81,8 +78,6 @@ class FakeRepo(vcs.base.BaseRepo):
 
 vcs.SUPPORTED['fakevcs'] = FakeRepo
 
-pip_vcs.register(FakeRepo)  # for tests around gp.vcsdevelop
-
 
 def get_vcs_log():
     return FakeRepo.log
@@ -142,6 +137,7 @@ class RecipeTestCase(unittest.TestCase):
             'allow-hosts': '',
             'eggs-directory': eggs_dir,
             'develop-eggs-directory': develop_dir,
+            'installed': os.path.join(b_dir, '.installed.cfg'),
             'python': 'main_python',
         }
 
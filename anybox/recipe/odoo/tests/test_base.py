@@ -1,13 +1,19 @@
 import os
-import sys
+import shutil
+import tarfile
+from contextlib import contextmanager
 from copy import deepcopy
+import pkg_resources
 
 from zc.buildout import UserError
 from ..server import BaseRecipe
 from ..base import main_software
 from ..base import WITH_ODOO_REQUIREMENTS_FILE_OPTION
+from ..base import EXTRACT_MANIFEST
+from .. import utils
 from ..testing import RecipeTestCase
 from ..testing import get_vcs_log
+from ..utils import working_directory_keeper
 
 TEST_DIR = os.path.dirname(__file__)
 
@@ -64,6 +70,22 @@ class TestBaseRecipe(RecipeTestCase):
         self.assertDownloadUrl(url)
         self.assertEquals(recipe.archive_filename, 'odoo-12.0.tgz')
 
+    def test_version_url_sha256(self):
+        url = 'http://download.example/future/odoo-12.0.tgz'
+        self.make_recipe(version='url %s sha256=abc123' % url)
+        self.assertDownloadUrl(url)
+        self.assertEqual(self.recipe.sources[main_software][2],
+                         dict(sha256='abc123'))
+
+        self.assertRaises(UserError, self.make_recipe,
+                          version='url %s md5=abc123' % url)
+
+    def test_version_nightly_sha256(self):
+        self.make_recipe(version='nightly 10.0rc1c 20161001 sha256=abc')
+        self.assertEqual(self.recipe.version_wanted, '20161001')
+        self.assertEqual(self.recipe.sources[main_software][2],
+                         dict(sha256='abc'))
+
     def test_base_url(self):
         self.make_recipe(version='10.0-1',
                          base_url='http://example.org/odoo')
@@ -75,6 +97,14 @@ class TestBaseRecipe(RecipeTestCase):
         self.assertDownloadUrl(
             'http://example.org/odoo/10-0-nightly-latest.tbz')
 
+    def test_base_url_mirrors(self):
+        self.make_recipe(version='10.0-1',
+                         base_url='http://example.org/odoo\n'
+                         '  http://mirror.example/odoo/')
+        self.assertDownloadUrl('http://example.org/odoo/blob-10.0-1.tgz')
+        self.assertEqual(self.recipe.archive_mirrors,
+                         ['http://mirror.example/odoo/blob-10.0-1.tgz'])
+
     def test_buildout_cfg_name(self):
         self.make_recipe(version='10.0-1')
         bcn = self.recipe.buildout_cfg_name
@@ -175,6 +205,191 @@ class TestBaseRecipe(RecipeTestCase):
             self.assertEquals(os.path.exists(os.path.join(b_dir, *path)),
                               expected)
 
+    def test_retrieve_main_software_archive(self):
+        url = 'http://download.example/future/odoo-12.0.tgz'
+        self.make_recipe(version='url ' + url)
+        recipe = self.recipe
+        src = os.path.join(recipe.buildout_dir, 'src')
+        for path in (('odoo-12.0', 'addons'), ('evil', )):
+            os.makedirs(os.path.join(src, *path))
+        for path in (('odoo-12.0', 'setup.py'), ('evil', 'x')):
+            with open(os.path.join(src, *path), 'w') as f:
+                f.write("content")
+        with tarfile.open(recipe.archive_path, 'w:gz') as tar:
+            tar.add(os.path.join(src, 'odoo-12.0'), arcname='odoo-12.0')
+            tar.add(os.path.join(src, 'evil'), arcname='evil')
+        os.makedirs(recipe.parts)
+        with working_directory_keeper:
+            os.chdir(recipe.parts)
+            recipe.retrieve_main_software()
+
+        self.assertEqual(recipe.odoo_dir,
+                         os.path.join(recipe.parts, 'odoo-12.0'))
+        self.assertTrue(os.path.isfile(os.path.join(recipe.odoo_dir,
+                                                    'setup.py')))
+        self.assertTrue(os.path.isdir(os.path.join(recipe.odoo_dir,
+                                                   'addons')))
+        self.assertFalse(os.path.exists(os.path.join(recipe.parts, 'evil')))
+
+    def test_main_download_cache(self):
+        url = 'http://download.example/future/odoo-12.0.tgz'
+        self.buildout['buildout']['odoo-download-cache'] = 'cache'
+        self.buildout['buildout']['offline'] = 'true'
+        self.make_recipe(version='url ' + url)
+        recipe = self.recipe
+        self.assertEqual(recipe.download_cache.directory,
+                         self.path_from_buildout('cache'))
+        with open(recipe.archive_path, 'wb') as f:
+            f.write(b'cached archive')
+        recipe.download_cache.store(url, recipe.archive_path)
+        os.unlink(recipe.archive_path)
+
+        # offline mode is not a problem for cached archives
+        recipe.main_download()
+        with open(recipe.archive_path, 'rb') as f:
+            self.assertEqual(f.read(), b'cached archive')
+
+        os.unlink(recipe.archive_path)
+        recipe.sources[main_software] = ('downloadable', url + '.new', None)
+        self.assertRaises(IOError, recipe.main_download)
+
+    def test_shared_directories_home(self):
+        home = os.path.join(self.buildout_dir, 'home')
+        orig_home = os.environ.get('HOME')
+        os.environ['HOME'] = home
+        self.buildout['buildout']['odoo-download-cache'] = '~/.cache/dl'
+        try:
+            self.make_recipe(version='local server-dir',
+                             wheelhouse='wheels',
+                             **{'git-cache-directory': '~/.cache/git',
+                                'bzr-shared-repo': '~/.cache/bzr'})
+        finally:
+            if orig_home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = orig_home
+        options = self.recipe.options
+        self.assertEqual(options['git-cache-directory'],
+                         os.path.join(home, '.cache', 'git'))
+        self.assertEqual(options['bzr-shared-repo'],
+                         os.path.join(home, '.cache', 'bzr'))
+        self.assertEqual(options['wheelhouse'],
+                         self.path_from_buildout('wheels'))
+        self.assertEqual(self.recipe.download_cache.directory,
+                         os.path.join(home, '.cache', 'dl'))
+
+    def test_download_cache_size(self):
+        self.buildout['buildout']['odoo-download-cache'] = 'cache'
+        self.buildout['buildout']['odoo-download-cache-size'] = '1X'
+        self.assertRaises(UserError, self.make_recipe,
+                          version='url http://download.example/odoo.tgz')
+
+    def test_wheelhouse(self):
+        self.buildout['buildout']['find-links'] = 'http://links.example'
+        self.make_recipe(version='local server-dir', wheelhouse='wheels',
+                         **{'wheelhouse-fill': 'true'})
+        recipe = self.recipe
+        wheelhouse = self.path_from_buildout('wheels')
+        self.assertEqual(recipe.options['find-links'].split(),
+                         [wheelhouse, 'http://links.example'])
+
+        egg = os.path.join(recipe.b_options['eggs-directory'],
+                           'Prebuilt-1.0-py2.7.egg')
+        os.makedirs(os.path.join(egg, 'EGG-INFO'))
+        os.makedirs(os.path.join(egg, 'prebuilt'))
+        with open(os.path.join(egg, 'EGG-INFO', 'PKG-INFO'), 'w') as f:
+            f.write("Metadata-Version: 1.0\nName: Prebuilt\nVersion: 1.0\n")
+        with open(os.path.join(egg, 'prebuilt', '__init__.py'), 'w') as f:
+            f.write("")
+        recipe.ws = pkg_resources.WorkingSet([])
+        recipe.ws.add(next(pkg_resources.find_distributions(egg)))
+        recipe.fill_wheelhouse()
+
+        zipped = os.path.join(wheelhouse, 'Prebuilt-1.0-py2.7.egg')
+        dist = next(pkg_resources.find_distributions(zipped))
+        self.assertEqual((dist.project_name, dist.version),
+                         ('Prebuilt', '1.0'))
+        self.assertTrue(dist.has_metadata('PKG-INFO'))
+
+    def make_archive(self, files):
+        """Make the main software archive, with given files contents."""
+        src = os.path.join(self.recipe.buildout_dir, 'src')
+        if os.path.exists(src):
+            shutil.rmtree(src)
+        for path, content in files.items():
+            path = os.path.join(src, 'odoo-12.0', path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(content)
+        with tarfile.open(self.recipe.archive_path, 'w:gz') as tar:
+            tar.add(os.path.join(src, 'odoo-12.0'), arcname='odoo-12.0')
+
+    def test_retrieve_main_software_incremental(self):
+        self.make_recipe(version='url http://download.example/odoo-12.0.tgz')
+        recipe = self.recipe
+        os.makedirs(recipe.parts)
+        self.make_archive({'setup.py': 'v1', 'odoo/mod.py': 'mod',
+                           'odoo/other.py': 'other'})
+        with working_directory_keeper:
+            os.chdir(recipe.parts)
+            recipe.retrieve_main_software()
+
+        odoo_dir = recipe.odoo_dir
+
+        def odoo_path(*path):
+            return os.path.join(odoo_dir, *path)
+
+        for fname in ('mod.pyc', 'other.pyc'):
+            with open(odoo_path('odoo', fname), 'w') as f:
+                f.write('compiled')
+        with working_directory_keeper:
+            os.chdir(recipe.parts)
+            recipe.retrieve_main_software()  # unchanged archive
+        self.assertTrue(os.path.exists(odoo_path('odoo', 'mod.pyc')))
+
+        self.make_archive({'setup.py': 'v2, longer', 'odoo/other.py': 'other'})
+        os.utime(recipe.archive_path, (0, 0))
+        with working_directory_keeper:
+            os.chdir(recipe.parts)
+            recipe.retrieve_main_software()
+        with open(odoo_path('setup.py')) as f:
+            self.assertEqual(f.read(), 'v2, longer')
+        self.assertFalse(os.path.exists(odoo_path('odoo', 'mod.py')))
+        self.assertFalse(os.path.exists(odoo_path('odoo', 'mod.pyc')))
+        self.assertTrue(os.path.exists(odoo_path('odoo', 'other.pyc')))
+
+    def test_retrieve_main_software_decompression_error(self):
+        self.make_recipe(version='url http://download.example/odoo-12.0.tgz')
+        recipe = self.recipe
+        os.makedirs(recipe.parts)
+        self.make_archive({'setup.py': 'v1'})
+        with working_directory_keeper:
+            os.chdir(recipe.parts)
+            recipe.retrieve_main_software()
+        manifest_path = os.path.join(recipe.odoo_dir, EXTRACT_MANIFEST)
+        self.assertTrue(os.path.exists(manifest_path))
+
+        orig_open_tar_stream = utils.open_tar_stream
+
+        @contextmanager
+        def failing_open_tar_stream(path):
+            with orig_open_tar_stream(path) as tar:
+                yield tar
+            raise IOError("Decompression of %s failed" % path)
+
+        self.make_archive({'setup.py': 'v2'})
+        os.utime(recipe.archive_path, (0, 0))
+        utils.open_tar_stream = failing_open_tar_stream
+        try:
+            with working_directory_keeper:
+                os.chdir(recipe.parts)
+                self.assertRaises(IOError, recipe.retrieve_main_software)
+        finally:
+            utils.open_tar_stream = orig_open_tar_stream
+        # next run must not take the archive as already extracted
+        self.assertFalse(os.path.exists(manifest_path))
+
     def test_clean_vcs_server(self):
         """Test clean for base class vcs server."""
         self.make_recipe(
@@ -312,7 +527,6 @@ class TestBaseRecipe(RecipeTestCase):
         :param dict pre_versions: if supplied, will be set before calling the
                                   recipe's code
         """
-        import pip as pip_original
         from zc.buildout.easy_install import Installer
         versions_original = deepcopy(Installer._versions)
 
@@ -322,7 +536,6 @@ class TestBaseRecipe(RecipeTestCase):
         try:
             self.recipe.apply_odoo_requirements_file()
         finally:
-            sys.modules['pip'] = pip_original
             Installer._versions = versions_original
 
         return versions
@@ -372,6 +585,22 @@ class TestBaseRecipe(RecipeTestCase):
             pre_versions={dist_name: '17.2'})
         self.assertEqual(versions.get(dist_name), '17.2')
 
+    def test_apply_requirements_file_markers(self):
+        """Unit test for Odoo requirements.txt: markers and included files
+        """
+        self.make_recipe_appplying_requirements_file(os.linesep.join((
+            "someproject==1.2.3 ; python_version >= '2.0'",
+            "otherproject==3.2.1 ; python_version < '2.0'",
+            "-r extra-requirements.txt")))
+        with open(os.path.join(self.recipe.odoo_dir,
+                               'extra-requirements.txt'), 'w') as f:
+            f.write("Included_Project==0.1 --hash=sha256:abcd\n")
+        versions = self.apply_requirements_file()
+        self.assertEqual(versions.get('someproject'), '1.2.3')
+        self.assertEqual(versions.get('included-project'), '0.1')
+        self.assertFalse('otherproject' in versions)
+        self.assertFalse('otherproject' in self.recipe.requirements)
+
     def test_list_develops(self):
         self.make_recipe(
             version='git http://github.com/odoo/odoo.git odoo 10.0')
@@ -380,6 +609,50 @@ class TestBaseRecipe(RecipeTestCase):
         self.assertEqual(self.recipe.list_develops(),
                          [self.fictive_dist_name])
 
+    def test_develop_unchanged(self):
+        """Sources whose setup hasn't changed are not developed again."""
+        import zc.buildout.easy_install
+        self.make_recipe(
+            version='git http://github.com/odoo/odoo.git odoo 10.0')
+        self.silence_buildout_develop()
+        src = self.path_from_buildout('fictive_dist')
+        shutil.copytree(os.path.join(self.test_dir, 'fictive_dist'), src,
+                        ignore=shutil.ignore_patterns('*.egg-info', 'build'))
+        self.assertEqual(self.recipe.develop(src), self.fictive_dist_name)
+
+        calls = []
+        orig_develop = zc.buildout.easy_install.develop
+
+        def develop(*args, **kwargs):
+            calls.append(args)
+            return orig_develop(*args, **kwargs)
+        zc.buildout.easy_install.develop = develop
+        try:
+            self.assertEqual(self.recipe.develop(src),
+                             self.fictive_dist_name)
+            self.assertEqual(calls, [])
+            with open(os.path.join(src, 'setup.cfg'), 'a') as f:
+                f.write("\n# changed\n")
+            self.assertEqual(self.recipe.develop(src),
+                             self.fictive_dist_name)
+            self.assertEqual(len(calls), 1)
+
+            # the egg link got pointed to another tree meanwhile
+            egg_link = os.path.join(
+                self.recipe.b_options['develop-eggs-directory'],
+                self.fictive_dist_name + '.egg-link')
+            with open(egg_link, 'w') as f:
+                f.write(self.path_from_buildout('elsewhere') + '\n.')
+            self.assertEqual(self.recipe.develop(src),
+                             self.fictive_dist_name)
+            self.assertEqual(len(calls), 2)
+            with open(egg_link) as f:
+                self.assertEqual(f.readline().strip(), src)
+        finally:
+            zc.buildout.easy_install.develop = orig_develop
+        self.assertEqual(self.recipe.list_develops(),
+                         [self.fictive_dist_name])
+
     def test_apply_requirements_file_precedence2(self):
         """Unit test for Odoo requirements.txt: develops should win
         """
@@ -400,3 +673,178 @@ class TestBaseRecipe(RecipeTestCase):
         """
         self.make_recipe_appplying_requirements_file("spam==1.2.3, >2.0")
         self.assertRaises(UserError, self.apply_requirements_file)
+
+    def test_retrieve_addons_jobs(self):
+        """Concurrent retrieval keeps the order of addons lines."""
+        addons_dirs = ['addons-%d' % i for i in range(6)]
+        self.make_recipe(
+            version='local server-dir',
+            addons=os.linesep.join('fakevcs http://some/repo%d %s rev' % (
+                i, d) for i, d in enumerate(addons_dirs)),
+            **{'vcs-jobs': '3'})
+        self.assertEqual(self.recipe.vcs_jobs, 3)
+        self.recipe.retrieve_addons()
+        paths = [self.path_from_buildout(d) for d in addons_dirs]
+        self.assertEqual(self.recipe.addons_paths, paths)
+        self.assertEqual(set(entry[0] for entry in get_vcs_log()),
+                         set(paths))
+
+    def test_retrieve_addons_git_worktrees(self):
+        """Lines with the same Git URL become worktrees, in one task."""
+        from .. import vcs
+        calls = []
+
+        def get_update(vcs_type, target_dir, url, revision, **options):
+            calls.append((target_dir, options.get('worktree_of')))
+
+        self.buildout['buildout']['offline'] = 'true'
+        self.make_recipe(
+            version='local server-dir',
+            addons=os.linesep.join((
+                'git http://some/repo a 1.0',
+                'git http://other/repo b 1.0',
+                'git http://some/repo c 2.0',
+                'git http://some/repo d 3.0')),
+            **{'git-worktrees': 'true', 'vcs-jobs': '2'})
+        orig_get_update = vcs.get_update
+        vcs.get_update = get_update
+        try:
+            self.recipe.retrieve_addons()
+        finally:
+            vcs.get_update = orig_get_update
+
+        main = self.path_from_buildout('a')
+        self.assertEqual(
+            [c for c in calls if c[0] != self.path_from_buildout('b')],
+            [(main, None),
+             (self.path_from_buildout('c'), main),
+             (self.path_from_buildout('d'), main)])
+        self.assertTrue((self.path_from_buildout('b'), None) in calls)
+
+    def test_retrieve_merges_jobs(self):
+        """Merges are done in order for each directory."""
+        from .. import vcs
+        calls = []
+
+        def get_update(vcs_type, target_dir, url, revision, **options):
+            self.assertTrue(options['merge'])
+            calls.append((target_dir, revision))
+
+        self.make_recipe(
+            version='local server-dir',
+            merges=os.linesep.join((
+                'git http://some/repo a 1.0',
+                'git http://other/repo b 1.0',
+                'git http://other/repo a 2.0',
+                'git http://some/repo a 3.0')),
+            **{'vcs-jobs': '2'})
+        preloaded = []
+
+        def preload_remote_refs(urls, jobs=1):
+            preloaded.extend(urls)
+
+        orig_get_update = vcs.get_update
+        orig_preload = vcs.GitRepo.preload_remote_refs
+        vcs.get_update = get_update
+        vcs.GitRepo.preload_remote_refs = staticmethod(preload_remote_refs)
+        try:
+            self.recipe.retrieve_merges()
+        finally:
+            vcs.get_update = orig_get_update
+            vcs.GitRepo.preload_remote_refs = orig_preload
+
+        # remote refs are listed once per remote
+        self.assertEqual(sorted(preloaded),
+                         ['http://other/repo', 'http://some/repo'])
+        a = self.path_from_buildout('a')
+        self.assertEqual([c for c in calls if c[0] == a],
+                         [(a, '1.0'), (a, '2.0'), (a, '3.0')])
+        self.assertTrue((self.path_from_buildout('b'), '1.0') in calls)
+
+    def test_vcs_refs_cache(self):
+        self.make_recipe(version='local server-dir',
+                         addons='fakevcs http://some/repo addons-a rev',
+                         **{'vcs-refs-cache-ttl': '60'})
+        cache = self.recipe.refs_cache
+        self.assertEqual(cache.ttl, 60)
+        self.assertEqual(cache.path,
+                         self.path_from_buildout('.installed.vcs-refs.json'))
+        self.recipe.retrieve_addons()
+        cache.save()
+        self.assertTrue(os.path.exists(cache.path))
+
+    def test_vcs_refs_cache_default(self):
+        self.make_recipe(version='local server-dir')
+        self.assertIsNone(self.recipe.refs_cache)
+
+    def test_vcs_fingerprint(self):
+        self.make_recipe(version='local server-dir')
+        self.assertTrue(self.recipe.vcs_fingerprint)
+        self.make_recipe(version='local server-dir',
+                         **{'vcs-fingerprint': 'false'})
+        self.assertFalse(self.recipe.vcs_fingerprint)
+
+    def test_retrieve_addons_jobs_failures(self):
+        """All failures are reported, and other sources are retrieved."""
+        from ..testing import FakeRepo
+        from .. import vcs
+
+        class FailingRepo(FakeRepo):
+            def get_update(self, revision):
+                raise ValueError("failing on purpose")
+
+        vcs.SUPPORTED['failing'] = FailingRepo
+        try:
+            self.make_recipe(
+                version='local server-dir',
+                addons=os.linesep.join((
+                    'failing http://some/repo failing1 rev',
+                    'fakevcs http://some/repo fake rev',
+                    'failing http://some/repo failing2 rev')),
+                **{'vcs-jobs': '2'})
+            with self.assertRaises(UserError) as arc:
+                self.recipe.retrieve_addons()
+        finally:
+            del vcs.SUPPORTED['failing']
+
+        msg = str(arc.exception)
+        self.assertTrue('failing1' in msg)
+        self.assertTrue('failing2' in msg)
+        self.assertEqual([entry[0] for entry in get_vcs_log()],
+                         [self.path_from_buildout('fake')])
+
+    def test_retrieve_addons_jobs_one_failure(self):
+        """A single failure is raised again with its original traceback."""
+        import sys
+        import traceback
+        from ..testing import FakeRepo
+        from .. import vcs
+
+        class FailingRepo(FakeRepo):
+            def get_update(self, revision):
+                raise ValueError("failing on purpose")
+
+        vcs.SUPPORTED['failing'] = FailingRepo
+        try:
+            self.make_recipe(
+                version='local server-dir',
+                addons=os.linesep.join((
+                    'failing http://some/repo failing1 rev',
+                    'fakevcs http://some/repo fake rev')),
+                **{'vcs-jobs': '2'})
+            try:
+                self.recipe.retrieve_addons()
+            except ValueError:
+                tb = sys.exc_info()[2]
+            else:
+                self.fail("Expected ValueError")
+        finally:
+            del vcs.SUPPORTED['failing']
+
+        self.assertEqual(traceback.extract_tb(tb)[-1][2], 'get_update')
+
+    def test_vcs_jobs_invalid(self):
+        for invalid in ('0', '-2', 'many'):
+            self.assertRaises(UserError, self.make_recipe,
+                              version='local server-dir',
+                              **{'vcs-jobs': invalid})
@@ -0,0 +1,278 @@
+import os
+import json
+import shutil
+import socket
+import hashlib
+import tempfile
+import threading
+import unittest
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # Py 2
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler  # Py 3
+
+from .. import download
+
+LAST_MODIFIED = 'Sat, 01 Oct 2016 10:00:00 GMT'
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve the ``files`` of the server, honouring ``If-Range``."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def send_empty(self, status, **headers):
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server
+        headers = dict((k.lower(), v) for k, v in self.headers.items())
+        headers['client'] = self.client_address
+        server.requests.append(headers)
+        if self.path == '/redirect':
+            self.send_empty(302, Location='/archive.tgz')
+            return
+        content = server.files.get(self.path)
+        if content is None:
+            self.send_empty(404)
+            return
+        if (headers.get('if-none-match') == ETAG or
+                headers.get('if-modified-since') == LAST_MODIFIED):
+            self.send_empty(304)
+            return
+
+        ctype = 'text/html' if self.path.endswith('.html') else (
+            'application/x-gzip')
+        rng = self.headers.get('Range')
+        if rng and self.headers.get('If-Range') == LAST_MODIFIED:
+            start = int(rng.split('=')[1].rstrip('-'))
+            if start >= len(content):
+                self.send_empty(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(content) - 1, len(content)))
+        else:
+            start = 0
+            self.send_response(200)
+        body = content[start:]
+        self.send_header('Content-Length', str(len(body)))
+        if server.truncate:
+            body = body[:server.truncate]
+            server.truncate = server.truncate_next
+            self.close_connection = True
+        self.send_header('Content-Type', ctype)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('ETag', ETAG)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class Server(HTTPServer):
+
+    def handle_error(self, request, client_address):
+        """Connections closed by the client are expected."""
+
+
+class DownloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.files = {}
+        self.server.requests = []
+        self.server.truncate = self.server.truncate_next = None
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'archive.tgz')
+        self.content = os.urandom(200000)
+        self.server.files['/archive.tgz'] = self.content
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, path=None):
+        with open(path or self.path, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        download.download(self.base_url + '/redirect', self.path,
+                          sha256=self.sha256)
+        self.assertEqual(self.read(), self.content)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertEqual(os.path.getmtime(self.path),
+                         download.parse_http_date(LAST_MODIFIED))
+
+    def test_html(self):
+        self.server.files['/archive.html'] = b'<html></html>'
+        self.assertRaises(LookupError, download.download,
+                          self.base_url + '/archive.html', self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_resume(self):
+        url = self.base_url + '/archive.tgz'
+        self.server.truncate = self.server.truncate_next = 50000
+        self.assertRaises(IOError, download.download, url, self.path,
+                          retries=0)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(self.read(self.path + '.part'),
+                         self.content[:50000])
+
+        self.server.truncate = None
+        download.download(url, self.path, sha256=self.sha256)
+        self.assertEqual(self.server.requests[-1]['range'], 'bytes=50000-')
+        self.assertEqual(self.read(), self.content)
+
+    def test_retries(self):
+        self.server.truncate = 50000
+        download.download(self.base_url + '/archive.tgz', self.path,
+                          sha256=self.sha256)
+        self.assertEqual(self.read(), self.content)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[-1]['range'], 'bytes=50000-')
+
+    def test_conditional(self):
+        url = self.base_url + '/redirect'
+        download.download(url, self.path)
+        with open(download.validators_path(self.path)) as f:
+            self.assertEqual(json.load(f), dict(url=url, etag=ETAG,
+                                                last_modified=LAST_MODIFIED))
+        self.assertIsNone(download.download(url, self.path,
+                                            conditional=True))
+        requests = self.server.requests[-2:]
+        self.assertEqual(requests[-1]['if-none-match'], ETAG)
+        # redirection and actual request with the same connection
+        self.assertEqual(requests[0]['client'], requests[1]['client'])
+
+        self.server.files['/archive.tgz'] = b'new content'
+        os.unlink(download.validators_path(self.path))
+        os.utime(self.path, (0, 0))  # no validators, the date is used
+        self.assertIsNotNone(download.download(url, self.path,
+                                               conditional=True))
+        self.assertEqual(self.read(), b'new content')
+
+    def test_resume_stale(self):
+        """A partial file that can't be resumed is downloaded again."""
+        with open(self.path + '.part', 'wb') as f:
+            f.write(self.content + b'extra')
+        mtime = download.parse_http_date(LAST_MODIFIED)
+        os.utime(self.path + '.part', (mtime, mtime))
+        download.download(self.base_url + '/archive.tgz', self.path)
+        self.assertEqual(self.read(), self.content)
+
+    def test_checksum_mismatch(self):
+        self.assertRaises(download.ChecksumError, download.download,
+                          self.base_url + '/archive.tgz', self.path,
+                          sha256='0' * 64)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_other_scheme(self):
+        src = os.path.join(self.tmpdir, 'src.tgz')
+        with open(src, 'wb') as f:
+            f.write(self.content)
+        download.download('file://' + src, self.path, sha256=self.sha256)
+        self.assertEqual(self.read(), self.content)
+
+        # a file hardlinked from elsewhere (e.g., the download cache)
+        # is replaced, not written into
+        with open(src, 'wb') as f:
+            f.write(b'new content')
+        linked = os.path.join(self.tmpdir, 'linked.tgz')
+        os.link(self.path, linked)
+        download.download('file://' + src, self.path)
+        self.assertEqual(self.read(), b'new content')
+        self.assertEqual(self.read(linked), self.content)
+
+    def test_mirrors(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        dead_url = 'http://127.0.0.1:%d/archive.tgz' % sock.getsockname()[1]
+        sock.close()
+        missing_url = self.base_url + '/missing.tgz'
+        good_url = self.base_url + '/archive.tgz'
+        self.assertEqual(
+            download.rank_mirrors([dead_url, missing_url, good_url]),
+            [good_url, dead_url, missing_url])
+        self.assertEqual(self.server.requests[0]['range'], 'bytes=0-65535')
+
+        download.download_mirrors([dead_url, missing_url, good_url],
+                                  self.path, sha256=self.sha256)
+        self.assertEqual(self.read(), self.content)
+
+        # fail over if a mirror serves a wrong file
+        self.server.files['/broken.tgz'] = b'not the archive'
+        os.unlink(self.path)
+        download.download_mirrors([self.base_url + '/broken.tgz', good_url],
+                                  self.path, sha256=self.sha256)
+        self.assertEqual(self.read(), self.content)
+
+        self.assertRaises(IOError, download.download_mirrors,
+                          [dead_url, missing_url], self.path)
+
+        # conditional: the previous mirror is asked directly, no probing
+        del self.server.requests[:]
+        self.assertIsNone(download.download_mirrors(
+            [self.base_url + '/broken.tgz', good_url], self.path,
+            conditional=True))
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(self.server.requests[0]['if-none-match'], ETAG)
+
+    def test_cache(self):
+        url = self.base_url + '/redirect'
+        cache = download.DownloadCache(os.path.join(self.tmpdir, 'cache'))
+        self.assertFalse(cache.restore(url, self.path))
+        download.download(url, self.path)
+        cache.store(url, self.path)
+        entry = cache.lookup(url)
+        self.assertEqual(entry['sha256'], self.sha256)
+        self.assertEqual(entry['validators']['etag'], ETAG)
+
+        other_path = os.path.join(self.tmpdir, 'other.tgz')
+        self.assertTrue(cache.restore(url, other_path))
+        self.assertEqual(self.read(other_path), self.content)
+        # hardlinked from the cache, with the validators
+        self.assertEqual(os.stat(other_path).st_ino,
+                         os.stat(cache.object_path(self.sha256)).st_ino)
+        self.assertIsNone(download.download(url, other_path,
+                                            conditional=True))
+
+        # with a checksum, the content can come from another URL
+        os.unlink(other_path)
+        self.assertTrue(cache.restore('http://mirror.example/a.tgz',
+                                      other_path, sha256=self.sha256))
+        self.assertFalse(cache.restore(url, other_path, sha256='0' * 64))
+
+    def test_cache_eviction(self):
+        cache = download.DownloadCache(os.path.join(self.tmpdir, 'cache'))
+        for atime, url in ((3000, 'http://h/a'), (1000, 'http://h/b'),
+                           (2000, 'http://h/c')):
+            with open(self.path, 'wb') as f:
+                f.write(url.encode() * 2)  # 20 bytes
+            cache.store(url, self.path)
+            os.utime(cache.object_path(cache.lookup(url)['sha256']),
+                     (atime, 0))
+            os.unlink(self.path)
+
+        cache.max_size = 45
+        cache.evict()
+        self.assertIsNone(cache.lookup('http://h/b'))
+        self.assertIsNotNone(cache.lookup('http://h/c'))
+        cache.max_size = 10
+        keep = cache.object_path(cache.lookup('http://h/c')['sha256'])
+        cache.evict(keep=keep)
+        self.assertIsNone(cache.lookup('http://h/a'))
+        self.assertTrue(os.path.exists(keep))
@@ -23,10 +23,8 @@ EGG_SUFFIX = '-py%d.%d.egg' % sys.version_info[:2]
 class IntegrationTestCase(unittest.TestCase):
 
     def setUp(self):
-        import pip as pip_original
         self.versions_original = deepcopy(Installer._versions)
         self.cwd_original = os.getcwd()
-        self.pip_original = pip_original
         try:
             sandbox = mkdtemp('test_int_oerp_base_recipe')
             self.buildout_dir = os.path.join(sandbox, 'buildout_dir')
@@ -65,7 +63,7 @@ class IntegrationTestCase(unittest.TestCase):
 
         autopath = buildout_and_setuptools_path
         self.autopath_original = autopath[:]
-        forward_projects = ['pip', 'zc.buildout', 'zc.recipe.egg',
+        forward_projects = ['zc.buildout', 'zc.recipe.egg',
                             'anybox.recipe.odoo']
         if sys.version_info < (2, 7):
             forward_projects.extend(('argparse', 'ordereddict'))
@@ -78,7 +76,6 @@ class IntegrationTestCase(unittest.TestCase):
         except:
             pass
 
-        sys.modules['pip'] = self.pip_original
         Installer._versions = self.versions_original
         buildout_and_setuptools_path[:] = self.autopath_original
         os.chdir(self.cwd_original)
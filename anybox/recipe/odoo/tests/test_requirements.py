@@ -0,0 +1,74 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from zc.buildout import UserError
+
+from ..requirements import parse_requirements
+
+
+class ParseRequirementsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def write(self, name, *lines):
+        path = os.path.join(self.dirpath, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def parse(self, *lines):
+        path = self.write('requirements.txt', *lines)
+        return [(req.project_name, req.specs, str(req.marker or ''))
+                for req in parse_requirements(path)]
+
+    def test_specifiers(self):
+        self.assertEqual(self.parse(
+            '# Odoo requirements',
+            'Babel==2.3.4',
+            'psycopg2 >= 2.2, < 3  # comment',
+            'python-ldap',
+            '',
+        ), [('Babel', [('==', '2.3.4')], ''),
+            ('psycopg2', [('>=', '2.2'), ('<', '3')], ''),
+            ('python-ldap', [], '')])
+
+    def test_markers(self):
+        self.assertEqual(self.parse(
+            "pypiwin32 ; sys_platform == 'win32'",
+        ), [('pypiwin32', [], 'sys_platform == "win32"')])
+
+    def test_continuation_and_options(self):
+        self.assertEqual(self.parse(
+            '--index-url https://pypi.example/simple',
+            '-f https://links.example',
+            'lxml==3.5.0 \\',
+            '    --hash=sha256:0123',
+        ), [('lxml', [('==', '3.5.0')], '')])
+
+    def test_editable(self):
+        self.assertEqual(self.parse(
+            '-e git+https://example.com/proj.git@1.0#egg=some_proj',
+        ), [('some-proj', [], '')])
+        self.assertRaises(UserError, self.parse, '-e ./local')
+
+    def test_included(self):
+        self.write(os.path.join('sub', 'base.txt'),
+                   'Werkzeug==0.11.11', '-r ../requirements.txt')
+        self.assertEqual(self.parse(
+            'Jinja2==2.8',
+            '--requirement sub/base.txt',
+        ), [('Jinja2', [('==', '2.8')], ''),
+            ('Werkzeug', [('==', '0.11.11')], '')])
+
+    def test_invalid(self):
+        self.assertRaises(UserError, self.parse, 'not a requirement!')
+        self.assertRaises(UserError, self.parse,
+                          '-r http://example.com/requirements.txt')
@@ -5,6 +5,7 @@ an embedded http server, etc.
 """
 import os
 from pkg_resources import Requirement
+import zc.recipe.egg
 
 from ..base import MissingDistribution
 from ..base import IncompatibleConstraintError
@@ -348,6 +349,32 @@ class TestServer(RecipeTestCase):
         self.do_test_install_scripts_soft_deps(
             exc=MissingDistribution(req, []))
 
+    def test_install_scripts_soft_deps_upfront(self):
+        """Missing soft requirements are removed before a single resolution.
+        """
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo10'),
+                         gunicorn='direct')
+        self.recipe.version_detected = "10.0-20121003-233130"
+        softreqs = ('zztest-softreq', 'zztest-softreq2')
+        self.recipe.soft_requirements = softreqs
+        self.unreachable_distributions.update(softreqs)
+
+        resolutions = []
+        orig_working_set = zc.recipe.egg.Scripts.working_set
+
+        def working_set(recipe, *args):
+            resolutions.append(recipe.options['eggs'])
+            return orig_working_set(recipe, *args)
+        zc.recipe.egg.Scripts.working_set = working_set
+        try:
+            self.install_scripts(extra_requirements=softreqs)
+        finally:
+            zc.recipe.egg.Scripts.working_set = orig_working_set
+        self.assertEqual(len(resolutions), 1)
+        for softreq in softreqs:
+            self.assertNotIn(softreq, resolutions[0].split(os.linesep))
+        self.assertScripts(('start_odoo', 'gunicorn_odoo'))
+
     def test_install_scripts_soft_deps_incompatible_constraint(self):
         req = Requirement.parse("zztest-softreq==1.2.3")
         self.do_test_install_scripts_soft_deps(
@@ -402,6 +429,47 @@ class TestServer(RecipeTestCase):
     def test_install_scripts_10_no_devtools(self):
         self.test_install_scripts_10(with_devtools=False)
 
+    def test_install_requirements_working_set_cache(self):
+        self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo10'),
+                         gunicorn='direct')
+        self.recipe.version_detected = "10.0alpha"
+        self.install_scripts()
+        recipe = self.recipe
+        recipe.options['scripts'] = 'gunicorn'
+        # Odoo itself got developed afterwards
+        recipe.install_requirements()
+        self.assertTrue(os.path.exists(recipe.working_set_path))
+        dists = [(d.project_name, d.location) for d in recipe.ws]
+
+        def working_set(*args):
+            raise AssertionError("Requirements should not be resolved")
+        orig_working_set = zc.recipe.egg.Scripts.working_set
+        zc.recipe.egg.Scripts.working_set = working_set
+        try:
+            recipe.ws = recipe.eggs_ws = None
+            recipe.install_requirements()
+            self.assertEqual([(d.project_name, d.location)
+                              for d in recipe.ws], dists)
+            self.assertEqual(recipe.eggs_ws, recipe.ws)
+
+            # a generated script is missing
+            scripts = recipe.eggs_scripts
+            self.assertTrue(scripts)
+            os.unlink(scripts[0])
+            self.assertRaises(AssertionError, recipe.install_requirements)
+
+            # scripts would not be generated on a cache hit
+            scripts = recipe.options['scripts']
+            recipe.options['scripts'] += os.linesep + 'zztest-script'
+            self.assertRaises(AssertionError, recipe.install_requirements)
+            recipe.options['scripts'] = scripts
+
+            # the requirements have changed
+            recipe.options['eggs'] += os.linesep + 'zztest-req'
+            self.assertRaises(AssertionError, recipe.install_requirements)
+        finally:
+            zc.recipe.egg.Scripts.working_set = orig_working_set
+
     def test_gunicorn_preload_databases(self, databases='onedb',
                                         expected="('onedb',)"):
         self.make_recipe(version='local %s' % os.path.join(TEST_DIR, 'odoo10'),
@@ -1,10 +1,16 @@
 import unittest
 import tempfile
+import tarfile
 import shutil
+import subprocess
 import os
 from datetime import timedelta
+from unittest import SkipTest
 
+from .. import utils
 from ..utils import working_directory_keeper, total_seconds
+from ..utils import archive_compression, open_tar_stream
+from ..utils import find_executable
 
 
 class WorkingDirectoryTestCase(unittest.TestCase):
@@ -32,3 +38,69 @@ class VariousTestCase(unittest.TestCase):
         self.assertEqual(total_seconds(timedelta(1, 2)), 86402.0)
         self.assertEqual(total_seconds(timedelta(0, -3)), -3.0)
         self.assertEqual(total_seconds(timedelta(0, 12, 35000)), 12.035)
+
+
+class TarStreamTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        src = os.path.join(self.dirpath, 'src')
+        os.makedirs(os.path.join(src, 'd'))
+        for i in range(3):
+            with open(os.path.join(src, 'd', 'f%d' % i), 'w') as f:
+                f.write("content %d" % i)
+        self.tar_path = os.path.join(self.dirpath, 'archive.tar')
+        with tarfile.open(self.tar_path, 'w') as tar:
+            tar.add(os.path.join(src, 'd'), arcname='d')
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def compress(self, cmd):
+        """Compress the archive with cmd, return the path."""
+        if not find_executable(cmd[0]):
+            raise SkipTest("%s not available" % cmd[0])
+        path = self.tar_path + '.compressed'
+        with open(self.tar_path, 'rb') as src:
+            with open(path, 'wb') as dst:
+                subprocess.check_call(cmd, stdin=src, stdout=dst)
+        return path
+
+    def assertMembers(self, path):
+        with open_tar_stream(path) as tar:
+            self.assertEqual(sorted(t.name for t in iter(tar.next, None)),
+                             ['d', 'd/f0', 'd/f1', 'd/f2'])
+
+    def test_formats(self):
+        self.assertIsNone(archive_compression(self.tar_path))
+        self.assertMembers(self.tar_path)
+        for cmd, fmt in ((['gzip', '-c'], 'gz'),
+                         (['bzip2', '-c'], 'bz2'),
+                         (['xz', '-c'], 'xz'),
+                         (['zstd', '-c', '-q'], 'zst')):
+            path = self.compress(cmd)
+            self.assertEqual(archive_compression(path), fmt)
+            self.assertMembers(path)
+
+    def test_python_fallback(self):
+        path = self.compress(['gzip', '-c'])
+        orig = utils.DECOMPRESSORS
+        utils.DECOMPRESSORS = {}
+        try:
+            self.assertMembers(path)
+        finally:
+            utils.DECOMPRESSORS = orig
+
+    def test_partial_read(self):
+        path = self.compress(['gzip', '-c'])
+        with open_tar_stream(path) as tar:
+            self.assertEqual(tar.next().name, 'd')
+
+    def test_corrupted(self):
+        path = self.compress(['gzip', '-c'])
+        with open(path, 'r+b') as f:
+            f.seek(-4, os.SEEK_END)
+            f.write(b'\0\0\0\0')  # wrong length in gzip trailer
+        with self.assertRaises(IOError):
+            with open_tar_stream(path) as tar:
+                list(iter(tar.next, None))
@@ -1,12 +1,28 @@
 import os
 import sys
 import re
+import tarfile
+import zipfile
 import subprocess
+import threading
+try:
+    from shutil import which as find_executable  # Python 3
+except ImportError:
+    from distutils.spawn import find_executable  # Python 2
 from contextlib import contextmanager
+try:
+    from Queue import Queue, Empty  # Python 2
+except ImportError:
+    from queue import Queue, Empty  # Python 3
+try:
+    import fcntl
+except ImportError:  # not on POSIX systems
+    fcntl = None
 try:
     from ConfigParser import DuplicateSectionError  # Python 2
 except ImportError:
     from configparser import DuplicateSectionError  # Python 3
+from zc.buildout import UserError
 import logging
 logger = logging.getLogger(__name__)
 
@@ -51,6 +67,117 @@ def use_or_open(provided, path, *open_args):
             yield f
 
 
+@contextmanager
+def file_lock(path):
+    """A context manager holding an exclusive lock on the given file.
+
+    The file is created if needed. The lock is advisory, and is effective
+    across processes (e.g., concurrent buildouts) as well as across threads.
+    On systems lacking :mod:`fcntl`, no locking occurs.
+    """
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gz'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zst'),
+)
+
+DECOMPRESSORS = {
+    'gz': (['pigz', '-dc'], ['gzip', '-dc']),
+    'bz2': (['pbzip2', '-dc'], ['lbzip2', '-dc'], ['bzip2', '-dc']),
+    'xz': (['xz', '-dc', '-T0'], ),
+    'zst': (['zstd', '-dc', '-T0'], ),
+}
+"""Decompression commands, by order of preference (parallel ones first)."""
+
+
+def archive_compression(path):
+    """Tell the compression format of a file from its first bytes.
+
+    :returns: one of ``'gz'``, ``'bz2'``, ``'xz'``, ``'zst'`` or ``None``
+    """
+    with open(path, 'rb') as f:
+        head = f.read(6)
+    for magic, fmt in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return fmt
+
+
+class _StreamTarFile(tarfile.TarFile):
+    """Remember if the end of the archive has been reached."""
+
+    exhausted = False
+
+    def next(self):
+        tinfo = tarfile.TarFile.next(self)
+        if tinfo is None:
+            self.exhausted = True
+        return tinfo
+
+
+@contextmanager
+def open_tar_stream(path):
+    """Open a tar archive for reading in one forward pass (stream mode).
+
+    Compressed archives are piped through an external decompressor if one
+    is available (parallel ones preferred), so that decompression runs
+    concurrently and possibly on several cores. Otherwise, Python's own
+    decompression is used, if it supports the format.
+
+    If the archive isn't read up to its end, the decompressor is stopped
+    without further checks.
+    """
+    fmt = archive_compression(path)
+    cmd = None
+    for candidate in DECOMPRESSORS.get(fmt, ()):
+        if find_executable(candidate[0]):
+            cmd = candidate
+            break
+    if cmd is None:
+        try:
+            tar = _StreamTarFile.open(path, 'r|' + (fmt or ''))
+        except tarfile.CompressionError:
+            raise UserError("No decompressor available for %s, please "
+                            "install %s" % (path, ' or '.join(
+                                c[0] for c in DECOMPRESSORS[fmt])))
+        try:
+            yield tar
+        finally:
+            tar.close()
+        return
+
+    logger.debug("Decompressing %s with %r", path, cmd)
+    with open(path, 'rb') as archive:
+        proc = subprocess.Popen(cmd, stdin=archive, stdout=subprocess.PIPE)
+    try:
+        tar = _StreamTarFile.open(fileobj=proc.stdout, mode='r|')
+        yield tar
+    except BaseException:
+        proc.kill()
+        proc.wait()
+        raise
+    else:
+        tar.close()
+        if not tar.exhausted:
+            proc.kill()
+            proc.wait()
+        elif proc.wait():
+            raise IOError("Decompression of %s failed: %r returned %d" % (
+                path, cmd, proc.returncode))
+    finally:
+        proc.stdout.close()
+
+
 def major_version(version_string):
     """The least common denominator of Odoo versions : two numbers.
 
@@ -270,6 +397,96 @@ def conf_ensure_section(conf, section):
         pass
 
 
+def zip_directory(directory, path):
+    """Create a zip archive at path with the contents of directory.
+
+    Archive member names are relative to directory.
+    """
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                file_path = os.path.join(dirpath, filename)
+                archive.write(file_path,
+                              os.path.relpath(file_path, directory))
+
+
+def run_jobs(jobs, tasks):
+    """Run callables, with at most ``jobs`` of them at the same time.
+
+    :param int jobs: maximum number of concurrent threads. With ``1``, the
+                     tasks are simply run in order in the current thread.
+    :param tasks: sequence of ``(key, callable)`` pairs. The callables take
+                  no argument.
+    :returns: list of ``(key, exc_info)`` for the tasks that raised, in the
+              same order as ``tasks``. All tasks are run, even if some
+              of them fail.
+
+    Example::
+
+      >>> run_jobs(2, [('a', lambda: None), ('b', lambda: 1 / 0)])[0][0]
+      'b'
+    """
+    tasks = list(tasks)
+    failures = {}
+
+    def run(index, key, task):
+        try:
+            task()
+        except Exception:
+            failures[index] = (key, sys.exc_info())
+
+    if jobs <= 1 or len(tasks) <= 1:
+        for index, (key, task) in enumerate(tasks):
+            run(index, key, task)
+    else:
+        queue = Queue()
+        for index, (key, task) in enumerate(tasks):
+            queue.put((index, key, task))
+
+        def worker():
+            while True:
+                try:
+                    index, key, task = queue.get_nowait()
+                except Empty:
+                    return
+                run(index, key, task)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(jobs, len(tasks)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    return [failures[i] for i in sorted(failures)]
+
+
+if sys.version_info >= (3, ):
+    def reraise(exc_info):
+        """Raise again an exception, from the result of sys.exc_info().
+
+        Unlike a plain ``raise exc``, this keeps the original traceback,
+        even if the exception was caught in another thread.
+        """
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    exec("""def reraise(exc_info):
+    raise exc_info[0], exc_info[1], exc_info[2]
+""")
+
+
+def run_all(calls):
+    """Run the given callables in order, until one of them fails.
+
+    This is useful to turn a sequence of callables into a single task
+    for :func:`run_jobs`.
+    """
+    for call in calls:
+        call()
+
+
 def next(iterator):
     """ Python2 compatibility of iterators """
     return iterator.next()
@@ -1,5 +1,6 @@
 from zc.buildout import UserError
 from .base import UpdateError  # noqa
+from .base import RefsCache  # noqa
 from .hg import HgRepo
 from .bzr import BzrBranch
 from .svn import SvnCheckout
@@ -1,7 +1,11 @@
 import os
+import json
+import time
 import shutil
 import subprocess
 import logging
+import threading
+import weakref
 from .. import utils
 
 SUBPROCESS_ENV = os.environ.copy()
@@ -43,6 +47,101 @@ update_check_output = wrap_check_call(UpdateError, utils.check_output)
 clone_check_output = wrap_check_call(CloneError, utils.check_output)
 
 
+_open_repos = weakref.WeakSet()
+_open_repos_lock = threading.Lock()
+
+
+def close_all():
+    """Close all repository instances that may still hold resources.
+
+    This is meant for test fixtures, normal callers should close
+    the instances they create (see :meth:`BaseRepo.close`).
+    """
+    with _open_repos_lock:
+        repos = list(_open_repos)
+        _open_repos.clear()
+    for repo in repos:
+        repo.close()
+
+
+class RefsCache(object):
+    """Persistent cache of remote refs resolutions, with expiration.
+
+    Maps ``(url, ref)`` pairs to values chosen by the repository classes
+    (typically the SHA or revision id the ref pointed to after the latest
+    pull), so that network operations can be skipped during ``ttl`` seconds.
+    The values must be JSON serializable.
+
+    Instances can be shared by concurrently running repositories.
+    Changes are written to disk by :meth:`save` only, merging them with
+    those that other instances saved meanwhile.
+
+    :param path: path to the JSON file backing the cache
+    :param ttl: time to live of entries, in seconds
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = self.read()
+
+    def read(self):
+        """Return the entries currently stored on disk."""
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as cache_file:
+                return json.load(cache_file)
+        except (IOError, ValueError) as exc:
+            logger.warn("Could not read VCS refs cache %s (%s), "
+                        "starting from scratch", self.path, exc)
+            return {}
+
+    @staticmethod
+    def key(url, ref):
+        return ' '.join((url, ref))
+
+    def get(self, url, ref):
+        """Return the value stored for ``(url, ref)`` if not expired.
+
+        :returns: ``None`` if there is no such value.
+        """
+        with self.lock:
+            entry = self.entries.get(self.key(url, ref))
+        if entry is None:
+            return None
+        value, timestamp = entry
+        if not 0 <= time.time() - timestamp < self.ttl:
+            return None
+        return value
+
+    def set(self, url, ref, value):
+        with self.lock:
+            self.entries[self.key(url, ref)] = (value, time.time())
+
+    def save(self):
+        """Write non expired entries to disk.
+
+        Entries saved by other instances in the meantime (e.g., by other
+        parts) are kept, the most recent one winning for a given key.
+        """
+        with utils.file_lock(self.path + '.lock'):
+            entries = self.read()
+            now = time.time()
+            with self.lock:
+                for k, v in self.entries.items():
+                    if k not in entries or entries[k][1] < v[1]:
+                        entries[k] = v
+                self.entries = entries = dict(
+                    (k, v) for k, v in entries.items()
+                    if 0 <= now - v[1] < self.ttl)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as cache_file:
+                json.dump(entries, cache_file)
+            os.rename(tmp_path, self.path)
+
+
 class BaseRepo(object):
     """The common interface that all repository classes implement.
 
@@ -58,6 +157,13 @@ class BaseRepo(object):
     :param clear_retry: if ``True`` failed updates by calling the instance are
                         cleared (see :meth:`clear_target`) and retried once.
                         This is intended for brittle VCSes from CI robots.
+    :param refs_cache: a :class:`RefsCache` instance. If not ``None``,
+                       recently resolved refs are not queried from the
+                       remote again.
+    :param fingerprint: if ``True``, a fingerprint of the wanted revision and
+                        options is written in the VCS control directory after
+                        each update, and the next calls are no-ops if it still
+                        matches (see :meth:`is_up_to_date`).
 
     Other options depend on the concrete repository class.
 
@@ -72,17 +178,37 @@ class BaseRepo(object):
     """
 
     def __init__(self, target_dir, url, clear_retry=False,
-                 offline=False, clear_locks=False, **options):
+                 offline=False, clear_locks=False, refs_cache=None,
+                 fingerprint=False, **options):
 
         self.target_dir = target_dir
         self.url = url
         self.clear_retry = clear_retry
         self.offline = offline
         self.clear_locks = clear_locks
+        self.refs_cache = refs_cache
+        self.fingerprint = fingerprint
 
         # additional options that may depend on the VCS subclass
         self.options = options
 
+    def get_cached_ref(self, ref):
+        """Return the value cached for ``ref`` of this remote, if fresh enough.
+
+        :returns: ``None`` if there's no such value, or no cache at all.
+        """
+        if self.refs_cache is None:
+            return None
+        return self.refs_cache.get(self.url, ref)
+
+    def set_cached_ref(self, ref, value):
+        """Store in cache the current value for ``ref`` of this remote.
+
+        Nothing is stored if ``value`` is ``None``.
+        """
+        if self.refs_cache is not None and value is not None:
+            self.refs_cache.set(self.url, ref, value)
+
     def clear_target(self):
         """Entirely remove the target directory."""
         shutil.rmtree(self.target_dir)
@@ -108,17 +234,122 @@ class BaseRepo(object):
         if self.options.get('clean'):
             self.clean()
 
+        if self.is_up_to_date(revision):
+            logger.info("%s is already at revision %r, nothing to do",
+                        self, revision)
+            return self
+
         try:
-            self.get_update(revision)
-        except UpdateError:
-            if self.offline or not self.clear_retry:
-                raise
-            logger.warn("Update of %s failed, removing and re-cloning "
-                        "according to the clear-retry option. ", self)
-            self.clear_target()
-            self.get_update(revision)
+            try:
+                self.get_update(revision)
+            except UpdateError:
+                if self.offline or not self.clear_retry:
+                    raise
+                logger.warn("Update of %s failed, removing and re-cloning "
+                            "according to the clear-retry option. ", self)
+                self.clear_target()
+                self.get_update(revision)
+            self.write_fingerprint(revision)
+        finally:
+            self.close()
         return self  # nicer in particular for tests
 
+    def close(self):
+        """Release resources held by the instance, such as subprocesses.
+
+        This is called at the end of :meth:`__call__`, and by the ``with``
+        statement, for direct calls to other methods. The instance stays
+        usable afterwards.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def register_open(self):
+        """Record that the instance holds resources until :meth:`close`.
+
+        See :func:`close_all`.
+        """
+        with _open_repos_lock:
+            _open_repos.add(self)
+
+    @property
+    def fingerprint_path(self):
+        return os.path.join(self.target_dir, self.vcs_control_dir,
+                            'buildout-fingerprint.json')
+
+    def fingerprint_spec(self, revision):
+        """Return what is needed to tell apart two different update requests.
+
+        This is normalized through JSON, to be compared with stored values.
+        """
+        options = dict((k, v) for k, v in self.options.items()
+                       if k != 'clean')
+        return json.loads(json.dumps(dict(url=self.url,
+                                          revision=revision,
+                                          options=options),
+                                     default=str))
+
+    def is_up_to_date(self, revision):
+        """True if a previous update to revision can be considered current.
+
+        This is the case if the fingerprint written by the previous update
+        has the same specification and parents as the current state, and
+
+        - either the revision was at that time a locally fixed one
+          (see :meth:`is_local_fixed_revision`),
+        - or its resolution is still in the refs cache, unchanged (see
+          :class:`RefsCache`).
+
+        Merges are never considered to be up to date.
+        """
+        if not self.fingerprint or self.options.get('merge'):
+            return False
+        try:
+            with open(self.fingerprint_path) as fp_file:
+                fingerprint = json.load(fp_file)
+        except (IOError, ValueError):
+            return False
+        if fingerprint.get('spec') != self.fingerprint_spec(revision):
+            return False
+        if not fingerprint.get('fixed'):
+            resolved = self.get_cached_ref(revision)
+            if resolved is None or resolved != fingerprint.get('resolved'):
+                return False
+        try:
+            return self.parents() == fingerprint.get('parents')
+        except (NotImplementedError, subprocess.CalledProcessError):
+            return False
+
+    def write_fingerprint(self, revision):
+        """Record that the current state is the result of updating to revision.
+
+        See :meth:`is_up_to_date`.
+        """
+        if not self.fingerprint or self.options.get('merge'):
+            return
+        try:
+            parents = self.parents()
+            try:
+                fixed = self.is_local_fixed_revision(revision)
+            except NotImplementedError:
+                fixed = False
+        except (NotImplementedError, subprocess.CalledProcessError):
+            return
+        fixed = bool(fixed) or revision in parents
+        fingerprint = dict(spec=self.fingerprint_spec(revision),
+                           parents=parents,
+                           fixed=fixed,
+                           resolved=self.get_cached_ref(revision))
+        try:
+            with open(self.fingerprint_path, 'w') as fp_file:
+                json.dump(fingerprint, fp_file)
+        except IOError as exc:
+            logger.warn("Could not write fingerprint for %s: %s", self, exc)
+
     def get_update(self, revision):
         """Make it so that the target directory is at the prescribed revision.
 
@@ -1,4 +1,5 @@
 import os
+import re
 import logging
 import subprocess
 try:
@@ -6,16 +7,21 @@ try:
 except ImportError:
     from urllib.parse import urlparse  # Python 3
 import urllib
+try:
+    from urllib import unquote  # Python 2
+except ImportError:
+    from urllib.parse import unquote  # Python 3
 try:
     from StringIO import StringIO
 except ImportError:
     from io import StringIO
 from copy import deepcopy
+from hashlib import sha1
 
 from zc.buildout import UserError
 from ..utils import use_or_open
-from ..utils import working_directory_keeper
 from ..utils import check_output
+from ..utils import file_lock
 from .base import SUBPROCESS_ENV
 from .base import BaseRepo
 from .base import update_check_call
@@ -64,7 +70,53 @@ class BzrBranch(BaseRepo):
             self.url = urlparse.urlunparse(parsed)
 
     def conf_file_path(self):
-        return os.path.join(self.target_dir, '.bzr', 'branch', 'branch.conf')
+        branch_dir = self.shared_branch_path() or self.target_dir
+        return os.path.join(branch_dir, '.bzr', 'branch', 'branch.conf')
+
+    def shared_branch_path(self):
+        """Return the path to the branch of :attr:`url` in the shared repo.
+
+        The shared repository is used if the ``bzr-shared-repo`` option is
+        set and ``bzr-init`` has its default value. The target directory is
+        then a lightweight checkout of that branch. Pre-existing standalone
+        branches are left as they are.
+
+        :returns: ``None`` if the shared repository is not used.
+        """
+        shared_repo = self.options.get('bzr-shared-repo')
+        if (not shared_repo or
+                self.options.get('bzr-init', 'branch') != 'branch' or
+                'bzr-stacked-branches' in self.options):
+            return None
+        if (os.path.exists(self.target_dir) and not os.path.exists(
+                os.path.join(self.target_dir, '.bzr', 'branch', 'location'))):
+            return None
+        name = re.sub(r'[^\w.-]+', '_', self.url.rstrip('/').rsplit('/')[-1])
+        return os.path.join(shared_repo, '%s-%s' % (
+            name, sha1(self.url.encode('utf-8')).hexdigest()[:12]))
+
+    def checkout_location(self):
+        """Return the branch the target lightweight checkout is bound to.
+
+        :returns: a local path if the branch is local, or an URL, or ``None``
+                  if the target is not a lightweight checkout.
+        """
+        try:
+            with open(os.path.join(self.target_dir, '.bzr', 'branch',
+                                   'location')) as location_file:
+                location = location_file.read().strip()
+        except IOError:
+            return None
+        if location.startswith('file://'):
+            location = unquote(location[len('file://'):])
+        return location
+
+    def is_bound_to(self, branch_path):
+        """True if target is a lightweight checkout of the given branch."""
+        location = self.checkout_location()
+        if location is None:
+            return False
+        return os.path.realpath(location) == os.path.realpath(branch_path)
 
     def parse_conf(self, from_file=None):
         """Return a dict of paths from standard conf (or the given file-like)
@@ -83,8 +135,6 @@ class BzrBranch(BaseRepo):
                         for name, url in (
                             line.split('=', 1) for line in conffile
                             if not line.startswith('#') and '=' in line))
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
 
     def write_conf(self, conf, to_file=None):
         """Write counterpart to :meth:`read_conf`
@@ -182,19 +232,14 @@ class BzrBranch(BaseRepo):
         if not os.path.exists(self.target_dir):
             # not branched yet, there's nothing to clean
             return
-            subprocess.check_call(['bzr', 'clean-tree',
-                                   '--ignored', '--force'])
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['bzr', 'clean-tree',
-                                   '--ignored', '--force'])
+        subprocess.check_call(['bzr', 'clean-tree', '--ignored', '--force'],
+                              cwd=self.target_dir)
 
     def revert(self, revision):
         logger.info("Reverting bzr repo at %s to revision %r", self.target_dir,
                     revision)
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['bzr', 'revert', '-r', revision])
+        subprocess.check_call(['bzr', 'revert', '-r', revision],
+                              cwd=self.target_dir)
 
     def _update(self, revision):
         """Update existing branch at target dir to given revision.
@@ -211,23 +256,42 @@ class BzrBranch(BaseRepo):
         :param str revision: any valid revision string.
         :raises: :class:`LookupError` if not actually available.
         """
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            try:
-                log = check_output(
-                    ['bzr', 'log', '--show-ids', '-r', revision],
-                    env=SUBPROCESS_ENV)
-            except subprocess.CalledProcessError as exc:
-                if exc.returncode != 3:
-                    raise
-                raise LookupError(
-                    "could not find revision id for %r" % revision)
+        try:
+            log = check_output(
+                ['bzr', 'log', '--show-ids', '-r', revision],
+                env=SUBPROCESS_ENV, cwd=self.target_dir)
+        except subprocess.CalledProcessError as exc:
+            if exc.returncode != 3:
+                raise
+            raise LookupError(
+                "could not find revision id for %r" % revision)
+
+        prefix = 'revision-id:'
+        for line in log.split(os.linesep):
+            if line.startswith(prefix):
+                return line[len(prefix):].strip()
+        raise LookupError("could not find revision id for %r" % revision)
 
-            prefix = 'revision-id:'
-            for line in log.split(os.linesep):
-                if line.startswith(prefix):
-                    return line[len(prefix):].strip()
-            raise LookupError("could not find revision id for %r" % revision)
+    def get_tip_revid(self):
+        """Return the revid of the branch tip.
+
+        :returns: ``None`` for lightweight checkouts, because this
+                  would need to query the remote branch.
+        """
+        if self.options.get('bzr-init') == 'lightweight-checkout':
+            return None
+        try:
+            return self.get_revid('-1')
+        except LookupError:
+            return None
+
+    def is_recently_pulled(self, revision):
+        """True if the branch has been pulled recently and not moved since.
+
+        See the ``refs_cache`` parameter of :class:`BaseRepo`.
+        """
+        cached = self.get_cached_ref(revision)
+        return cached is not None and cached == self.get_tip_revid()
 
     def is_revno(self, revspec, fixed=False):
         """True iff revspec is a fixed revision number.
@@ -321,6 +385,12 @@ class BzrBranch(BaseRepo):
                     raise subprocess.CalledProcessError(
                         p.returncode, repr(['bzr', 'break-lock', target_dir]))
 
+            shared_branch = self.shared_branch_path()
+            if (shared_branch is not None and
+                    not self.is_bound_to(shared_branch)):
+                # URL has changed, hence the branch in the shared repository
+                self._switch_shared(shared_branch, revision)
+
             parent_changed = self.update_conf()
             unsafe_revno = parent_changed and self.is_revno(revision)
             fixed_rev = self.is_fixed_revision(revision)
@@ -351,8 +421,12 @@ class BzrBranch(BaseRepo):
                         "instead." % revision)
 
                 logger.info("Offline mode, no pull for revision %r", revision)
+            elif not parent_changed and self.is_recently_pulled(revision):
+                logger.info("Branch %s has been pulled recently, "
+                            "no pull for revision %r", target_dir, revision)
             else:
                 self._pull()
+                self.set_cached_ref(revision, self.get_tip_revid())
 
             if not (offline and init_opt in ('stacked-branch',
                                              'lightweight-checkout')):
@@ -383,6 +457,11 @@ class BzrBranch(BaseRepo):
                            "Replace by bzr-init=stacked-branch")
             default = "stacked-branch"
 
+        shared_branch = self.shared_branch_path()
+        if shared_branch is not None:
+            self._branch_shared(shared_branch, revision)
+            return
+
         bzr_opt = options.get("bzr-init", default)
         branch_cmd = ['bzr']
         if bzr_opt == "branch":
@@ -409,8 +488,72 @@ class BzrBranch(BaseRepo):
 
         clone_check_call(branch_cmd, env=SUBPROCESS_ENV)
 
+    def _branch_shared(self, shared_branch, revision):
+        """Make target dir a lightweight checkout of a shared repo branch.
+
+        The whole remote branch is retrieved in the shared repository,
+        or pulled if it's already there, so that revisions common with
+        other branches are not downloaded nor stored twice.
+        """
+        if not self._make_shared_branch(shared_branch):
+            self._pull()
+
+        checkout_cmd = ['bzr', 'checkout', '--lightweight']
+        if revision:
+            checkout_cmd.extend(['-r', revision])
+        logger.info("Lightweight checkout of %s ...", shared_branch)
+        clone_check_call(checkout_cmd + [shared_branch, self.target_dir],
+                         env=SUBPROCESS_ENV)
+
+    def _make_shared_branch(self, shared_branch):
+        """Branch :attr:`url` in the shared repo, creating it if needed.
+
+        :returns: ``False`` if the branch was already there.
+        """
+        shared_repo = os.path.dirname(shared_branch)
+        if not os.path.isdir(shared_repo):
+            os.makedirs(shared_repo)
+        with file_lock(os.path.join(shared_repo, 'buildout.lock')):
+            if not os.path.exists(os.path.join(shared_repo, '.bzr')):
+                logger.info("Creating Bazaar shared repository at %s",
+                            shared_repo)
+                clone_check_call(['bzr', 'init-repo', '--no-trees',
+                                  shared_repo], env=SUBPROCESS_ENV)
+
+        with file_lock(shared_branch + '.lock'):
+            if os.path.exists(shared_branch):
+                return False
+            logger.info("Branching %s in shared repository ...", self.url)
+            clone_check_call(['bzr', 'branch', self.url, shared_branch],
+                             env=SUBPROCESS_ENV)
+        return True
+
+    def _switch_shared(self, shared_branch, revision):
+        """Bind the target lightweight checkout to another shared branch.
+
+        This happens if :attr:`url` changed since the checkout was made.
+        """
+        if not os.path.exists(shared_branch):
+            if self.offline:
+                raise UserError(
+                    "Change of URL to %r for %s is forbidden in offline "
+                    "mode, as it is not in the shared repository "
+                    "yet." % (self.url, self.target_dir))
+            self._make_shared_branch(shared_branch)
+        logger.info("Switching %s to %s (URL changed to %s) ...",
+                    self.target_dir, shared_branch, self.url)
+        update_check_call(['bzr', 'switch', shared_branch],
+                          cwd=self.target_dir, env=SUBPROCESS_ENV)
+
     def _pull(self):
-        if self.options.get('bzr-init') == 'lightweight-checkout':
+        shared_branch = self.shared_branch_path()
+        if shared_branch is not None:
+            logger.info("Pull for branch %s in shared repository ...",
+                        shared_branch)
+            with file_lock(shared_branch + '.lock'):
+                update_check_call(['bzr', 'pull', '-d', shared_branch],
+                                  env=SUBPROCESS_ENV)
+        elif self.options.get('bzr-init') == 'lightweight-checkout':
             logger.info("Update lightweight checkout at %s ...",
                         self.target_dir)
             update_check_call(['bzr', 'update', self.target_dir],
@@ -421,6 +564,5 @@ class BzrBranch(BaseRepo):
                               env=SUBPROCESS_ENV)
 
     def archive(self, target_path):
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['bzr', 'export', target_path])
+        subprocess.check_call(['bzr', 'export', target_path],
+                              cwd=self.target_dir)
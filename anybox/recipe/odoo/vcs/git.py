@@ -1,11 +1,13 @@
 import os
+import re
 import subprocess
 import logging
 import tempfile
+from functools import partial
+from hashlib import sha1
 
 from zc.buildout import UserError
 from .. import utils
-from ..utils import working_directory_keeper
 from ..utils import check_output
 from .base import BaseRepo
 from .base import SUBPROCESS_ENV
@@ -33,6 +35,50 @@ def ishex(s):
     return True
 
 
+def read_refs(common_dir, prefix):
+    """Read refs from a Git directory, without calling Git.
+
+    Both packed refs and loose refs are read, the latter having precedence.
+
+    :param common_dir: the Git directory, or for worktrees, the one of
+                       the main repository (see ``git rev-parse
+                       --git-common-dir``).
+    :param prefix: the prefix of wanted refs, such as ``'refs/tags/'``.
+    :returns: a dict whose keys are ref names stripped from ``prefix``, and
+              values their target (SHA, or ``ref: `` followed by another ref
+              for symbolic refs).
+    :raises ValueError: if refs are not stored in files.
+    :raises EnvironmentError: if they can't be read.
+    """
+    if not os.path.isdir(common_dir):
+        raise IOError("Not a Git directory: %r" % common_dir)
+    if os.path.exists(os.path.join(common_dir, 'reftable')):
+        raise ValueError("Refs of %r are stored in the reftable format" % (
+            common_dir, ))
+    refs = {}
+    packed_path = os.path.join(common_dir, 'packed-refs')
+    if os.path.exists(packed_path):
+        with open(packed_path) as packed:
+            for line in packed:
+                if line.startswith(('#', '^')):
+                    continue
+                split = line.split()
+                if len(split) == 2 and split[1].startswith(prefix):
+                    refs[split[1][len(prefix):]] = split[0]
+
+    loose_dir = os.path.join(common_dir, *prefix.split('/'))
+    for dirpath, dirnames, filenames in os.walk(loose_dir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            with open(path) as loose:
+                target = loose.read().strip()
+            if not target:  # being written
+                continue
+            name = os.path.relpath(path, loose_dir).replace(os.sep, '/')
+            refs[name] = target
+    return refs
+
+
 class GitRepo(BaseRepo):
     """Represent a Git clone tied to a reference branch/commit/tag."""
 
@@ -42,6 +88,18 @@ class GitRepo(BaseRepo):
 
     _git_version = None
 
+    _updated_mirrors = set()
+    """Cache mirrors that have already been updated by this process."""
+
+    _cat_file = None
+    """The ``git cat-file`` process used by :meth:`object_info`."""
+
+    _remote_refs = {}
+    """Refs of remote repositories, see :meth:`preload_remote_refs`.
+
+    Keys are URLs, values are dicts mapping full ref names to SHAs.
+    """
+
     def __init__(self, *args, **kwargs):
         super(GitRepo, self).__init__(*args, **kwargs)
         depth = self.options.pop('depth', None)
@@ -57,6 +115,10 @@ class GitRepo(BaseRepo):
             if depth <= 0:
                 raise invalid
             self.options['depth'] = depth
+        filter_spec = self.options.pop('filter', None)
+        if filter_spec is not None and filter_spec != 'None':
+            # same override rules as depth
+            self.options['filter'] = filter_spec
 
     @property
     def git_version(self):
@@ -141,46 +203,161 @@ class GitRepo(BaseRepo):
                  log_level=logging.INFO, **kw):
         """Wrap a subprocess call with logging
 
+        The command is run from within the target directory, unless
+        ``cwd`` is explicitely passed. The process working directory is
+        never changed, so that several instances can work at the same time.
+
         :param meth: the calling method to use.
         """
+        kw.setdefault('cwd', self.target_dir)
         logger.log(log_level, "%s> call %r", self.target_dir, cmd)
         return callwith(cmd, **kw)
 
     def clean(self):
         if not os.path.isdir(self.target_dir):
             return
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['git', 'clean', '-fdqx'])
+        subprocess.check_call(['git', 'clean', '-fdqx'], cwd=self.target_dir)
 
     def parents(self, pip_compatible=False):
         """Return full hash of parent nodes.
 
         :param pip_compatible: ignored, all Git revspecs are pip compatible
         """
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            p = subprocess.Popen(['git', 'rev-parse', '--verify', 'HEAD'],
-                                 stdout=subprocess.PIPE, env=SUBPROCESS_ENV)
-            return p.communicate()[0].split()
+        p = subprocess.Popen(['git', 'rev-parse', '--verify', 'HEAD'],
+                             stdout=subprocess.PIPE, env=SUBPROCESS_ENV,
+                             cwd=self.target_dir)
+        return p.communicate()[0].split()
 
     def uncommitted_changes(self):
         """True if we have uncommitted changes."""
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            p = subprocess.Popen(['git', 'status', '--short'],
-                                 stdout=subprocess.PIPE, env=SUBPROCESS_ENV)
-            out = p.communicate()[0]
-            return bool(out.strip())
+        p = subprocess.Popen(['git', 'status', '--short'],
+                             stdout=subprocess.PIPE, env=SUBPROCESS_ENV,
+                             cwd=self.target_dir)
+        out = p.communicate()[0]
+        return bool(out.strip())
+
+    def cache_mirror_path(self):
+        """Return the path to the bare mirror of :attr:`url` in the cache.
+
+        :returns: ``None`` if the ``git-cache-directory`` option is not set.
+        """
+        cache_dir = self.options.get('git-cache-directory')
+        if not cache_dir:
+            return None
+        name = self.url.rstrip('/').rsplit('/', 1)[-1]
+        if name.endswith('.git'):
+            name = name[:-4]
+        name = re.sub(r'[^\w.-]+', '_', name)
+        return os.path.join(cache_dir, '%s-%s.git' % (
+            name, sha1(self.url.encode('utf-8')).hexdigest()[:12]))
+
+    def update_cache_mirror(self):
+        """Create or update the bare mirror of :attr:`url` in the cache.
+
+        The mirror is updated at most once per process. It is never garbage
+        collected, so that the objects borrowed by checkouts stay available.
+
+        :returns: the path to the mirror
+        """
+        mirror = self.cache_mirror_path()
+        cache_dir = os.path.dirname(mirror)
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:  # concurrent creation
+                if not os.path.isdir(cache_dir):
+                    raise
+
+        with utils.file_lock(mirror + '.lock'):
+            if mirror in GitRepo._updated_mirrors:
+                return mirror
+            if not os.path.exists(mirror):
+                logger.info("Creating cache mirror %s for %s",
+                            mirror, self.url)
+                self.log_call(['git', 'init', '--bare', mirror], cwd=None)
+                self.log_call(['git', 'config', 'gc.auto', '0'], cwd=mirror)
+                self.log_call(['git', 'remote', 'add', '--mirror=fetch',
+                               BUILDOUT_ORIGIN, self.url], cwd=mirror)
+            self.log_call(['git', 'fetch', BUILDOUT_ORIGIN],
+                          callwith=update_check_call, cwd=mirror)
+            GitRepo._updated_mirrors.add(mirror)
+        return mirror
+
+    def borrow_objects(self, mirror):
+        """Make the local repository use the objects of the given mirror.
+
+        This is done through Git's alternates mechanism.
+        """
+        info_dir = os.path.join(self.target_dir, '.git', 'objects', 'info')
+        alternates_path = os.path.join(info_dir, 'alternates')
+        mirror_objects = os.path.join(mirror, 'objects')
+        alternates = []
+        if os.path.exists(alternates_path):
+            with open(alternates_path) as alt_file:
+                alternates = [line.strip() for line in alt_file]
+        if mirror_objects in alternates:
+            return
+        if not os.path.isdir(info_dir):
+            os.makedirs(info_dir)
+        with open(alternates_path, 'a') as alt_file:
+            alt_file.write(mirror_objects + '\n')
+
+    def setup_partial_clone(self):
+        """Make the buildout remote a promisor remote, if filter is set.
+
+        Objects excluded by the filter (e.g., all blobs with ``blob:none``)
+        are then not fetched in advance, but only when needed, such as
+        upon checkout.
+        """
+        filter_spec = self.options.get('filter')
+        if filter_spec is None:
+            return
+        if self.git_version < (2, 19):
+            logger.warn("%s> partial clone needs Git >= 2.19, "
+                        "ignoring filter %r", self.target_dir, filter_spec)
+            return
+        remote_conf = 'remote.%s.' % BUILDOUT_ORIGIN
+        self.log_call(['git', 'config', remote_conf + 'promisor', 'true'],
+                      log_level=logging.DEBUG)
+        self.log_call(['git', 'config', remote_conf + 'partialclonefilter',
+                       filter_spec], log_level=logging.DEBUG)
+
+    def update_sparse_checkout(self):
+        """Restrict the working tree to ``subdir`` in partial clones.
+
+        This is a cone mode sparse checkout, done only if there is a filter
+        (see :meth:`setup_partial_clone`). Otherwise, a previous sparse
+        checkout is disabled.
+        """
+        subdir = self.options.get('subdir')
+        if subdir is not None and self.options.get('filter') is not None:
+            if self.git_version < (2, 25):
+                logger.warn("%s> sparse checkout needs Git >= 2.25, "
+                            "working tree won't be restricted to %r",
+                            self.target_dir, subdir)
+                return
+            self.log_call(['git', 'sparse-checkout', 'init', '--cone'],
+                          callwith=update_check_call)
+            self.log_call(['git', 'sparse-checkout', 'set', subdir],
+                          callwith=update_check_call)
+            return
+
+        try:
+            sparse = check_output(['git', 'config', '--bool',
+                                   'core.sparseCheckout'],
+                                  cwd=self.target_dir).strip()
+        except subprocess.CalledProcessError:  # not set
+            return
+        if sparse == 'true':
+            self.log_call(['git', 'sparse-checkout', 'disable'],
+                          callwith=update_check_call)
 
     def get_current_remote_fetch(self):
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            for line in self.log_call(['git', 'remote', '-v'],
-                                      callwith=check_output).splitlines():
-                if (line.endswith('(fetch)') and
-                        line.startswith(BUILDOUT_ORIGIN)):
-                    return line[len(BUILDOUT_ORIGIN):-7].strip()
+        for line in self.log_call(['git', 'remote', '-v'],
+                                  callwith=check_output).splitlines():
+            if (line.endswith('(fetch)') and
+                    line.startswith(BUILDOUT_ORIGIN)):
+                return line[len(BUILDOUT_ORIGIN):-7].strip()
 
     def offline_update(self, revision):
         target_dir = self.target_dir
@@ -201,27 +378,85 @@ class GitRepo(BaseRepo):
                             "Cannot update adresses in offline mode." % (
                                 self.target_dir, current_url, self.url))
         self.log_call(['git', 'checkout', revision],
-                      callwith=update_check_call,
-                      cwd=self.target_dir)
+                      callwith=update_check_call)
 
     def is_local_fixed_revision(self, refspec):
         """In Git, tags only are reproductible refspec."""
-        tags = (t.strip()
-                for t in self.log_call(['git', 'tag'],
-                                       callwith=check_output,
-                                       cwd=self.target_dir).splitlines())
-        return refspec in tags
+        return refspec in self.local_tags()
 
-    def has_commit(self, sha):
-        """Return true if repo has specified commit"""
+    def local_tags(self):
+        """Return the names of the tags of the local repository.
+
+        They are read directly from the Git directory, with a fallback to
+        ``git tag`` if that's not possible.
+        """
+        try:
+            return set(read_refs(self.common_git_dir, 'refs/tags/'))
+        except (ValueError, EnvironmentError) as exc:
+            logger.debug("%s> could not read tags directly (%s), "
+                         "calling git", self.target_dir, exc)
+        return set(t.strip()
+                   for t in self.log_call(['git', 'tag'],
+                                          callwith=check_output).splitlines())
+
+    def object_info(self, obj):
+        """Return the SHA and type of a local object, given by any name.
+
+        Queries are sent to a ``git cat-file --batch-check`` process that
+        is started on first use and kept running until :meth:`close` is
+        called. Objects and refs created meanwhile are seen by the process.
+
+        :returns: ``(sha, type)``, or ``None`` if not found.
+        """
+        if '\n' in obj or not os.path.isdir(self.target_dir):
+            return None
+        for attempt in range(2):
+            cat_file = self._cat_file
+            if cat_file is None or cat_file.poll() is not None:
+                cat_file = self._cat_file = subprocess.Popen(
+                    ['git', 'cat-file', '--batch-check'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                    cwd=self.target_dir,
+                    env=SUBPROCESS_ENV, bufsize=1, universal_newlines=True)
+                self.register_open()
+            try:
+                cat_file.stdin.write(obj + '\n')
+                cat_file.stdin.flush()
+                answer = cat_file.stdout.readline().split()
+            except (IOError, OSError):
+                answer = []
+            if answer:
+                break
+            # the process died, most probably because the repository
+            # has been removed. Let's try once with a new one.
+            self.close()
+        else:
+            return None
+
+        if answer[-1] in ('missing', 'ambiguous') or len(answer) != 3:
+            return None
+        return answer[0], answer[1]
+
+    def close(self):
+        """Stop the ``git cat-file`` process, if any."""
+        cat_file = self._cat_file
+        if cat_file is None:
+            return
+        self._cat_file = None
         try:
-            objtype = check_output(['git', 'cat-file', '-t', sha],
-                                   cwd=self.target_dir,
-                                   stderr=subprocess.PIPE).strip()
-        except subprocess.CalledProcessError:
-            return False
+            cat_file.stdin.close()
+        except (IOError, OSError):
+            pass
+        cat_file.wait()
+
+    def clear_target(self):
+        self.close()
+        super(GitRepo, self).clear_target()
 
-        return objtype == 'commit'
+    def has_commit(self, sha):
+        """Return true if repo has specified commit"""
+        info = self.object_info(sha)
+        return info is not None and info[1] == 'commit'
 
     def fetch_remote_sha(self, sha, checkout=True):
         """Fetch a precise SHA from remote if necessary.
@@ -264,18 +499,60 @@ class GitRepo(BaseRepo):
         :return: ``sha`` the hash of a given ref if known to the local git repo
                 ``None`` if the ref is unkown
         """
-        if self.has_commit(ref):
-            ref_hash = check_output(
-                ['git', 'show', '--pretty=format:%H', '-s', ref],
-                cwd=self.target_dir,
-                stderr=subprocess.PIPE
-            ).strip()
-            return ref_hash
+        info = self.object_info(ref)
+        if info is not None and info[1] == 'commit':
+            return info[0]
         return None
 
+    @staticmethod
+    def parse_ls_remote(out):
+        """Parse ``git ls-remote`` output into a dict of full refs to SHAs.
+
+        Example::
+
+          >>> refs = GitRepo.parse_ls_remote("1234abcd\\tHEAD\\n"
+          ...                                "1234abcd\\trefs/heads/master\\n")
+          >>> refs['refs/heads/master']
+          '1234abcd'
+        """
+        return dict(reversed(li.split()) for li in out.strip().splitlines())
+
+    @classmethod
+    def preload_remote_refs(cls, urls, jobs=1):
+        """List the branches and tags of all given remote URLs at once.
+
+        This is one ``git ls-remote`` per URL, run up to ``jobs`` at a time.
+        Afterwards, :meth:`query_remote_ref` resolves refs of these remotes
+        without any network round-trip, until :meth:`clear_remote_refs`
+        is called.
+
+        Failures are only logged: the remote will be queried again by the
+        repositories that need it, and errors reported from there.
+        """
+        def ls_remote(url):
+            logger.info("Listing remote refs of %s", url)
+            out = utils.check_output(['git', 'ls-remote', url, 'HEAD',
+                                      'refs/heads/*', 'refs/tags/*'])
+            cls._remote_refs[url] = cls.parse_ls_remote(out)
+
+        urls = [url for url in set(urls) if url not in cls._remote_refs]
+        tasks = [(url, partial(ls_remote, url)) for url in sorted(urls)]
+        for url, exc_info in utils.run_jobs(jobs, tasks):
+            logger.warn("Could not list remote refs of %s: %s",
+                        url, exc_info[1])
+
+    @classmethod
+    def clear_remote_refs(cls):
+        """Forget about the remote refs loaded by :meth:`preload_remote_refs`.
+        """
+        cls._remote_refs.clear()
+
     def query_remote_ref(self, remote, ref):
         """Query remote repo about given ref.
 
+        If the remote refs have been preloaded (see
+        :meth:`preload_remote_refs`), they are used instead of an actual query.
+
         :return: ``('tag', sha)`` if ref is a tag in remote
                  ``('branch', sha)`` if ref is branch (aka "head") in remote
                  ``(None, ref)`` if ref does not exist in remote. This happens
@@ -285,16 +562,18 @@ class GitRepo(BaseRepo):
             # shortcut for commit hashes: if ref is a commit hash and git
             # already knows it as a commit, we can skip the remote querying
             return (None, ref)
-        out = self.log_call(['git', 'ls-remote', remote, ref],
-                            cwd=self.target_dir,
-                            callwith=check_output).strip()
-        for sha, fullref in (li.split() for li in out.splitlines()):
-            if fullref == 'refs/heads/' + ref:
-                return 'branch', sha
-            elif fullref == 'refs/tags/' + ref:
-                return 'tag', sha
-            elif fullref == ref and ref == 'HEAD':
-                return 'HEAD', sha
+        refs = self._remote_refs.get(
+            self.url if remote == BUILDOUT_ORIGIN else remote)
+        if refs is None:
+            refs = self.parse_ls_remote(self.log_call(
+                ['git', 'ls-remote', remote, ref], callwith=check_output))
+        for rtype, prefix in (('branch', 'refs/heads/'),
+                              ('tag', 'refs/tags/')):
+            sha = refs.get(prefix + ref)
+            if sha is not None:
+                return rtype, sha
+        if ref == 'HEAD' and 'HEAD' in refs:
+            return 'HEAD', refs['HEAD']
         return None, ref
 
     dangerous_revisions = ('FETCH_HEAD', 'ORIG_HEAD', 'MERGE_HEAD',
@@ -326,64 +605,215 @@ class GitRepo(BaseRepo):
         if self.options.get('merge'):
             return self.merge(revision)
 
+        if self.options.get('worktree_of'):
+            if os.path.isdir(os.path.join(self.target_dir, '.git')):
+                logger.warn("%s> is a full clone, and can't become a "
+                            "worktree of %s. Remove it to save resources.",
+                            self.target_dir, self.options['worktree_of'])
+            else:
+                return self.update_worktree(revision)
+
         if self.offline:
             return self.offline_update(revision)
 
         target_dir = self.target_dir
         url = self.url
 
-        with working_directory_keeper:
-            is_new = not os.path.exists(target_dir)
-            if is_new:
-                self.log_call(['git', 'init', target_dir])
+        mirror = self.cache_mirror_path()
+
+        is_new = not os.path.exists(target_dir)
+        if is_new:
+            self.log_call(['git', 'init', target_dir], cwd=None)
+        if mirror is not None and os.path.exists(mirror):
+            # objects already in the cache count for the shortcuts below
+            self.borrow_objects(mirror)
+
+        self.log_call(['git', 'remote', 'add' if is_new else 'set-url',
+                       BUILDOUT_ORIGIN, url],
+                      log_level=logging.DEBUG)
+        if mirror is None:
+            # with a cache mirror, all objects are already available locally
+            self.setup_partial_clone()
+        self.update_sparse_checkout()
+
+        # if pinned, try to find on local first
+        if ishex(revision) and self.has_commit(revision):
+            self.log_call(['git', 'checkout', revision],
+                          callwith=update_check_call)
+            return
+        cached = self.get_cached_ref(revision)
+        if cached is not None and self.has_resolved_ref(revision, *cached):
+            logger.info("%s> %r has been resolved recently as %s, "
+                        "skipping remote query and fetch",
+                        target_dir, revision, cached[1])
+            return self.update_resolved_ref(revision, *cached)
+
+        if mirror is not None:
+            # only now that a fetch is needed
+            self.update_cache_mirror()
+            self.borrow_objects(mirror)
+        rtype, sha = self.resolve_and_fetch(revision, mirror=mirror)
+        if rtype is None and ishex(revision):
+            return self.fetch_remote_sha(revision)
+
+        self.update_resolved_ref(revision, rtype, 'FETCH_HEAD')
+        self.set_cached_ref(revision, [rtype, sha])
+
+    def resolve_and_fetch(self, revision, mirror=None):
+        """Query the remote about revision, and fetch it if it is a ref.
+
+        :param mirror: path to the cache mirror, if any. Refs are then
+                       resolved and fetched from there.
+        :returns: same as :meth:`query_remote_ref`. Unless the type is
+                  ``None``, the commit is fetched as ``FETCH_HEAD``.
+        """
+        # with a cache mirror, refs are resolved and fetched locally
+        # (remote HEAD is not tracked by the mirror)
+        if mirror is None or revision == 'HEAD':
+            fetch_remote = BUILDOUT_ORIGIN
+        else:
+            fetch_remote = mirror
+        rtype, sha = self.query_remote_ref(fetch_remote, revision)
+        if rtype is None and ishex(revision):
+            return rtype, sha
+
+        fetch_cmd = ['git', 'fetch']
+        depth = self.options.get('depth')
+        if depth is not None:
+            fetch_cmd.extend(('--depth', str(depth)))
+        if rtype == 'tag':
+            fetch_refspec = '+refs/tags/%s:refs/tags/%s' % (revision,
+                                                            revision)
+        else:
+            fetch_refspec = revision
+        fetch_cmd.extend((fetch_remote, fetch_refspec))
+        self.log_call(fetch_cmd, callwith=update_check_call)
+        return rtype, sha
 
-            os.chdir(target_dir)
-            self.log_call(['git', 'remote', 'add' if is_new else 'set-url',
-                           BUILDOUT_ORIGIN, url],
-                          log_level=logging.DEBUG)
+    def fetch_revision(self, revision):
+        """Make revision locally available, without touching the working tree.
 
-            # if pinned, try to find on local first
-            if ishex(revision) and self.has_commit(revision):
-                self.log_call(['git', 'checkout', revision],
-                              callwith=update_check_call)
-                return
-            rtype, sha = self.query_remote_ref(BUILDOUT_ORIGIN, revision)
+        :returns: a local commit-ish for revision.
+        """
+        if ishex(revision) and self.has_commit(revision):
+            return revision
+        cached = self.get_cached_ref(revision)
+        if cached is not None and self.has_resolved_ref(revision, *cached):
+            rtype, sha = cached
+        else:
+            mirror = None
+            if self.options.get('git-cache-directory'):
+                mirror = self.update_cache_mirror()
+            rtype, sha = self.resolve_and_fetch(revision, mirror=mirror)
             if rtype is None and ishex(revision):
-                return self.fetch_remote_sha(revision)
-
-            fetch_cmd = ['git', 'fetch']
-            depth = self.options.get('depth')
-            if depth is not None:
-                fetch_cmd.extend(('--depth', str(depth)))
-            if rtype == 'tag':
-                fetch_refspec = '+refs/tags/%s:refs/tags/%s' % (revision,
-                                                                revision)
-            else:
-                fetch_refspec = revision
-            fetch_cmd.extend((BUILDOUT_ORIGIN, fetch_refspec))
-            self.log_call(fetch_cmd, callwith=update_check_call)
-
-            if rtype == 'tag':
-                self.log_call(['git', 'checkout', revision],
-                              callwith=update_check_call)
-            elif rtype in ('branch', 'HEAD'):
-                self.update_fetched_branch(revision)
-            else:
+                self.fetch_remote_sha(revision, checkout=False)
+                return revision
+            if rtype not in ('tag', 'branch', 'HEAD'):
                 raise NotImplementedError(
                     "Unknown remote reference type %r" % rtype)
+            self.set_cached_ref(revision, [rtype, sha])
+        if rtype == 'tag':
+            return 'refs/tags/' + revision
+        return sha
+
+    @property
+    def git_dir(self):
+        """Path to the Git directory, taking worktrees into account."""
+        dot_git = os.path.join(self.target_dir, '.git')
+        if os.path.isfile(dot_git):
+            with open(dot_git) as dot_git_file:
+                content = dot_git_file.read().strip()
+            if content.startswith('gitdir:'):
+                return os.path.join(self.target_dir,
+                                    content[len('gitdir:'):].strip())
+        return dot_git
+
+    @property
+    def common_git_dir(self):
+        """Path to the Git directory holding refs shared by all worktrees."""
+        git_dir = self.git_dir
+        commondir_path = os.path.join(git_dir, 'commondir')
+        if not os.path.exists(commondir_path):
+            return git_dir
+        with open(commondir_path) as commondir:
+            return os.path.normpath(
+                os.path.join(git_dir, commondir.read().strip()))
+
+    @property
+    def fingerprint_path(self):
+        return os.path.join(self.git_dir, 'buildout-fingerprint.json')
+
+    def worktree_main_repo(self):
+        """Return the repository the target is a worktree of.
+
+        It is given by the ``worktree_of`` option, and has the same URL.
+        """
+        options = dict((k, v) for k, v in self.options.items()
+                       if k not in ('worktree_of', 'subdir', 'group', 'clean'))
+        return GitRepo(self.options['worktree_of'], self.url,
+                       offline=self.offline, refs_cache=self.refs_cache,
+                       **options)
+
+    def update_worktree(self, revision):
+        """Put the target, a worktree of another repository, at revision.
+
+        All fetching is done in the main repository, and the worktree is
+        always in detached state, so that several worktrees can be at the
+        same branch.
+        """
+        main = self.worktree_main_repo()
+        try:
+            commit = (revision if self.offline
+                      else main.fetch_revision(revision))
+        finally:
+            main.close()
+        if os.path.exists(self.target_dir):
+            self.log_call(['git', 'checkout', '--detach', commit],
+                          callwith=update_check_call)
+            return
+
+        # forget about previously removed worktrees
+        main.log_call(['git', 'worktree', 'prune'], log_level=logging.DEBUG)
+        main.log_call(['git', 'worktree', 'add', '--detach',
+                       self.target_dir, commit], callwith=update_check_call)
+
+    def has_resolved_ref(self, revision, rtype, sha):
+        """True if the resolution of a remote ref is locally available.
 
-    def update_fetched_branch(self, branch):
+        :param rtype: reference type, as returned by :meth:`query_remote_ref`
+        """
+        if rtype == 'tag':
+            info = self.object_info('refs/tags/' + revision)
+            return info is not None and info[0] == sha
+        return self.has_commit(sha)
+
+    def update_resolved_ref(self, revision, rtype, commit):
+        """Put the working tree at a resolved and fetched remote ref.
+
+        :param rtype: reference type, as returned by :meth:`query_remote_ref`
+        :param commit: the fetched commit (a SHA or ``FETCH_HEAD``)
+        """
+        if rtype == 'tag':
+            self.log_call(['git', 'checkout', revision],
+                          callwith=update_check_call)
+        elif rtype in ('branch', 'HEAD'):
+            self.update_fetched_branch(revision, commit=commit)
+        else:
+            raise NotImplementedError(
+                "Unknown remote reference type %r" % rtype)
+
+    def update_fetched_branch(self, branch, commit='FETCH_HEAD'):
         # TODO: check what happens when there are local changes
         # TODO: what about the 'clean' option
         # setup remote tracking branch, in all cases
         # it's necessary with Git 1.7.10, not with 1.9.3 and shoud not
         # harm
         self.log_call(['git', 'update-ref', '/'.join((
-            'refs', 'remotes', BUILDOUT_ORIGIN, branch)), 'FETCH_HEAD'])
+            'refs', 'remotes', BUILDOUT_ORIGIN, branch)), commit])
         if self.options.get('depth') or branch == 'HEAD':
             # doing it the other way does not work, at least
             # not on Git 1.7
-            self.log_call(['git', 'checkout', 'FETCH_HEAD'],
+            self.log_call(['git', 'checkout', commit],
                           callwith=update_check_call)
             if branch != 'HEAD':
                 self.log_call(['git', 'branch', '-f', branch],
@@ -391,14 +821,14 @@ class GitRepo(BaseRepo):
             return
 
         if not self._is_a_branch(branch):
-            self.log_call(['git', 'checkout', '-b', branch, 'FETCH_HEAD'],
+            self.log_call(['git', 'checkout', '-b', branch, commit],
                           callwith=update_check_call)
         else:
             # switch, then fast-forward
             self.log_call(['git', 'checkout', branch],
                           callwith=update_check_call)
             try:
-                self.log_call(['git', 'merge', '--ff-only', 'FETCH_HEAD'],
+                self.log_call(['git', 'merge', '--ff-only', commit],
                               callwith=update_check_call)
             except UpdateError:
                 if not self.clear_retry:
@@ -414,7 +844,7 @@ class GitRepo(BaseRepo):
                                 "but clear-retry option is active: "
                                 "trying a reset in case that's a "
                                 "simple fast-forward issue.", self)
-                    self.log_call(['git', 'reset', '--hard', 'FETCH_HEAD'],
+                    self.log_call(['git', 'reset', '--hard', commit],
                                   callwith=update_check_call)
 
     def _no_edit(self, cmd):
@@ -435,61 +865,110 @@ class GitRepo(BaseRepo):
             raise UserError("Branch %s not found in git repository "
                             "%s (offline mode)" % (revision, self))
         cmd = self._no_edit(['git', 'merge', revision])
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            self.log_call(cmd)
+        self.log_call(cmd)
 
     def merge(self, revision):
-        """Merge revision into current branch"""
-        with working_directory_keeper:
-            if not self.is_versioned(self.target_dir):
-                raise RuntimeError("Cannot merge into non existent "
-                                   "or non git local directory %s" %
-                                   self.target_dir)
-            os.chdir(self.target_dir)
-            rtype, sha = self.query_remote_ref(self.url, revision)
-            if rtype is None and ishex(revision):
-                self.fetch_remote_sha(revision, checkout=False)
-                cmd = ['git', 'merge', revision]
-            else:
-                cmd = ['git', 'pull', self.url, revision]
-            if self.git_version >= (1, 7, 10):
-                # --edit and --no-edit appear with Git 1.7.10
-                # see Documentation/RelNotes/1.7.10.txt of Git
-                # (https://git.kernel.org/cgit/git/git.git/tree)
-                cmd.insert(2, '--no-edit')
+        """Merge revision into current branch.
 
-            self.log_call(self._no_edit(cmd))
+        The resulting commits are kept as
+        ``refs/buildout-merges/<key>``, the key being computed from the
+        current and merged commits: merging the same revision into the
+        same commit again is then a mere fast-forward, without any fetch.
+        """
+        if not self.is_versioned(self.target_dir):
+            raise RuntimeError("Cannot merge into non existent "
+                               "or non git local directory %s" %
+                               self.target_dir)
+        rtype, sha = self.query_remote_ref(self.url, revision)
+        base = self.object_info('HEAD')
+        cache_ref = None
+        if base is not None:
+            cache_ref = self.merge_cache_ref(base[0], sha)
+            cached = self.object_info(cache_ref)
+            if cached is not None:
+                logger.info("%s> merge of %r into %s has already been done, "
+                            "reusing it", self.target_dir, revision, base[0])
+                self.log_call(['git', 'merge', '--ff-only', cached[0]],
+                              callwith=update_check_call)
+                return
+
+        if rtype is None and ishex(revision):
+            self.fetch_remote_sha(revision, checkout=False)
+            cmd = ['git', 'merge', revision]
+        elif rtype is not None and self.object_info(sha) is not None:
+            # already fetched, e.g., by fetch_merge_revisions()
+            cmd = ['git', 'merge', '-m', "Merge %s '%s' of %s" % (
+                rtype, revision, self.url), sha]
+        else:
+            # fetch, then merge, rather than pull, which can refuse to merge
+            # divergent branches, depending on the Git version and settings
+            self.log_call(['git', 'fetch', self.url, revision],
+                          callwith=update_check_call)
+            cmd = ['git', 'merge', 'FETCH_HEAD']
+        self.log_call(self._no_edit(cmd))
+        if cache_ref is not None:
+            self.log_call(['git', 'update-ref', cache_ref, 'HEAD'],
+                          log_level=logging.DEBUG)
+
+    def fetch_merge_revisions(self, revisions):
+        """Fetch several remote branches or tags to merge, in one go.
+
+        Those that are not in the remote, or already available locally
+        are skipped. :meth:`merge` then doesn't fetch them again.
+        """
+        if not self.is_versioned(self.target_dir):
+            return
+        refs = []
+        try:
+            for revision in revisions:
+                rtype, sha = self.query_remote_ref(self.url, revision)
+                if rtype in ('branch', 'tag') and (
+                        self.object_info(sha) is None):
+                    prefix = 'refs/heads/' if rtype == 'branch' else (
+                        'refs/tags/')
+                    refs.append(prefix + revision)
+            if refs:
+                self.log_call(['git', 'fetch', self.url] + refs,
+                              callwith=update_check_call)
+        finally:
+            self.close()
+
+    @staticmethod
+    def merge_cache_ref(base, *merged):
+        """Return the ref to record merging commits into base commit.
+
+        >>> GitRepo.merge_cache_ref('abc', 'def')
+        'refs/buildout-merges/4d93fd047780e2977f8a1c9868599ebb2bbfc29f'
+        """
+        key = ' '.join((base, ) + tuple(sorted(merged)))
+        return 'refs/buildout-merges/' + sha1(key.encode('utf-8')).hexdigest()
 
     def archive(self, target_path):
         # TODO: does this work with merge-ins?
         revision = self.parents()[0]
         if not os.path.exists(target_path):
             os.makedirs(target_path)
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            target_tar = tempfile.NamedTemporaryFile(
-                prefix=os.path.split(self.target_dir)[1] + '.tar')
-            target_tar.file.close()
-            subprocess.check_call(['git', 'archive', revision,
-                                   '-o', target_tar.name])
-            subprocess.check_call(['tar', '-x', '-f', target_tar.name,
-                                   '-C', target_path])
-            os.unlink(target_tar.name)
+        target_tar = tempfile.NamedTemporaryFile(
+            prefix=os.path.split(self.target_dir)[1] + '.tar')
+        target_tar.file.close()
+        subprocess.check_call(['git', 'archive', revision,
+                               '-o', target_tar.name], cwd=self.target_dir)
+        subprocess.check_call(['tar', '-x', '-f', target_tar.name,
+                               '-C', target_path])
+        os.unlink(target_tar.name)
 
     def revert(self, revision):
-        with working_directory_keeper:
-            os.chdir(self.target_dir)
-            subprocess.check_call(['git', 'checkout', revision])
-            if self._is_a_branch(revision):
-                self.log_call(['git', 'reset', '--hard',
-                              BUILDOUT_ORIGIN + '/' + revision],
-                              callwith=update_check_call)
-            else:
-                self.log_call(['git', 'reset', '--hard', revision])
+        subprocess.check_call(['git', 'checkout', revision],
+                              cwd=self.target_dir)
+        if self._is_a_branch(revision):
+            self.log_call(['git', 'reset', '--hard',
+                          BUILDOUT_ORIGIN + '/' + revision],
+                          callwith=update_check_call)
+        else:
+            self.log_call(['git', 'reset', '--hard', revision])
 
     def _is_a_branch(self, revision):
         # if this fails, we have a seriously corrupted repo
-        branches = update_check_output(["git", "branch"])
+        branches = update_check_output(["git", "branch"], cwd=self.target_dir)
         branches = branches.split()
         return revision in branches
@@ -1,4 +1,6 @@
 import os
+import sys
+import struct
 import logging
 import subprocess
 import warnings
@@ -14,17 +16,156 @@ from zc.buildout import UserError
 from .base import BaseRepo
 from .base import SUBPROCESS_ENV
 from .base import update_check_call
+from .base import UpdateError
 from ..utils import check_output
 
 logger = logging.getLogger(__name__)
 
 
+class HgCommandServer(object):
+    """Client for a Mercurial command server, talking through pipes.
+
+    The server runs Mercurial commands in the same process, therefore
+    saving the interpreter and extensions startup time of each of them.
+    Protocol reference: https://www.mercurial-scm.org/wiki/CommandServer
+
+    The server reads the repository configuration at startup only: it has
+    to be closed and restarted to take changes into account.
+    """
+
+    def __init__(self, repo_dir):
+        self.process = subprocess.Popen(
+            ['hg', 'serve', '--cmdserver', 'pipe'], cwd=repo_dir,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=SUBPROCESS_ENV)
+        channel, hello = self.read_message()
+        if channel != b'o' or b'runcommand' not in hello:
+            self.close()
+            raise EnvironmentError(
+                "Unexpected greeting from Mercurial command server: %r" % (
+                    hello, ))
+
+    def read_exactly(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size:
+            raise EnvironmentError("Mercurial command server died")
+        return data
+
+    def read_message(self):
+        """Read a message from the server.
+
+        :returns: ``(channel, data)``. For input channels, ``data`` is the
+                  requested size.
+        """
+        header = self.read_exactly(5)
+        channel, length = header[:1], struct.unpack('>I', header[1:])[0]
+        if channel in (b'I', b'L'):
+            return channel, length
+        return channel, self.read_exactly(length)
+
+    def runcommand(self, args):
+        """Run a Mercurial command.
+
+        :param args: the command line arguments, without the leading ``hg``
+        :returns: return code, standard output and error output
+        """
+        data = b'\0'.join(
+            a if isinstance(a, bytes) else a.encode('utf-8') for a in args)
+        stdin = self.process.stdin
+        stdin.write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+        stdin.flush()
+        out, err = [], []
+        while True:
+            channel, data = self.read_message()
+            if channel == b'o':
+                out.append(data)
+            elif channel == b'e':
+                err.append(data)
+            elif channel == b'r':
+                return (struct.unpack('>i', data)[0],
+                        b''.join(out), b''.join(err))
+            elif channel in (b'I', b'L'):
+                # no input to provide, this is like a closed stdin
+                stdin.write(struct.pack('>I', 0))
+                stdin.flush()
+            elif channel.isupper():
+                raise EnvironmentError("Unsupported required channel %r in "
+                                       "Mercurial command server" % channel)
+            # other optional channels (debug) are ignored
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.process.wait()
+
+
 class HgRepo(BaseRepo):
+    """Represent a Mercurial clone.
+
+    If the ``hg-cmdserver`` option is ``true``, commands on an existing
+    clone are run through a :class:`HgCommandServer`, started on first use
+    and stopped by :meth:`close`.
+    """
 
     vcs_control_dir = '.hg'
 
     vcs_official_name = 'Mercurial'
 
+    cmdserver = False
+    """Default value of the ``hg-cmdserver`` option."""
+
+    _server = None
+
+    def __init__(self, *args, **kwargs):
+        super(HgRepo, self).__init__(*args, **kwargs)
+        cmdserver = self.options.get('hg-cmdserver')
+        if cmdserver is not None:
+            self.cmdserver = str(cmdserver).lower() == 'true'
+
+    def close(self):
+        """Stop the command server, if any."""
+        server = self._server
+        if server is not None:
+            self._server = None
+            server.close()
+
+    def hg_call(self, cmd, callwith=subprocess.check_call, **kwargs):
+        """Run a Mercurial command line, possibly through the command server.
+
+        :param cmd: the full command line, starting with ``hg``.
+        :param callwith: :func:`subprocess.check_call`,
+                         :func:`update_check_call` or :func:`check_output`.
+                         Without command server, it is simply used.
+                         Otherwise, its return value and exceptions
+                         are reproduced.
+        :param kwargs: passed to ``callwith``. With the command server,
+                       ``stderr`` is used only to know whether error output
+                       has to be displayed.
+        """
+        if not self.cmdserver or not self.is_versioned(self.target_dir):
+            return callwith(cmd, env=SUBPROCESS_ENV, **kwargs)
+
+        if self._server is None:
+            self._server = HgCommandServer(self.target_dir)
+            self.register_open()
+        ret, out, err = self._server.runcommand(cmd[1:])
+        if str is not bytes:  # Python 3
+            out, err = out.decode('utf-8'), err.decode('utf-8')
+        if 'stderr' not in kwargs:
+            sys.stderr.write(err)
+        if callwith is not check_output:
+            sys.stdout.write(out)
+        if ret:
+            exc_cls = (UpdateError if callwith is update_check_call
+                       else subprocess.CalledProcessError)
+            exc = exc_cls(ret, cmd)
+            exc.output = out
+            raise exc
+        if callwith is check_output:
+            return out
+        return 0
+
     def update_hgrc_paths(self):
         """Update hgrc paths section if needed.
 
@@ -63,20 +204,21 @@ class HgRepo(BaseRepo):
         f = open(hgrc_path, 'w')
         parser.write(f)
         f.close()
+        self.close()  # the command server would not see the change
 
     def uncommitted_changes(self):
         """True if we have uncommitted changes."""
-        return bool(check_output(['hg', '--cwd', self.target_dir, 'status'],
-                                 env=SUBPROCESS_ENV))
+        return bool(self.hg_call(['hg', '--cwd', self.target_dir, 'status'],
+                                 callwith=check_output))
 
     def parents(self, pip_compatible=False):
         """Return full hash of parent nodes.
 
         :param pip_compatible: ignored, all Hg revspecs are pip compatible
         """
-        return check_output(['hg', '--cwd', self.target_dir, 'parents',
+        return self.hg_call(['hg', '--cwd', self.target_dir, 'parents',
                              '--template={node}'],
-                            env=SUBPROCESS_ENV).split()
+                            callwith=check_output).split()
 
     def have_fixed_revision(self, revstr):
         warnings.warn("have_fixed_revision() is deprecated and has been "
@@ -114,10 +256,10 @@ class HgRepo(BaseRepo):
             return False
 
         try:
-            out = check_output(['hg', '--cwd', self.target_dir, 'log',
+            out = self.hg_call(['hg', '--cwd', self.target_dir, 'log',
                                 '-r', revstr,
                                 '--template={node}\n{tags}\n{rev}'],
-                               env=SUBPROCESS_ENV)
+                               callwith=check_output)
         except subprocess.CalledProcessError:
             return False
 
@@ -150,7 +292,7 @@ class HgRepo(BaseRepo):
             return
 
         try:
-            subprocess.check_call(['hg', 'purge', '--cwd', self.target_dir])
+            self.hg_call(['hg', 'purge', '--cwd', self.target_dir])
         except subprocess.CalledProcessError as exc:
             if exc.returncode == 255:
                 # fallback to default implementation
@@ -183,6 +325,7 @@ class HgRepo(BaseRepo):
                 clone_cmd.extend(['-r', revision])
             clone_cmd.extend([url, target_dir])
             subprocess.check_call(clone_cmd, env=SUBPROCESS_ENV)
+            self.set_cached_ref(revision, self.get_node(revision))
         else:
             self.update_hgrc_paths()
             # TODO what if remote repo is actually local fs ?
@@ -190,14 +333,42 @@ class HgRepo(BaseRepo):
                 self._update(revision)
                 return
 
-            if not offline:
+            if offline:
+                pass
+            elif self.is_recently_pulled(revision):
+                logger.info("Revision %r of hg repo %r has been pulled "
+                            "recently, skipping pull", revision, target_dir)
+            else:
                 self._pull()
+                self.set_cached_ref(revision, self.get_node(revision))
             self._update(revision)
 
+    def get_node(self, revision):
+        """Return the full hash of a locally available revision.
+
+        :returns: ``None`` if the revision is not available (or empty).
+        """
+        if not revision:
+            return None
+        try:
+            return self.hg_call(['hg', '--cwd', self.target_dir, 'log',
+                                 '-r', revision, '--template={node}'],
+                                callwith=check_output,
+                                stderr=subprocess.PIPE).strip()
+        except subprocess.CalledProcessError:
+            return None
+
+    def is_recently_pulled(self, revision):
+        """True if revision has been pulled recently and not moved since.
+
+        See the ``refs_cache`` parameter of :class:`BaseRepo`.
+        """
+        cached = self.get_cached_ref(revision)
+        return cached is not None and cached == self.get_node(revision)
+
     def _pull(self):
         logger.info("Pull for hg repo %r ...", self.target_dir)
-        subprocess.check_call(['hg', '--cwd', self.target_dir, 'pull'],
-                              env=SUBPROCESS_ENV)
+        self.hg_call(['hg', '--cwd', self.target_dir, 'pull'])
 
     def _update(self, revision):
         target_dir = self.target_dir
@@ -205,8 +376,8 @@ class HgRepo(BaseRepo):
         up_cmd = ['hg', '--cwd', target_dir, 'up']
         if revision:
             up_cmd.extend(['-r', revision])
-        update_check_call(up_cmd, env=SUBPROCESS_ENV)
+        self.hg_call(up_cmd, callwith=update_check_call)
 
     def archive(self, target_path):
-        subprocess.check_call(['hg', '--cwd', self.target_dir,
-                               'archive', target_path])
+        self.hg_call(['hg', '--cwd', self.target_dir,
+                      'archive', target_path])
@@ -3,6 +3,7 @@ import os
 import shutil
 from tempfile import mkdtemp
 from ..utils import working_directory_keeper
+from .base import close_all
 
 COMMIT_USER_NAME = 'Test'
 COMMIT_USER_EMAIL = 'test@example.org'
@@ -28,4 +29,6 @@ class VcsTestCase(unittest.TestCase):
         raise NotImplementedError
 
     def tearDown(self):
+        # repositories used outside of their __call__ are not closed
+        close_all()
         shutil.rmtree(self.sandbox)
@@ -4,13 +4,17 @@ These tests depend on system executables, such as 'hg', 'bzr', etc.
 """
 
 import os
+import time
+import unittest
 import subprocess
+from tempfile import mkdtemp
+import shutil
 
 from zc.buildout import UserError
 from .. import get_update
 from .. import testing
 from .. import SUPPORTED
-from ..base import UpdateError, BaseRepo
+from ..base import UpdateError, BaseRepo, RefsCache
 from ..hg import HgRepo
 
 
@@ -66,3 +70,128 @@ class CommonTestCase(testing.VcsTestCase):
         # no such wild retry in offline mode
         self.assertRaises(UpdateError, get_update, 'hg_fails_updates',
                           repo_path, self.src_repo, 'default', offline=True)
+
+    def test_fingerprint(self):
+        """A matching fingerprint makes updates no-ops."""
+        calls = []
+
+        class HgRepoLogUpdates(HgRepo):
+            def get_update(self, revision):
+                calls.append(revision)
+                HgRepo.get_update(self, revision)
+
+        repo_path = os.path.join(self.dst_dir, "clone")
+        node = HgRepo(self.src_repo, self.src_repo).parents()[0]
+
+        def update(revision, **kw):
+            calls[:] = []
+            repo = HgRepoLogUpdates(repo_path, self.src_repo,
+                                    fingerprint=True, **kw)
+            repo(revision)
+            return bool(calls)
+
+        self.assertTrue(update(node))
+        self.assertTrue(os.path.exists(
+            os.path.join(repo_path, '.hg', 'buildout-fingerprint.json')))
+        self.assertFalse(update(node))
+        # options are part of the fingerprint
+        self.assertTrue(update(node, subdir='addons'))
+        self.assertFalse(update(node, subdir='addons'))
+        self.assertTrue(update(node))
+
+        # a moving revision needs the refs cache
+        self.assertTrue(update('default'))
+        self.assertTrue(update('default'))
+        cache = RefsCache(os.path.join(self.dst_dir, 'refs.json'), 3600)
+        self.assertTrue(update('default', refs_cache=cache))
+        self.assertFalse(update('default', refs_cache=cache))
+        cache.set(self.src_repo, 'default', 'other')
+        self.assertTrue(update('default', refs_cache=cache))
+
+        # local changes of parents are detected
+        self.assertTrue(update(node))
+        self.assertFalse(update(node))
+        subprocess.check_call(['hg', '--cwd', repo_path, 'up', 'null'])
+        self.assertTrue(update(node))
+
+        # the feature is not activated by default
+        calls[:] = []
+        HgRepoLogUpdates(repo_path, self.src_repo)(node)
+        self.assertTrue(calls)
+
+    def test_fingerprint_merge(self):
+        repo_path = os.path.join(self.dst_dir, "clone")
+        node = HgRepo(self.src_repo, self.src_repo).parents()[0]
+        repo = HgRepo(repo_path, self.src_repo, fingerprint=True, merge=True)
+        repo.write_fingerprint(node)
+        self.assertFalse(os.path.exists(repo.fingerprint_path))
+        self.assertFalse(repo.is_up_to_date(node))
+
+
+class RefsCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = mkdtemp('test_refs_cache')
+        self.path = os.path.join(self.tmp_dir, 'refs.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_set(self):
+        cache = RefsCache(self.path, 60)
+        self.assertIsNone(cache.get('http://some/url', 'master'))
+        cache.set('http://some/url', 'master', ['branch', 'abc'])
+        self.assertEqual(cache.get('http://some/url', 'master'),
+                         ['branch', 'abc'])
+        self.assertIsNone(cache.get('http://some/url', 'other'))
+        self.assertIsNone(cache.get('http://other/url', 'master'))
+
+    def test_expiration(self):
+        cache = RefsCache(self.path, 60)
+        cache.set('http://some/url', 'master', 'abc')
+        cache.set('http://some/url', 'old', 'def')
+        key = RefsCache.key('http://some/url', 'old')
+        cache.entries[key] = ('def', time.time() - 61)
+        self.assertIsNone(cache.get('http://some/url', 'old'))
+
+        # expired entries are not saved
+        cache.save()
+        cache = RefsCache(self.path, 3600)
+        self.assertEqual(cache.get('http://some/url', 'master'), 'abc')
+        self.assertFalse(key in cache.entries)
+
+    def test_concurrent_instances(self):
+        cache1 = RefsCache(self.path, 60)
+        cache2 = RefsCache(self.path, 60)
+        cache1.set('http://some/url', 'master', 'abc')
+        cache1.set('http://some/url', 'shared', 'old')
+        cache2.set('http://other/url', 'master', 'def')
+        cache2.set('http://some/url', 'shared', 'new')
+        cache2.save()
+        cache1.save()
+
+        cache = RefsCache(self.path, 60)
+        self.assertEqual(cache.get('http://some/url', 'master'), 'abc')
+        self.assertEqual(cache.get('http://other/url', 'master'), 'def')
+        # the most recent entry wins
+        self.assertEqual(cache.get('http://some/url', 'shared'), 'new')
+
+    def test_corrupted(self):
+        with open(self.path, 'w') as cache_file:
+            cache_file.write('{not json')
+        cache = RefsCache(self.path, 60)
+        self.assertEqual(cache.entries, {})
+
+    def test_repo(self):
+        cache = RefsCache(self.path, 60)
+        repo = BaseRepo('/some/path', 'http://some/url', refs_cache=cache)
+        self.assertIsNone(repo.get_cached_ref('master'))
+        repo.set_cached_ref('master', None)
+        self.assertEqual(cache.entries, {})
+        repo.set_cached_ref('master', 'abc')
+        self.assertEqual(repo.get_cached_ref('master'), 'abc')
+        self.assertEqual(cache.get('http://some/url', 'master'), 'abc')
+
+        repo = BaseRepo('/some/path', 'http://some/url')
+        self.assertIsNone(repo.get_cached_ref('master'))
+        repo.set_cached_ref('master', 'abc')  # no error
@@ -6,9 +6,10 @@ from zc.buildout import UserError
 from ..testing import COMMIT_USER_FULL
 from ..testing import VcsTestCase
 from ..bzr import BzrBranch
-from ..bzr import working_directory_keeper
 from ..base import UpdateError
 from ..base import CloneError
+from ..base import RefsCache
+from ...utils import working_directory_keeper
 
 
 class BzrBaseTestCase(VcsTestCase):
@@ -144,6 +145,69 @@ class BzrTestCase(BzrBaseTestCase):
         branch('last:1')
         self.assertRevision2(branch)
 
+    def test_shared_repo(self):
+        shared = os.path.join(self.dst_dir, 'shared')
+        opts = {'bzr-shared-repo': shared}
+        branch = BzrBranch(os.path.join(self.dst_dir, "b1"),
+                           self.src_repo, **opts)
+        branch('1')
+        self.assertRevision1(branch)
+        shared_branch = branch.shared_branch_path()
+        self.assertEqual(os.path.dirname(shared_branch), shared)
+        self.assertTrue(os.path.isdir(os.path.join(shared, '.bzr',
+                                                   'repository')))
+        # the target is a lightweight checkout, without its own revisions
+        self.assertFalse(os.path.exists(os.path.join(
+            branch.target_dir, '.bzr', 'repository')))
+        # the whole history is in the shared repository
+        self.assertEqual(branch.get_tip_revid(), branch.get_revid('2'))
+
+        # second target on the same branch, updates
+        other = BzrBranch(os.path.join(self.dst_dir, "b2"),
+                          self.src_repo, **opts)
+        other('last:1')
+        self.assertRevision2(other)
+        self.assertEqual(other.shared_branch_path(), shared_branch)
+        branch('last:1')
+        self.assertRevision2(branch)
+        self.assertEqual(branch.parse_conf()['parent_location'],
+                         self.src_repo)
+
+    def test_shared_repo_url_change(self):
+        shared = os.path.join(self.dst_dir, 'shared')
+        opts = {'bzr-shared-repo': shared}
+        target_dir = os.path.join(self.dst_dir, "b1")
+        branch = BzrBranch(target_dir, self.src_repo, **opts)
+        branch('1')
+        old_shared_branch = branch.shared_branch_path()
+
+        new_src = os.path.join(self.src_dir, 'new-src-repo')
+        os.rename(self.src_repo, new_src)
+        branch = BzrBranch(target_dir, new_src, **opts)
+        branch('last:1')
+        self.assertRevision2(branch)
+        shared_branch = branch.shared_branch_path()
+        self.assertNotEqual(shared_branch, old_shared_branch)
+        self.assertTrue(branch.is_bound_to(shared_branch))
+        self.assertEqual(branch.parse_conf()['parent_location'], new_src)
+
+        # offline, the new branch can't be created in the shared repo
+        branch = BzrBranch(target_dir, 'http://other.url.example',
+                           offline=True, **opts)
+        self.assertRaises(UserError, branch, 'last:1')
+        self.assertTrue(branch.is_bound_to(shared_branch))
+
+    def test_shared_repo_existing_branch(self):
+        """Standalone branches are not converted to the shared repo."""
+        target_dir = os.path.join(self.dst_dir, "My branch")
+        BzrBranch(target_dir, self.src_repo)('1')
+        branch = BzrBranch(target_dir, self.src_repo,
+                           **{'bzr-shared-repo': os.path.join(self.dst_dir,
+                                                              'shared')})
+        self.assertIsNone(branch.shared_branch_path())
+        branch('last:1')
+        self.assertRevision2(branch)
+
     def test_branch_to_rev(self):
         """Directly clone and update to given revision."""
         target_dir = os.path.join(self.dst_dir, "My branch")
@@ -185,6 +249,25 @@ class BzrTestCase(BzrBaseTestCase):
         branch('2')
         self.assertRevision2(branch)
 
+    def test_update_refs_cache(self):
+        """Within the refs cache TTL, no pull is performed."""
+        cache = RefsCache(os.path.join(self.dst_dir, 'refs.json'), 3600)
+        target_dir = os.path.join(self.dst_dir, "clone to update")
+        branch = BzrBranch(target_dir, self.src_repo, refs_cache=cache)('1')
+        branch.update_conf()  # parent location as written by bzr may differ
+        cache.set(self.src_repo, 'last:1', branch.get_tip_revid())
+
+        branch('last:1')
+        self.assertRevision1(branch)
+
+        # after expiration, the pull is done
+        cache.ttl = 0
+        branch('last:1')
+        self.assertRevision2(branch)
+        cache.ttl = 3600
+        self.assertEqual(cache.get(self.src_repo, 'last:1'),
+                         branch.get_revid('2'))
+
     def test_update_revid_needs_pull(self):
         """Update to a rev that needs to be pulled from source, by revid."""
         target_dir = os.path.join(self.dst_dir, "clone to update")
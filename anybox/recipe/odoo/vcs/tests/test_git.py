@@ -8,7 +8,10 @@ from ..testing import COMMIT_USER_NAME
 from ..testing import VcsTestCase
 from ..git import GitRepo
 from ..git import BUILDOUT_ORIGIN
+from ..git import read_refs
 from ..base import UpdateError
+from ..base import RefsCache
+from ..base import close_all
 from ...utils import working_directory_keeper, WorkingDirectoryKeeper
 from ...utils import check_output
 
@@ -297,6 +300,37 @@ class GitTestCase(GitBaseTestCase):
         self.assertEqual(repo.query_remote_ref(BUILDOUT_ORIGIN, 'deadbeef'),
                          (None, 'deadbeef'))
 
+    def test_update_refs_cache(self):
+        """Within the refs cache TTL, no remote query nor fetch is done."""
+        cache = RefsCache(os.path.join(self.dst_dir, 'refs.json'), 3600)
+        target_dir = os.path.join(self.dst_dir, "clone")
+        repo = GitRepo(target_dir, self.src_repo, refs_cache=cache)('master')
+        self.assertEqual(list(cache.get(self.src_repo, 'master')),
+                         ['branch', self.commit_2_sha])
+
+        new_sha = git_write_commit(self.src_repo, 'tracked',
+                                   "new", msg="new commit")
+        # going elsewhere, and then back from the cache
+        repo(self.commit_1_sha)
+        repo('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+
+        # after expiration, the fetch is done
+        cache.ttl = 0
+        repo('master')
+        self.assertEqual(repo.parents(), [new_sha])
+        cache.ttl = 3600
+        self.assertEqual(list(cache.get(self.src_repo, 'master')),
+                         ['branch', new_sha])
+
+    def test_refs_cache_missing_commit(self):
+        """A cached SHA that is not available locally is fetched."""
+        cache = RefsCache(os.path.join(self.dst_dir, 'refs.json'), 3600)
+        cache.set(self.src_repo, 'master', ['branch', self.commit_1_sha])
+        target_dir = os.path.join(self.dst_dir, "clone")
+        repo = GitRepo(target_dir, self.src_repo, refs_cache=cache)('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+
     def test_clone_remote_HEAD(self):
         """Remote HEAD should be usable to clone onto."""
         target_dir = os.path.join(self.dst_dir, "clone to make on HEAD")
@@ -599,6 +633,78 @@ class GitMergeTestCase(GitBaseTestCase):
                         'file_on_branch1 should exist')
         repo.revert('master')
 
+    def test_05_merge_cache(self):
+        target_dir = os.path.join(self.dst_dir, "to_repo")
+        repo = GitRepo(target_dir, self.src_repo)
+        repo('master')
+        git_set_user_info(repo.target_dir)
+        base = repo.parents()[0]
+        repo.merge('branch1')
+        repo.merge('branch2')
+        merged = repo.parents()[0]
+        self.assertEqual(len(check_output(['git', 'for-each-ref',
+                                           'refs/buildout-merges/'],
+                                          cwd=target_dir).splitlines()), 2)
+
+        repo.revert('master')
+        self.assertEqual(repo.parents(), [base])
+        # breaking the remote shows that the merges are not redone
+        repo.url = os.path.join(self.dst_dir, 'does-not-exist')
+        GitRepo.preload_remote_refs([self.src_repo])
+        try:
+            repo._remote_refs[repo.url] = repo._remote_refs[self.src_repo]
+            repo.merge('branch1')
+            repo.merge('branch2')
+        finally:
+            GitRepo.clear_remote_refs()
+        self.assertEqual(repo.parents(), [merged])
+
+    def test_06_fetch_merge_revisions(self):
+        target_dir = os.path.join(self.dst_dir, "to_repo")
+        repo = GitRepo(target_dir, self.src_repo)
+        repo('master')
+        git_set_user_info(repo.target_dir)
+        repo.fetch_merge_revisions(['branch1', 'branch2', 'unknown'])
+
+        # no more fetch needed
+        GitRepo.preload_remote_refs([self.src_repo])
+        try:
+            repo.url = os.path.join(self.dst_dir, 'does-not-exist')
+            repo._remote_refs[repo.url] = repo._remote_refs[self.src_repo]
+            repo.merge('branch1')
+            repo.merge('branch2')
+        finally:
+            GitRepo.clear_remote_refs()
+        for fname in ('file_on_branch1', 'file_on_branch2'):
+            self.assertTrue(os.path.exists(os.path.join(target_dir, fname)))
+
+    def test_07_merge_network_calls(self):
+        """With preloaded refs, merging branches takes a single fetch."""
+        target_dir = os.path.join(self.dst_dir, "to_repo")
+        repo = GitRepo(target_dir, self.src_repo)
+        repo('master')
+        git_set_user_info(repo.target_dir)
+
+        commands = []
+        orig_log_call = repo.log_call
+
+        def log_call(cmd, *args, **kwargs):
+            commands.append(cmd[1])
+            return orig_log_call(cmd, *args, **kwargs)
+        repo.log_call = log_call
+
+        GitRepo.preload_remote_refs([self.src_repo])
+        try:
+            repo.fetch_merge_revisions(['branch1', 'branch2'])
+            repo.merge('branch1')
+            repo.merge('branch2')
+        finally:
+            GitRepo.clear_remote_refs()
+        self.assertEqual([c for c in commands if c in ('fetch', 'ls-remote')],
+                         ['fetch'])
+        for fname in ('file_on_branch1', 'file_on_branch2'):
+            self.assertTrue(os.path.exists(os.path.join(target_dir, fname)))
+
 
 class GitTagTestCase(GitBaseTestCase):
 
@@ -621,6 +727,71 @@ class GitTagTestCase(GitBaseTestCase):
             self.assertRemoteQueryResult(
                 repo.query_remote_ref('orig', 'sometag'), self.commit_1_sha)
 
+    def test_local_tags(self):
+        repo = GitRepo(self.src_repo, self.src_repo)
+        with working_directory_keeper:
+            os.chdir(self.src_repo)
+            self.make_tag('sub/tag')
+        self.assertEqual(repo.local_tags(), set(('sometag', 'sub/tag')))
+        self.assertTrue(repo.is_local_fixed_revision('sometag'))
+        self.assertFalse(repo.is_local_fixed_revision('master'))
+
+        subprocess.check_call(['git', 'pack-refs', '--all'],
+                              cwd=self.src_repo)
+        git_dir = os.path.join(self.src_repo, '.git')
+        self.assertFalse(os.path.exists(
+            os.path.join(git_dir, 'refs', 'tags', 'sometag')))
+        with working_directory_keeper:
+            os.chdir(self.src_repo)
+            self.make_tag('loose')
+        tags = read_refs(git_dir, 'refs/tags/')
+        self.assertEqual(set(tags), set(('sometag', 'sub/tag', 'loose')))
+        self.assertEqual(tags['loose'],
+                         check_output(['git', 'rev-parse', 'loose'],
+                                      cwd=self.src_repo).strip())
+        self.assertTrue(repo.is_local_fixed_revision('sub/tag'))
+        self.assertTrue(repo.is_local_fixed_revision('loose'))
+
+        # fallback
+        os.mkdir(os.path.join(git_dir, 'reftable'))
+        self.assertRaises(ValueError, read_refs, git_dir, 'refs/tags/')
+        self.assertEqual(repo.local_tags(),
+                         set(('sometag', 'sub/tag', 'loose')))
+
+    def test_local_tags_worktree(self):
+        main = GitRepo(os.path.join(self.dst_dir, "main"), self.src_repo)
+        main('master')
+        repo = GitRepo(os.path.join(self.dst_dir, "wt"), self.src_repo,
+                       worktree_of=main.target_dir)('sometag')
+        self.assertEqual(repo.common_git_dir,
+                         os.path.join(main.target_dir, '.git'))
+        self.assertTrue(repo.is_local_fixed_revision('sometag'))
+
+    def test_fingerprint_tag(self):
+        target_dir = os.path.join(self.dst_dir, "to_repo")
+        repo = GitRepo(target_dir, self.src_repo, fingerprint=True)
+        repo('sometag')
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+        self.assertTrue(repo.is_up_to_date('sometag'))
+        self.assertFalse(repo.is_up_to_date('master'))
+        # HEAD has moved
+        repo('master')
+        self.assertFalse(repo.is_up_to_date('sometag'))
+
+    def test_query_remote_preloaded(self):
+        target_dir = os.path.join(self.dst_dir, "to_repo")
+        repo = GitRepo(target_dir, self.src_repo)
+        GitRepo.preload_remote_refs([self.src_repo])
+        try:
+            with working_directory_keeper:
+                subprocess.check_call(['git', 'init', target_dir])
+                os.chdir(target_dir)
+                self.assertRemoteQueryResult(
+                    repo.query_remote_ref(self.src_repo, 'sometag'),
+                    self.commit_1_sha)
+        finally:
+            GitRepo.clear_remote_refs()
+
     def assertRemoteQueryResult(self, result, expected_sha):
         """If possible, check that the result of query matches expected_sha.
 
@@ -719,3 +890,287 @@ class GitAnnotatedTagTestCase(GitTagTestCase):
         # that will be enough for now : there are also tests for
         # get_update(). This test is to fasten up debugging
         self.assertEqual(result[0], ('tag'))
+
+
+class GitCacheTestCase(GitBaseTestCase):
+
+    def setUp(self):
+        super(GitCacheTestCase, self).setUp()
+        self.cache_dir = os.path.join(self.sandbox, 'cache')
+        GitRepo._updated_mirrors.clear()
+
+    def make_repo(self, name, **options):
+        options['git-cache-directory'] = self.cache_dir
+        return GitRepo(os.path.join(self.dst_dir, name), self.src_repo,
+                       **options)
+
+    def assertBorrows(self, repo):
+        mirror = repo.cache_mirror_path()
+        with open(os.path.join(repo.target_dir, '.git', 'objects', 'info',
+                               'alternates')) as alt_file:
+            self.assertEqual(alt_file.read().strip(),
+                             os.path.join(mirror, 'objects'))
+        # no object has been stored in the local repository
+        count = check_output(['git', 'count-objects', '-v'],
+                             cwd=repo.target_dir)
+        count = count.splitlines()
+        self.assertTrue('count: 0' in count)
+        self.assertTrue('in-pack: 0' in count)
+
+    def test_clone(self):
+        repo = self.make_repo('clone')('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+        self.assertEqual(repo.get_current_remote_fetch(), self.src_repo)
+
+        mirror = repo.cache_mirror_path()
+        self.assertTrue(mirror.startswith(self.cache_dir))
+        self.assertEqual(check_output(['git', 'rev-parse', 'master'],
+                                      cwd=mirror).strip(), self.commit_2_sha)
+        self.assertBorrows(repo)
+
+        repo2 = self.make_repo('clone2')(self.commit_1_sha)
+        self.assertEqual(repo2.parents(), [self.commit_1_sha])
+        self.assertEqual(repo2.cache_mirror_path(), mirror)
+        self.assertBorrows(repo2)
+
+    def test_update(self):
+        repo = self.make_repo('clone')('master')
+        new_sha = git_write_commit(self.src_repo, 'tracked',
+                                   "new content", msg="new commit")
+        # the mirror is updated once per process
+        GitRepo._updated_mirrors.clear()
+        repo('master')
+        self.assertEqual(repo.parents(), [new_sha])
+
+    def test_no_mirror_update_if_not_needed(self):
+        cache = RefsCache(os.path.join(self.sandbox, 'refs.json'), 3600)
+        self.make_repo('clone', refs_cache=cache)('master')
+        self.make_repo('pinned')(self.commit_1_sha)
+
+        # next run
+        GitRepo._updated_mirrors.clear()
+        updates = []
+        orig_update = GitRepo.update_cache_mirror
+
+        def update_cache_mirror(repo):
+            updates.append(repo.target_dir)
+            return orig_update(repo)
+        GitRepo.update_cache_mirror = update_cache_mirror
+        try:
+            repo = self.make_repo('clone', refs_cache=cache)('master')
+            self.assertEqual(repo.parents(), [self.commit_2_sha])
+            repo = self.make_repo('pinned')(self.commit_1_sha)
+            self.assertEqual(repo.parents(), [self.commit_1_sha])
+            self.assertEqual(updates, [])
+
+            # a fetch is needed
+            repo = self.make_repo('clone')('master')
+            self.assertEqual(len(updates), 1)
+        finally:
+            GitRepo.update_cache_mirror = orig_update
+
+    def test_clone_depth(self):
+        repo = self.make_repo('clone', depth='1')('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+
+
+class GitPartialCloneTestCase(GitBaseTestCase):
+
+    def create_src(self):
+        GitBaseTestCase.create_src(self)
+        os.mkdir(os.path.join(self.src_repo, 'addons_a'))
+        os.mkdir(os.path.join(self.src_repo, 'addons_b'))
+        git_write_commit(self.src_repo, os.path.join('addons_a', 'f'), "a")
+        self.commit_3_sha = git_write_commit(
+            self.src_repo, os.path.join('addons_b', 'f'), "b")
+        subprocess.check_call(['git', 'config', 'uploadpack.allowFilter',
+                               'true'], cwd=self.src_repo)
+
+    def setUp(self):
+        super(GitPartialCloneTestCase, self).setUp()
+        if GitRepo('', '').git_version < (2, 25):
+            self.skipTest("Sparse checkout needs Git >= 2.25")
+
+    def missing_objects(self, repo):
+        out = check_output(['git', 'rev-list', '--objects', '--missing=print',
+                            'HEAD'], cwd=repo.target_dir)
+        return [line[1:] for line in out.splitlines()
+                if line.startswith('?')]
+
+    def test_init_filter(self):
+        repo = GitRepo('/some/target', self.src_repo, filter='blob:none')
+        self.assertEqual(repo.options.get('filter'), 'blob:none')
+        repo = GitRepo('/some/target', self.src_repo, filter='None')
+        self.assertFalse('filter' in repo.options)
+
+    def test_clone_filter(self):
+        target_dir = os.path.join(self.dst_dir, "clone")
+        repo = GitRepo(target_dir, self.src_repo,
+                       filter='blob:none')('master')
+        self.assertEqual(repo.parents(), [self.commit_3_sha])
+        # no sparse checkout without subdir: the whole tree is there
+        self.assertTrue(os.path.exists(os.path.join(target_dir, 'addons_b')))
+        # but not the history
+        self.assertNotEqual(self.missing_objects(repo), [])
+        self.assertEqual(check_output(
+            ['git', 'config', 'remote.%s.promisor' % BUILDOUT_ORIGIN],
+            cwd=target_dir).strip(), 'true')
+
+    def test_clone_filter_subdir(self):
+        target_dir = os.path.join(self.dst_dir, "clone")
+        repo = GitRepo(target_dir, self.src_repo, filter='blob:none',
+                       subdir='addons_a')('master')
+        self.assertEqual(repo.parents(), [self.commit_3_sha])
+        self.assertTrue(os.path.exists(
+            os.path.join(target_dir, 'addons_a', 'f')))
+        self.assertTrue(os.path.exists(os.path.join(target_dir, 'tracked')))
+        self.assertFalse(os.path.exists(os.path.join(target_dir, 'addons_b')))
+        # the blob of addons_b/f has not been fetched
+        blob = check_output(['git', 'rev-parse', 'HEAD:addons_b/f'],
+                            cwd=target_dir).strip()
+        self.assertTrue(blob in self.missing_objects(repo))
+
+        # removing the subdir restores the full working tree
+        repo = GitRepo(target_dir, self.src_repo,
+                       filter='blob:none')('master')
+        self.assertTrue(os.path.exists(
+            os.path.join(target_dir, 'addons_b', 'f')))
+        self.assertFalse(blob in self.missing_objects(repo))
+
+    def test_subdir_no_filter(self):
+        target_dir = os.path.join(self.dst_dir, "clone")
+        GitRepo(target_dir, self.src_repo, subdir='addons_a')('master')
+        self.assertTrue(os.path.exists(os.path.join(target_dir, 'addons_b')))
+
+
+class GitWorktreeTestCase(GitBaseTestCase):
+
+    def create_src(self):
+        GitBaseTestCase.create_src(self)
+        subprocess.check_call(['git', 'branch', 'other', self.commit_1_sha],
+                              cwd=self.src_repo)
+
+    def setUp(self):
+        super(GitWorktreeTestCase, self).setUp()
+        self.main_dir = os.path.join(self.dst_dir, 'main')
+        self.main = GitRepo(self.main_dir, self.src_repo)('master')
+
+    def make_worktree(self, name, **options):
+        return GitRepo(os.path.join(self.dst_dir, name), self.src_repo,
+                       worktree_of=self.main_dir, **options)
+
+    def test_worktree(self):
+        repo = self.make_worktree('wt')('other')
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+        self.assertTrue(os.path.isfile(os.path.join(repo.target_dir, '.git')))
+        self.assertEqual(self.main.parents(), [self.commit_2_sha])
+
+        # same branch as the main repository
+        repo2 = self.make_worktree('wt2')('master')
+        self.assertEqual(repo2.parents(), [self.commit_2_sha])
+
+        new_sha = git_write_commit(self.src_repo, 'tracked',
+                                   "new", msg="new commit")
+        repo2('master')
+        self.assertEqual(repo2.parents(), [new_sha])
+        # main repository working tree is untouched
+        self.assertEqual(self.main.parents(), [self.commit_2_sha])
+
+        repo2(self.commit_1_sha)
+        self.assertEqual(repo2.parents(), [self.commit_1_sha])
+
+    def test_worktree_tag(self):
+        subprocess.check_call(['git', 'tag', 'sometag', self.commit_1_sha],
+                              cwd=self.src_repo)
+        repo = self.make_worktree('wt')('sometag')
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+
+    def test_worktree_removed(self):
+        repo = self.make_worktree('wt')('other')
+        repo.clear_target()
+        repo('other')
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+
+    def test_worktree_offline(self):
+        repo = self.make_worktree('wt', offline=True)('master')
+        self.assertEqual(repo.parents(), [self.commit_2_sha])
+
+    def test_worktree_fingerprint(self):
+        repo = self.make_worktree('wt', fingerprint=True)(self.commit_1_sha)
+        self.assertTrue(os.path.exists(repo.fingerprint_path))
+        self.assertTrue(repo.is_up_to_date(self.commit_1_sha))
+
+    def test_full_clone(self):
+        """An existing full clone is updated normally."""
+        target_dir = os.path.join(self.dst_dir, 'clone')
+        GitRepo(target_dir, self.src_repo)('master')
+        repo = self.make_worktree('clone')('other')
+        self.assertEqual(repo.parents(), [self.commit_1_sha])
+        self.assertTrue(os.path.isdir(os.path.join(target_dir, '.git')))
+
+
+class GitObjectInfoTestCase(GitBaseTestCase):
+
+    def test_object_info(self):
+        target_dir = os.path.join(self.dst_dir, "clone")
+        repo = GitRepo(target_dir, self.src_repo)('master')
+        self.assertEqual(repo.object_info('master'),
+                         (self.commit_2_sha, 'commit'))
+        self.assertEqual(repo.object_info(self.commit_1_sha[:10]),
+                         (self.commit_1_sha, 'commit'))
+        self.assertEqual(repo.object_info('master:tracked')[1], 'blob')
+        self.assertIsNone(repo.object_info('unknown'))
+        self.assertIsNone(repo.object_info('with space'))
+        self.assertIsNone(repo.object_info('two\nlines'))
+        self.assertTrue(repo.has_commit(self.commit_2_sha))
+        self.assertFalse(repo.has_commit('master:tracked'))
+        self.assertEqual(repo.get_local_hash_for_ref('master'),
+                         self.commit_2_sha)
+        self.assertIsNone(repo.get_local_hash_for_ref('deadbeef'))
+
+        # the same process sees new objects and refs
+        cat_file = repo._cat_file
+        new_sha = git_write_commit(self.src_repo, 'tracked',
+                                   "new", msg="new commit")
+        self.assertIsNone(repo.object_info(new_sha))
+        subprocess.check_call(['git', 'fetch', self.src_repo,
+                               'master:refs/remotes/other/master'],
+                              cwd=target_dir)
+        self.assertEqual(repo.object_info(new_sha), (new_sha, 'commit'))
+        self.assertEqual(repo.get_local_hash_for_ref('other/master'),
+                         new_sha)
+        self.assertTrue(repo._cat_file is cat_file)
+
+        repo.close()
+        self.assertIsNone(repo._cat_file)
+        self.assertEqual(cat_file.returncode, 0)
+        # still usable
+        self.assertTrue(repo.has_commit(new_sha))
+        repo.close()
+
+    def test_call_closes(self):
+        target_dir = os.path.join(self.dst_dir, "clone")
+        repo = GitRepo(target_dir, self.src_repo)
+        repo(self.commit_1_sha)
+        repo(self.commit_1_sha)
+        self.assertIsNone(repo._cat_file)
+
+    def test_with_closes(self):
+        target_dir = os.path.join(self.dst_dir, "clone")
+        GitRepo(target_dir, self.src_repo)(self.commit_1_sha)
+        with GitRepo(target_dir, self.src_repo) as repo:
+            self.assertTrue(repo.has_commit(self.commit_1_sha))
+            cat_file = repo._cat_file
+        self.assertIsNone(repo._cat_file)
+        self.assertEqual(cat_file.returncode, 0)
+
+        repo.has_commit(self.commit_1_sha)
+        cat_file = repo._cat_file
+        close_all()
+        self.assertIsNone(repo._cat_file)
+        self.assertEqual(cat_file.returncode, 0)
+
+    def test_object_info_no_repo(self):
+        repo = GitRepo(os.path.join(self.dst_dir, "missing"), self.src_repo)
+        self.assertIsNone(repo.object_info('master'))
+        self.assertFalse(repo.has_commit(self.commit_1_sha))
@@ -9,6 +9,7 @@ from ..testing import COMMIT_USER_FULL
 from ..testing import VcsTestCase
 from ..hg import HgRepo
 from ..base import UpdateError
+from ..base import RefsCache
 
 
 class HgBaseTestCase(VcsTestCase):
@@ -183,6 +184,31 @@ class HgTestCase(HgBaseTestCase):
         self.assertFutureBranch(repo)
         self.assertRevision(repo, 2)  # would not have worked without a pull
 
+    def test_update_refs_cache(self):
+        """Within the refs cache TTL, no pull is performed."""
+        cache = RefsCache(os.path.join(self.dst_dir, 'refs.json'), 3600)
+        target_dir = os.path.join(self.dst_dir, "clone")
+        repo = HgRepo(target_dir, self.src_repo, refs_cache=cache)('future')
+        self.assertEqual(cache.get(self.src_repo, 'future'), self.rev1)
+
+        newfile = os.path.join(self.src_repo, 'newfile')
+        with open(newfile, 'w') as f:
+            f.write('something')
+        subprocess.check_call(['hg', '--cwd', self.src_repo,
+                               'commit', '-A', '-m',
+                               "new commit on future branch",
+                               '-u', COMMIT_USER_FULL])
+        repo('future')
+        self.assertRevision(repo, 1)
+
+        # after expiration, the pull is done
+        cache.ttl = 0
+        repo('future')
+        self.assertRevision(repo, 2)
+        cache.ttl = 3600
+        self.assertEqual(cache.get(self.src_repo, 'future'),
+                         self.get_parent_node(self.src_repo))
+
     def test_update_fixed_rev(self):
         """Test update on a fixed rev that we already have."""
         repo = self.make_clone("clone to update", 'default')
@@ -314,6 +340,40 @@ class HgTestCase(HgBaseTestCase):
             self.assertEquals(f.readlines()[0].strip(), 'default')
 
 
+class HgCmdServerTestCase(HgTestCase):
+    """Same tests, running commands through the command server."""
+
+    def setUp(self):
+        super(HgCmdServerTestCase, self).setUp()
+        HgRepo.cmdserver = True
+
+    def tearDown(self):
+        HgRepo.cmdserver = False
+        super(HgCmdServerTestCase, self).tearDown()
+
+    def test_server_reuse(self):
+        repo = self.make_clone("clone", 'default')
+        self.assertIsNone(repo._server)  # closed at the end of __call__
+        repo.parents()
+        server = repo._server
+        self.assertIsNotNone(server)
+        self.assertFalse(repo.uncommitted_changes())
+        self.assertTrue(repo.is_local_fixed_revision(self.rev0))
+        self.assertIs(repo._server, server)
+        self.assertEqual(repo.get_node('does-not-exist'), None)
+        repo.close()
+        self.assertIsNone(repo._server)
+        self.assertIsNotNone(server.process.returncode)
+
+    def test_option(self):
+        repo = HgRepo(os.path.join(self.dst_dir, "clone"), self.src_repo,
+                      **{'hg-cmdserver': 'false'})
+        self.assertFalse(repo.cmdserver)
+        repo('default')
+        repo.parents()
+        self.assertIsNone(repo._server)
+
+
 class HgOfflineTestCase(HgBaseTestCase):
 
     def make_clone(self, path, initial_rev):
@@ -9,9 +9,7 @@ if sys.version_info < (2, 6):
                      "Yours is " + sys.version + os.linesep)
     sys.exit(1)
 
-# a sufficient version of pip is needed to parse Odoo requirement file
-# version 1.4.1 is the one required by reportlab anyway
-requires = ['setuptools', 'zc.recipe.egg', 'zc.buildout>=2.2.0', 'pip>=1.4.1']
+requires = ['setuptools', 'zc.recipe.egg', 'zc.buildout>=2.2.0']
 
 if sys.version_info < (2, 7):
     requires.append('ordereddict')